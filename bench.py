@@ -0,0 +1,792 @@
+import os
+import sys
+import re
+import json
+import time
+import timeit
+import platform
+import shutil
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import ir
+import transformer
+import incremental
+from typing import *
+
+# benchmarks for the transpiler, and the code it emits.
+#
+# python3 bench.py [name...] [--json results.json]
+# python3 bench.py --compare old.json new.json
+#
+# each benchmark returns a flat dict of results, which are printed
+# as `name.key: value` lines, or dumped as JSON to compare between commits.
+
+# the `_In` helper as it was first written, kept for comparison
+LEGACY_IN_PRELUDE = (
+	'class _In:\n'
+	'	__init__ = lambda self, notin, lhs=None: (setattr(self, "notin", notin), setattr(self, "lhs", lhs), None)[2]\n'
+	'	__rand__ = lambda self, lhs: _In(self.notin, lhs)\n'
+	'	__and__ = lambda self, rhs: (self.in_impl(rhs), self.op_ret)[1] ^ self.notin\n'
+	'	def in_impl(self, rhs):\n'
+	'		is_inst = isinstance(rhs, str)\n'
+	'		if is_inst:\n'
+	'			self.op_ret = rhs.find(self.lhs) != -1\n'
+	'		if False == is_inst:\n'
+	'			self.op_ret = any(filter(lambda _x: _x == self.lhs, rhs))\n'
+	'_in = _In(False)\n'
+)
+
+# the `_And`, `_Or` and `_Not` helpers as they were first written.
+#
+# note: the legacy `_Not` drains its counter on first use, every later
+# `_not& x` skips the loop entirely. it's measured as is.
+LEGACY_BOOL_PRELUDE = (
+	'class _And:\n'
+	'	__init__ = lambda self, lhs=None : setattr(self, "lhs", lhs)\n'
+	'	__rxor__ = lambda self, lhs: _And(lhs)\n'
+	'	__xor__ = lambda self, rhs: (self.impl_and(rhs), self.op_ret)[1]\n'
+	'	def impl_and(self, rhs):\n'
+	'		passed = True\n'
+	'		if self.lhs:\n'
+	'			self.op_ret = rhs\n'
+	'			passed = False\n'
+	'		if passed:\n'
+	'			self.op_ret = self.lhs\n'
+	'_and = _And()\n'
+	'class _Or:\n'
+	'	__init__ = lambda self, lhs=None: setattr(self, "lhs", lhs)\n'
+	'	__ror__ = lambda self, lhs: _Or(lhs)\n'
+	'	__or__ = lambda self, rhs: (self.impl_or(rhs), self.op_ret)[1]\n'
+	'	def impl_or(self, rhs):\n'
+	'		passed = True\n'
+	'		if self.lhs:\n'
+	'			self.op_ret = self.lhs\n'
+	'			passed = False\n'
+	'		if passed:\n'
+	'			self.op_ret = rhs\n'
+	'_or = _Or()\n'
+	'class _Not:\n'
+	'	__init__ = lambda self: setattr(self, "dup", 1)\n'
+	'	__and__ = lambda self, other: (self.impl_not(other), self.op_ret)[1]\n'
+	'	def impl_not(self, other):\n'
+	'		is_inst = isinstance(other, _Not)\n'
+	'		if is_inst:\n'
+	'			self.dup += 1\n'
+	'			self.op_ret = self\n'
+	'		if False == is_inst:\n'
+	'			self.impl_operate(other)\n'
+	'	def impl_operate(self, other):\n'
+	'		ret = other\n'
+	'		while self.dup > 0:\n'
+	'			ret = False == bool(ret)\n'
+	'			self.dup -= 1\n'
+	'		self.op_ret = ret\n'
+	'_not = _Not()\n'
+)
+
+# the lexer as it was first written, walking every character, kept for comparison
+def legacy_iter_to_identifers(src: str):
+	start = 0
+	i = 0
+	strch = None
+
+	while True:
+		if i >= len(src):
+			yield (True, start, len(src))
+			return
+		
+		ch = src[i]
+		
+		if ch.isspace():
+			pass	
+		elif strch is None:
+			if ch == "'" or ch == '"':
+				strch = ch
+				yield (True, start, i)
+				start = i
+			elif ch == "#":
+				if src[start:i] != '':
+					yield (True, start, i)
+				yield (False, i, len(src))
+				return
+		else:
+			if ch == "\\":
+				i += 1
+			elif ch == strch:
+				strch = None
+				yield (False, start, i + 1)
+				start = i + 1		
+		i += 1
+
+# `Program.transform_expr` as it was first written, kept for comparison
+def legacy_transform_expr(program: ir.Program, src: str) -> str:
+	rep = {
+		'and': '^_and^',
+		'or': '|_or|',
+		'not in': '&_notin&',
+		'in': '&_in&',
+		'not': '_not&',
+	}
+	
+	nsrc = ''
+	for valid, start, end in ir.iter_to_identifers(src):
+		v = src[start:end]
+		if valid:
+			def matchfn(match):
+				string = match.group(0)
+				if string == 'not':
+					program.use_nothelper = True
+				elif string == 'and':
+					program.use_andhelper = True
+				elif string == 'or':
+					program.use_orhelper = True
+				elif string == 'in':
+					program.use_inhelper = True
+				elif string == 'not in':
+					program.use_notinhelper = True
+				return rep[string]
+			nsrc += re.sub(r'\b(not in|and|or|not|in)\b', matchfn, v)
+		else:
+			nsrc += v
+	return nsrc
+
+# run the full pipeline over a source string
+def transpile(src: str, **options) -> str:
+	program = ir.Program(src, **options)
+	program.transform()
+	return program.transpile()
+
+# execute a source string, returning its globals
+def run_src(src: str) -> dict:
+	namespace = {}
+	exec(compile(src, "<bench>", "exec"), namespace)
+	return namespace
+
+# best per-call time in seconds
+def best_of(fn, number: int, repeat: int = 5) -> float:
+	return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+# membership tests against large containers, the key is always found
+# at the "end" of the container to punish linear scans.
+def bench_in() -> dict:
+	src = "lookup = lambda needle, haystack: needle in haystack"
+	native = run_src(src)['lookup']
+	transformed = run_src(transpile(src))['lookup']
+	legacy = run_src(LEGACY_IN_PRELUDE + "lookup = lambda needle, haystack: needle &_in& haystack")['lookup']
+
+	results = {}
+	for size in (10 ** 3, 10 ** 6):
+		containers = {
+			'set': set(range(size)),
+			'dict': dict.fromkeys(range(size)),
+		}
+		for kind, haystack in containers.items():
+			needle = size - 1
+			results[f"{kind}{size}.native_ns"] = best_of(lambda: native(needle, haystack), 10000) * 1e9
+			results[f"{kind}{size}.transformed_ns"] = best_of(lambda: transformed(needle, haystack), 10000) * 1e9
+			# the legacy helper is O(n), keep it to the small containers
+			if size <= 10 ** 3:
+				results[f"{kind}{size}.legacy_ns"] = best_of(lambda: legacy(needle, haystack), 100) * 1e9
+	return results
+
+# throughput of the boolean operator helpers, old and new, in ops/sec.
+def bench_bool() -> dict:
+	exprs = {
+		'and_true': ("lambda a, b: a and b", True, 1),
+		'and_false': ("lambda a, b: a and b", False, 1),
+		'and_falsy': ("lambda a, b: a and b", 0, 1),
+		'or_true': ("lambda a, b: a or b", True, 1),
+		'or_falsy': ("lambda a, b: a or b", 0, 1),
+		'not': ("lambda a, b: not a", 1, None),
+	}
+
+	results = {}
+	for name, (expr, a, b) in exprs.items():
+		transformed = transpile(f"op = {expr}")
+		program = transformed[transformed.index("op = "):]
+		new = run_src(transformed)['op']
+		legacy = run_src(LEGACY_BOOL_PRELUDE + program)['op']
+		results[f"{name}.new_ops"] = 1 / best_of(lambda: new(a, b), 100000)
+		results[f"{name}.legacy_ops"] = 1 / best_of(lambda: legacy(a, b), 100000)
+	return results
+
+# call overhead of lowered functions, against the untransformed source.
+def bench_calls() -> dict:
+	src = (
+		"def fib(n):\n"
+		"	if n < 2:\n"
+		"		return n\n"
+		"	return fib(n - 1) + fib(n - 2)\n"
+		"def add(a, b):\n"
+		"	return a + b\n"
+		"def loop(n):\n"
+		"	total = 0\n"
+		"	i = 0\n"
+		"	while i < n:\n"
+		"		total = add(total, i)\n"
+		"		i += 1\n"
+		"	return total"
+	)
+	variants = {
+		'native': src,
+		'global': transpile(src, fn_lowering="global"),
+		'yield': transpile(src, fn_lowering="yield"),
+	}
+
+	results = {}
+	for name, variant in variants.items():
+		namespace = run_src(variant)
+		fib, loop = namespace['fib'], namespace['loop']
+		results[f"fib20.{name}_ms"] = best_of(lambda: fib(20), 1) * 1e3
+		results[f"loop100000.{name}_ms"] = best_of(lambda: loop(100000), 1) * 1e3
+	return results
+
+# throughput of lowered `for` loops over 10^6 element iterables.
+def bench_for() -> dict:
+	src = (
+		"def consume(values):\n"
+		"	total = 0\n"
+		"	for v in values:\n"
+		"		total += v\n"
+		"	return total"
+	)
+	variants = {
+		'native': src,
+		'except': transpile(src, for_lowering="except"),
+		'sentinel': transpile(src, for_lowering="sentinel"),
+	}
+	size = 10 ** 6
+	values = list(range(size))
+
+	results = {}
+	for name, variant in variants.items():
+		consume = run_src(variant)['consume']
+		results[f"list.{name}_mloops"] = size / best_of(lambda: consume(values), 1) / 1e6
+		results[f"generator.{name}_mloops"] = size / best_of(lambda: consume(v for v in values), 1) / 1e6
+		results[f"range.{name}_mloops"] = size / best_of(lambda: consume(range(size)), 1) / 1e6
+	return results
+
+# runtime of a program forbidding only some keywords, against forbidding
+# all of them and the untransformed source. constructs without forbidden
+# keywords are emitted as written, and keep their native speed.
+def bench_keywords() -> dict:
+	src = (
+		"def count(values, limit):\n"
+		"	total = 0\n"
+		"	for v in values:\n"
+		"		if v > limit:\n"
+		"			break\n"
+		"		elif v % 3:\n"
+		"			total += (v % 5) and 1\n"
+		"		else:\n"
+		"			total += 2\n"
+		"	return total"
+	)
+	variants = {
+		'native': src,
+		'and': transpile(src, keywords=['and']),
+		'elif_else': transpile(src, keywords=['elif', 'else']),
+		'all': transpile(src),
+	}
+	size = 10 ** 6
+	values = list(range(size))
+
+	results = {}
+	for name, variant in variants.items():
+		count = run_src(variant)['count']
+		results[f"{name}_ms"] = best_of(lambda: count(values, size), 1) * 1e3
+		results[f"{name}_lines"] = variant.count("\n") + 1
+	return results
+
+# runtime of transformed programs with and without the peephole pass,
+# and the lines they take
+def bench_peephole() -> dict:
+	programs = {
+		# an if chain, every branch but the last returning early
+		'guards': (
+			"def classify(v):\n"
+			"	if v < 10:\n"
+			"		return 0\n"
+			"	elif v < 100:\n"
+			"		return 1\n"
+			"	elif v % 2:\n"
+			"		return 2\n"
+			"	else:\n"
+			"		return 3\n"
+			"def run(n):\n"
+			"	total = 0\n"
+			"	for v in range(n):\n"
+			"		total += classify(v)\n"
+			"	return total"
+		),
+		# the fizzbuzz from the readme, without printing
+		'fizzbuzz': (
+			"def run(n):\n"
+			"	fb_count = 0\n"
+			"	for num in range(1, n + 1):\n"
+			"		if (num % 3 == 0) and (num % 5 == 0):\n"
+			"			fb_count += 1\n"
+			"		elif num % 3 == 0:\n"
+			"			fb_count += 2\n"
+			"		elif num % 5 == 0:\n"
+			"			fb_count += 3\n"
+			"		else:\n"
+			"			fb_count += 4\n"
+			"	return fb_count"
+		),
+		# a loop only ever running once, `break` at the end
+		'once': (
+			"def run(n):\n"
+			"	total = 0\n"
+			"	for v in range(n):\n"
+			"		while True:\n"
+			"			total += v\n"
+			"			break\n"
+			"	return total"
+		),
+	}
+	n = 10 ** 5
+
+	results = {}
+	for name, src in programs.items():
+		for peephole in (False, True):
+			variant = transpile(src, peephole=peephole)
+			key = 'on' if peephole else 'off'
+			run = run_src(variant)['run']
+			results[f"{name}.{key}_ms"] = best_of(lambda: run(n), 1) * 1e3
+			results[f"{name}.{key}_lines"] = variant.count("\n") + 1
+	return results
+
+# runtime of `and` and `or` lowered eagerly and lazily, in ms. `guard` and
+# `lookup` skip an expensive right operand, `cheap` only ever has cheap
+# operands, paying for the lazy helpers
+def bench_short_circuit() -> dict:
+	programs = {
+		# a right operand behind a guard, skipped almost always
+		'guard': (
+			"def expensive(v):\n"
+			"	return sum(range(50)) > v\n"
+			"def run(n):\n"
+			"	total = 0\n"
+			"	for v in range(n):\n"
+			"		if v % 100 == 0 and expensive(v):\n"
+			"			total += 1\n"
+			"	return total"
+		),
+		# a fallback computed only on a miss
+		'lookup': (
+			"def run(n):\n"
+			"	table = dict(zip(range(1, 64), range(1, 64)))\n"
+			"	total = 0\n"
+			"	for v in range(n):\n"
+			"		total += table.get(v % 64) or sum(range(20))\n"
+			"	return total"
+		),
+		'cheap': (
+			"def run(n):\n"
+			"	total = 0\n"
+			"	for v in range(n):\n"
+			"		total += (v % 3 == 0) or (v % 5 == 0)\n"
+			"	return total"
+		),
+	}
+	n = 10 ** 5
+
+	results = {}
+	for name, src in programs.items():
+		for short_circuit in (False, True):
+			key = 'lazy' if short_circuit else 'eager'
+			run = run_src(transpile(src, short_circuit=short_circuit))['run']
+			results[f"{name}.{key}_ms"] = best_of(lambda: run(n), 1) * 1e3
+	return results
+
+# lexing throughput over lines of code, against the lexer as it was
+# first written, in lines/sec. the legacy lexer doesn't look inside of
+# f-strings, the new lexer lexes their replacement fields as code.
+def bench_lex() -> dict:
+	corpora = {
+		'code': corpus_large(20000).split("\n"),
+		'strings': [
+			f"print('x{i}: ' + 'a, b' + \"it's \\\"quoted\\\"\", r'\\d+') # and a comment"
+			for i in range(20000)
+		],
+		'fstrings': [f"print(f'{{x{i}}}: {{y!r:>{{w}}}}')" for i in range(20000)],
+	}
+
+	results = {}
+	for name, lines in corpora.items():
+		for lexer_name, lexer in (('new', ir.iter_to_identifers), ('legacy', legacy_iter_to_identifers)):
+			def run():
+				for line in lines:
+					for _ in lexer(line):
+						pass
+			results[f"{name}.{lexer_name}_lines_per_sec"] = len(lines) / best_of(run, 1)
+	return results
+
+# throughput of rewriting the keywords of long expressions, big dict
+# literals, against the rewriter as it was first written, in chars/sec
+def bench_rewrite() -> dict:
+	results = {}
+	for size in (10 ** 3, 10 ** 4, 10 ** 5):
+		src = "{" + ", ".join(f"'k{i}': a and not b{i} or c in d" for i in range(size)) + "}"
+		program = ir.Program("")
+		results[f"dict{size}.new_chars_per_sec"] = len(src) / best_of(lambda: program.transform_expr(ir.IRUnit(src)), 1, 3)
+		results[f"dict{size}.legacy_chars_per_sec"] = len(src) / best_of(lambda: legacy_transform_expr(program, src), 1, 3)
+	return results
+
+# time and peak memory of emitting the transformed large corpus, building
+# the whole output string against writing it to a file in chunks
+def bench_emit() -> dict:
+	program = ir.Program(corpus_large())
+	program.transform()
+
+	def emit_sink():
+		with open(os.devnull, "w") as sink:
+			program.transpile_to(sink)
+
+	results = {}
+	for name, emit in (('string', program.transpile), ('sink', emit_sink)):
+		results[f"{name}_ms"] = best_of(emit, 1, 3) * 1e3
+		tracemalloc.start()
+		emit()
+		results[f"{name}_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+		tracemalloc.stop()
+	return results
+
+# memory held by the IR of the large corpus in bytes per source line,
+# once parsed and once transformed, against the size of the source
+def bench_memory() -> dict:
+	src = corpus_large()
+	lines = src.count("\n") + 1
+
+	tracemalloc.start()
+	start = tracemalloc.get_traced_memory()[0]
+	program = ir.Program(src)
+	parsed = tracemalloc.get_traced_memory()[0]
+	program.transform()
+	transformed = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	node = ir.IRUnit("")
+	node_bytes = sys.getsizeof(node)
+	if hasattr(node, '__dict__'):
+		node_bytes += sys.getsizeof(node.__dict__)
+
+	return {
+		'source_bytes_per_line': len(src) / lines,
+		'parsed_bytes_per_line': (parsed - start) / lines,
+		'transformed_bytes_per_line': (transformed - start) / lines,
+		'unit_node_bytes': node_bytes,
+	}
+
+# --- corpus for the per-stage benchmarks, generated deterministically
+
+# a realistic function, touching every construct the transformer removes
+def corpus_function(index: int) -> str:
+	return (
+		f"def process{index}(items, limit):\n"
+		f"	# count and classify the items\n"
+		f"	total = 0\n"
+		f"	seen = set()\n"
+		f"	for item in items:\n"
+		f"		if item in seen and not item % 2:\n"
+		f"			continue\n"
+		f"		elif item > limit or item < 0:\n"
+		f"			break\n"
+		f"		else:\n"
+		f"			seen.add(item)\n"
+		f"		total += item\n"
+		f"	for i in range(limit):\n"
+		f"		assert i >= 0, 'negative {index}'\n"
+		f"	while total > limit:\n"
+		f"		total -= limit\n"
+		f"		if total == 1:\n"
+		f"			break\n"
+		f"	return total\n"
+	)
+
+def corpus_small() -> str:
+	return "\n".join([corpus_function(i) for i in range(3)] + ["print(process0([1, 2, 3], 10))"])
+
+# functions repeated until the file is at least `lines` long
+def corpus_large(lines: int = 100000) -> str:
+	function_lines = corpus_function(0).count("\n")
+	return "\n".join(corpus_function(i) for i in range(lines // function_lines + 1))
+
+def corpus_nested(depth: int = 5000) -> str:
+	src = []
+	for i in range(depth):
+		src.append("\t" * i + f"if x{i} and not y{i}:")
+	src.append("\t" * depth + "pass")
+	return "\n".join(src)
+
+# nested loops, each with a break
+def corpus_loops(depth: int = 2000) -> str:
+	src = []
+	for i in range(depth):
+		src.append("\t" * i + f"while x{i}:")
+		src.append("\t" * (i + 1) + f"if y{i}:")
+		src.append("\t" * (i + 2) + "break")
+	src.append("\t" * depth + "pass")
+	return "\n".join(src)
+
+def corpus_elif(branches: int = 2000) -> str:
+	src = ["if x == 0:", "\tpass"]
+	for i in range(1, branches):
+		src += [f"elif x == {i} or y in z:", f"\tprint({i})"]
+	src += ["else:", "\tpass"]
+	return "\n".join(src)
+
+def corpus_functions(count: int = 2000) -> str:
+	return "\n".join(f"def f{i}(a, b={i}):\n\treturn a and b\n" for i in range(count))
+
+# a module without any forbidden keyword, constants and plain calls
+def corpus_clean(lines: int = 100000) -> str:
+	src = []
+	for i in range(lines // 5):
+		src += [
+			f"TABLE_{i} = {{",
+			f"    'name': 'entry {i}',",
+			f"    'size': {i} * 2 + 1,",
+			"}",
+			f"register(TABLE_{i}, f'{{prefix}}_{i}')  # keep in sync",
+		]
+	return "\n".join(src) + "\n"
+
+CORPUS = {
+	'small': corpus_small,
+	'large': corpus_large,
+	'nested': corpus_nested,
+	'loops': corpus_loops,
+	'elif': corpus_elif,
+	'functions': corpus_functions,
+}
+
+# run the whole pipeline, block by block as `transform` does, returning
+# the time spent in each stage as recorded by the program
+def run_stages(src: str) -> dict:
+	program = ir.Program(src)
+	program.transform()
+	program.transpile()
+	return program.stats()['timings']
+
+# time and peak memory of every stage of the transpiler, over the corpus.
+# memory is measured in a second run, tracemalloc slows everything down.
+def bench_stages() -> dict:
+	results = {}
+	for name, corpus in CORPUS.items():
+		src = corpus()
+		lines = src.count("\n") + 1
+
+		timings = [run_stages(src) for _ in range(3)]
+		total = 0
+		for stage in timings[0]:
+			best = min(timing[stage] for timing in timings)
+			total += best
+			results[f"{name}.{stage}_ms"] = best * 1e3
+		results[f"{name}.total_ms"] = total * 1e3
+		results[f"{name}.lines"] = lines
+		results[f"{name}.lines_per_sec"] = lines / total
+
+		tracemalloc.start()
+		run_stages(src)
+		results[f"{name}.peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+		tracemalloc.stop()
+	return results
+
+# throughput of the whole pipeline with the fast path on and off, over a
+# module without forbidden keywords and over the large corpus, which has
+# them in every block and only pays for scanning them, in lines/sec
+def bench_fast_path() -> dict:
+	results = {}
+	for name, corpus in (('clean', corpus_clean), ('large', corpus_large)):
+		src = corpus()
+		lines = src.count("\n") + 1
+		for fast_path in (True, False):
+			key = 'on' if fast_path else 'off'
+			results[f"{name}.{key}_lines_per_sec"] = lines / best_of(lambda: transpile(src, fast_path=fast_path), 1, 3)
+	return results
+
+# a package of modules, each holding a few functions of the corpus,
+# transformed ahead of time with `transformed`
+def write_package(root: str, modules: int = 200, functions: int = 5, transformed: bool = False):
+	package = os.path.join(root, "benchpkg")
+	os.makedirs(package)
+	for index in range(modules):
+		src = "\n".join(corpus_function(index * functions + i) for i in range(functions))
+		with open(os.path.join(package, f"mod{index}.py"), "w") as f:
+			f.write(transpile(src) if transformed else src)
+	with open(os.path.join(package, "__init__.py"), "w") as f:
+		f.write("".join(f"from benchpkg import mod{index}\n" for index in range(modules)))
+
+# import a package in a fresh interpreter, through the import hook if
+# `hook`. returns the time from before the hook is installed, in seconds
+def time_import(root: str, hook: bool) -> float:
+	script = (
+		"import sys, time\n"
+		"start = time.perf_counter()\n"
+		f"sys.path[:0] = [{os.path.dirname(os.path.abspath(__file__))!r}, {root!r}]\n"
+		+ (f"import importhook; importhook.install([{root!r}])\n" if hook else "")
+		+ "import benchpkg\n"
+		"print(time.perf_counter() - start)\n"
+	)
+	env = dict(os.environ)
+	env.pop("PYTHONDONTWRITEBYTECODE", None)
+	output = subprocess.run([sys.executable, "-c", script], env=env, check=True, capture_output=True, text=True).stdout
+	return float(output)
+
+# remove every cached file of the package
+def clear_pycache(root: str):
+	for directory, dirs, _ in os.walk(root):
+		if "__pycache__" in dirs:
+			shutil.rmtree(os.path.join(directory, "__pycache__"))
+
+# startup time of importing a package of 200 modules through the import
+# hook, with an empty cache and a warm one, in ms. `native` imports the
+# package untransformed, `ahead` transformed in place beforehand, the
+# floor the warm import is held to
+def bench_import_hook() -> dict:
+	results = {}
+	for name, hook, transformed in (('native', False, False), ('ahead', False, True), ('hook', True, False)):
+		with tempfile.TemporaryDirectory() as root:
+			write_package(root, transformed=transformed)
+			cold = []
+			for _ in range(3):
+				clear_pycache(root)
+				cold.append(time_import(root, hook))
+			warm = [time_import(root, hook) for _ in range(5)]
+			results[f"{name}.cold_ms"] = min(cold) * 1e3
+			results[f"{name}.warm_ms"] = min(warm) * 1e3
+	return results
+
+# transforming small files one invocation at a time, as a build system
+# does, with `transformer.py` and with the client of a running server,
+# in ms per file. `batch` sends every file in one client invocation,
+# `p50` and `p99` are the latencies the server reports
+def bench_server(files: int = 50) -> dict:
+	here = os.path.dirname(os.path.abspath(__file__))
+	results = {}
+	with tempfile.TemporaryDirectory() as root:
+		paths = []
+		for index in range(files):
+			paths.append(os.path.join(root, f"mod{index}.py"))
+			with open(paths[-1], "w") as f:
+				f.write(corpus_function(index))
+		sock_path = os.path.join(root, "server.sock")
+
+		env = dict(os.environ)
+		env.pop("PYTHONDONTWRITEBYTECODE", None)
+		def run(args: List[str]) -> float:
+			start = time.perf_counter()
+			subprocess.run([sys.executable] + args, env=env, check=True)
+			return time.perf_counter() - start
+
+		results['transformer_ms'] = sum(run([os.path.join(here, "transformer.py"), path]) for path in paths) / files * 1e3
+
+		process = subprocess.Popen([sys.executable, os.path.join(here, "server.py"), "--socket", sock_path, "-j", "2"], stderr=subprocess.DEVNULL)
+		try:
+			while not os.path.exists(sock_path):
+				time.sleep(0.01)
+			client = [os.path.join(here, "client.py"), "--socket", sock_path]
+			results['client_ms'] = sum(run(client + [path]) for path in paths) / files * 1e3
+			results['batch_ms'] = run(client + paths) / files * 1e3
+			stats = json.loads(subprocess.run([sys.executable] + client + ["--stats"], check=True, capture_output=True, text=True).stdout)
+			results['p50_ms'] = stats['p50_ms']
+			results['p99_ms'] = stats['p99_ms']
+		finally:
+			subprocess.run([sys.executable] + client + ["--shutdown"], capture_output=True)
+			process.wait()
+	return results
+
+# throughput of a single large file transformed whole, and block by block
+# in a pool of workers, in lines/sec. the workers are started for every
+# run, their start up is paid for.
+def bench_parallel() -> dict:
+	src = corpus_large()
+	lines = src.count("\n") + 1
+	results = {'serial_lines_per_sec': lines / best_of(lambda: transformer.transform_source(src), 1, 3)}
+	for jobs in (1, 2, 4):
+		results[f"j{jobs}_lines_per_sec"] = lines / best_of(lambda: transformer.transform_source_parallel(src, jobs), 1, 3)
+	results['cpus'] = os.cpu_count()
+	return results
+
+# re-transforming a large file with one function changed, whole and with
+# the blocks of the previous run, in ms. `changed_lines` counts the lines
+# of output not found anywhere in the previous output.
+def bench_incremental() -> dict:
+	src = corpus_large()
+	_, _, blocks, _ = incremental.transform_incremental(src, {})
+	old_src = transformer.transform_source(src)
+	changed = src.replace("def process500(items, limit):\n\t# count", "def process500(items, limit):\n\tlimit += 1\n\t# count")
+	new_src = transformer.transform_source(changed)
+	old_lines = set(old_src.split("\n"))
+	return {
+		'full_ms': best_of(lambda: transformer.transform_source(changed), 1, 3) * 1e3,
+		'incremental_ms': best_of(lambda: incremental.transform_incremental(changed, blocks), 1, 3) * 1e3,
+		'changed_lines': sum(line not in old_lines for line in new_src.split("\n")),
+	}
+
+BENCHMARKS = {
+	'in': bench_in,
+	'bool': bench_bool,
+	'calls': bench_calls,
+	'for': bench_for,
+	'keywords': bench_keywords,
+	'peephole': bench_peephole,
+	'short_circuit': bench_short_circuit,
+	'lex': bench_lex,
+	'rewrite': bench_rewrite,
+	'emit': bench_emit,
+	'memory': bench_memory,
+	'stages': bench_stages,
+	'fast_path': bench_fast_path,
+	'import_hook': bench_import_hook,
+	'server': bench_server,
+	'parallel': bench_parallel,
+	'incremental': bench_incremental,
+}
+
+# print the ratio of every result in `new` against `old`
+def compare(old_path: str, new_path: str):
+	with open(old_path, "r") as f:
+		old = json.load(f)['results']
+	with open(new_path, "r") as f:
+		new = json.load(f)['results']
+
+	for key, value in new.items():
+		if key in old and old[key] != 0:
+			print(f"{key}: {old[key]:.2f} -> {value:.2f} ({value / old[key]:.2f}x)")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("names", nargs="*", help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+	parser.add_argument("--json", help="write the results to a JSON file")
+	parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON result files")
+	args = parser.parse_args()
+
+	if args.compare:
+		compare(*args.compare)
+		return
+
+	for name in args.names:
+		if name not in BENCHMARKS:
+			parser.error(f"unknown benchmark: {name}")
+
+	results = {}
+	for name in args.names or list(BENCHMARKS):
+		for key, value in BENCHMARKS[name]().items():
+			print(f"{name}.{key}: {value:.2f}")
+			results[f"{name}.{key}"] = value
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({
+				'python': platform.python_version(),
+				'time': time.time(),
+				'results': results,
+			}, f, indent=1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from typing import *
+
+# a persistent, content addressed cache of transformed sources.
+#
+# entries are keyed by a hash of the source, the version of the
+# transformer and the options passed to `Program`. each entry is a file
+# holding the transformed source, its modification time is bumped on
+# every hit so the least recently used entries are evicted first.
+#
+# /--
+# |- <path>/ab/ab12...ef
+#
+
+# the transformer, hashed without importing it
+IR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ir.py")
+
+_version = None
+
+# the version of the transformer, a hash of `ir.py` itself.
+# any change to the transformer invalidates every entry.
+def transformer_version() -> str:
+	global _version
+	if _version is None:
+		with open(IR_PATH, "rb") as f:
+			_version = hashlib.sha256(f.read()).hexdigest()
+	return _version
+
+class TransformCache:
+	def __init__(self, path: str, max_bytes: int = 256 * 2 ** 20):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+
+	# the key of a source transformed with the given options
+	def key(self, src: str, options: dict) -> str:
+		h = hashlib.sha256()
+		h.update(transformer_version().encode())
+		h.update(json.dumps(options, sort_keys=True).encode())
+		h.update(src.encode())
+		return h.hexdigest()
+
+	def entry_path(self, key: str) -> str:
+		return os.path.join(self.path, key[:2], key)
+
+	# return the cached output for a key, or None on a miss
+	def get(self, key: str) -> str | None:
+		path = self.entry_path(key)
+		try:
+			with open(path, "r") as f:
+				output = f.read()
+			os.utime(path)
+		except FileNotFoundError:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return output
+
+	# store the output for a key, written to a temporary file first so
+	# concurrent readers never observe a partial entry
+	def put(self, key: str, output: str):
+		path = self.entry_path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+		with os.fdopen(fd, "w") as f:
+			f.write(output)
+		os.replace(tmp_path, path)
+
+	# list every entry as (mtime, size, path)
+	def entries(self) -> List[Tuple[float, int, str]]:
+		entries = []
+		if not os.path.isdir(self.path):
+			return entries
+
+		for prefix in os.listdir(self.path):
+			prefix_path = os.path.join(self.path, prefix)
+			if not os.path.isdir(prefix_path):
+				continue
+			for name in os.listdir(prefix_path):
+				if name.startswith(".tmp"):
+					continue
+				try:
+					stat = os.stat(os.path.join(prefix_path, name))
+				except FileNotFoundError:
+					continue # evicted by someone else
+				entries.append((stat.st_mtime, stat.st_size, os.path.join(prefix_path, name)))
+
+		return entries
+
+	# evict the least recently used entries until under `max_bytes`
+	def prune(self) -> int:
+		entries = sorted(self.entries())
+		total = sum(size for _, size, _ in entries)
+		evicted = 0
+
+		for _, size, path in entries:
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+			evicted += 1
+
+		return evicted
+
+	# remove every entry
+	def clear(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def stats(self) -> dict:
+		entries = self.entries()
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'entries': len(entries),
+			'bytes': sum(size for _, size, _ in entries),
+		}
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import socket
+
+# a thin client of the transform server, see `server.py`. it never
+# imports the transformer, or anything it doesn't need to start up fast.
+#
+# python3 client.py [--socket PATH] [--keywords PATH] <paths...>
+#
+#         transform files in place through the server, one request per
+#         file, all of them sent at once
+#
+# python3 client.py [--socket PATH] --stats
+# python3 client.py [--socket PATH] --shutdown
+
+# the socket of the server unless given, one per user
+DEFAULT_SOCKET = os.path.join(os.environ.get("TMPDIR", "/tmp"), f"logical-transformer-{os.getuid()}.sock")
+
+# send requests over a connection to the server, returning the responses
+# in the order of the requests. requests are numbered by their index.
+def request(path: str, requests: list[dict]) -> list[dict]:
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.connect(path)
+		sock.sendall("".join(json.dumps({**req, 'id': index}) + "\n" for index, req in enumerate(requests)).encode())
+		sock.shutdown(socket.SHUT_WR)
+
+		responses = [None] * len(requests)
+		with sock.makefile("r") as f:
+			for line in f:
+				response = json.loads(line)
+				responses[response['id']] = response
+		return responses
+
+def usage():
+	print("usage: python3 client.py [--socket PATH] [--keywords PATH] (<paths...> | --stats | --shutdown)", file=sys.stderr)
+	sys.exit(2)
+
+# parsed by hand, argparse takes as long to import as the rest
+def main():
+	args = sys.argv[1:]
+	sock_path = DEFAULT_SOCKET
+	keywords = None
+	op = None
+	paths = []
+
+	while args:
+		arg = args.pop(0)
+		match arg:
+			case "--socket" | "--keywords":
+				if not args:
+					usage()
+				value = args.pop(0)
+				if arg == "--socket":
+					sock_path = value
+				else:
+					with open(value, "r") as f:
+						keywords = sorted(set(f.read().replace(",", " ").split()))
+			case "--stats" | "--shutdown":
+				op = arg[2:]
+			case "-h" | "--help":
+				usage()
+			case path:
+				paths.append(path)
+
+	if (op is None) == (len(paths) == 0):
+		usage()
+
+	if op is not None:
+		response, = request(sock_path, [{'op': op}])
+		print(json.dumps(response, indent=2))
+		return
+
+	extra = {} if keywords is None else {'keywords': keywords}
+	failures = 0
+	# the server runs in a directory of its own
+	responses = request(sock_path, [{'path': os.path.abspath(path), **extra} for path in paths])
+	for path, response in zip(paths, responses):
+		if response['error'] is not None:
+			print(f"{path}: {response['error']}", file=sys.stderr)
+			failures += 1
+	sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,203 @@
+import os
+import sys
+import marshal
+import hashlib
+import argparse
+import importlib.util
+import importlib.machinery
+from typing import *
+import cache
+from cache import transformer_version, IR_PATH
+
+# transform modules as they're imported, never touching their source.
+#
+# the bytecode of every transformed module is cached next to it, keyed
+# by a hash of the source, the version of the transformer and the
+# options passed to `Program`. a warm import only reads the cache, it
+# never parses or transforms. stale entries of a module are removed once
+# it's cached again.
+#
+# /--
+# |- <dir>/<name>.py
+# |- <dir>/__pycache__/<name>.<cache_tag>.lt-<key>.pyc
+#
+# only modules under the given roots are transformed, everything else is
+# left to the import system.
+#
+#     import importhook
+#     importhook.install(["src"], keywords=["and", "or"])
+#     import mypackage
+#
+# a warm import never loads the transformer itself, it's imported on the
+# first module missing from the cache.
+#
+# python3 importhook.py [--root DIR] [--keywords PATH] <script.py> [args...]
+#
+#         run a script transformed, along with every module it imports
+#         from under the roots, its own directory by default
+
+# the tag of cached bytecode, after the name of the module
+CACHE_TAG = "lt"
+# the length of the key in the name of a cached file
+KEY_LENGTH = 16
+# the modules of the transformer itself, loaded by the loader. they're
+# never transformed, even from under a root.
+TRANSFORMER_PATHS = frozenset(os.path.abspath(path) for path in (IR_PATH, cache.__file__))
+
+# the path of the cached bytecode of a source file, for a key
+def cache_path(path: str, key: str) -> str:
+	directory, name = os.path.split(path)
+	stem = os.path.splitext(name)[0]
+	return os.path.join(directory, "__pycache__", f"{stem}.{sys.implementation.cache_tag}.{CACHE_TAG}-{key}.pyc")
+
+# the key of a source transformed with the given options
+def source_key(data: bytes, options: dict) -> str:
+	h = hashlib.sha256()
+	h.update(transformer_version().encode())
+	h.update(repr(sorted(options.items())).encode())
+	h.update(data)
+	return h.hexdigest()[:KEY_LENGTH]
+
+# read cached bytecode, None if missing or written by another Python
+def read_code(path: str) -> Any | None:
+	try:
+		with open(path, "rb") as f:
+			data = f.read()
+	except OSError:
+		return None
+	magic = importlib.util.MAGIC_NUMBER
+	if not data.startswith(magic):
+		return None
+	try:
+		return marshal.loads(data[len(magic):])
+	except (EOFError, ValueError, TypeError):
+		return None
+
+# write bytecode to the cache through a temporary file unique to the
+# process, so concurrent imports never read a partial entry. entries of
+# the module under an older key are removed. failing to write is never
+# an error.
+def write_code(path: str, code):
+	directory, name = os.path.split(path)
+	prefix = name[:len(name) - len(".pyc") - KEY_LENGTH]
+	tmp_path = f"{path}.{os.getpid()}.tmp"
+	try:
+		os.makedirs(directory, exist_ok=True)
+		with open(tmp_path, "wb") as f:
+			f.write(importlib.util.MAGIC_NUMBER)
+			f.write(marshal.dumps(code))
+		os.replace(tmp_path, path)
+	except OSError:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		return
+
+	try:
+		for stale in os.listdir(directory):
+			if stale.startswith(prefix) and stale != name and stale.endswith(".pyc"):
+				os.remove(os.path.join(directory, stale))
+	except OSError:
+		pass
+
+# loads a source file transformed, from the cache if possible
+class TransformLoader(importlib.machinery.SourceFileLoader):
+	def __init__(self, fullname: str, path: str, finder: 'TransformFinder'):
+		super().__init__(fullname, path)
+		self.finder = finder
+
+	def get_code(self, fullname: str):
+		path = self.get_filename(fullname)
+		data = self.get_data(path)
+		key = source_key(data, self.finder.options)
+		code_path = cache_path(path, key)
+
+		code = read_code(code_path)
+		if code is not None:
+			self.finder.hits += 1
+			return code
+		self.finder.misses += 1
+
+		from ir import Program
+		program = Program(importlib.util.decode_source(data), **self.finder.options)
+		program.transform()
+		code = self.source_to_code(program.transpile(), path)
+		if not sys.dont_write_bytecode:
+			write_code(code_path, code)
+		return code
+
+# finds the source files under the roots, loading them transformed
+class TransformFinder:
+	def __init__(self, roots: List[str], **options):
+		self.roots = [os.path.join(os.path.abspath(root), "") for root in roots]
+		self.options = options
+		self.hits = 0
+		self.misses = 0
+
+	# modules it doesn't claim are left to the finders after it, builtin
+	# and frozen modules are found before the path
+	def find_spec(self, fullname: str, path=None, target=None):
+		spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
+		if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+			return None
+		origin = os.path.abspath(spec.origin)
+		if origin in TRANSFORMER_PATHS or not any(origin.startswith(root) for root in self.roots):
+			return None
+		spec.loader = TransformLoader(fullname, spec.origin, self)
+		return spec
+
+	def invalidate_caches(self):
+		importlib.machinery.PathFinder.invalidate_caches()
+
+	def stats(self) -> dict:
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+		}
+
+# install a finder transforming modules under the roots, before every
+# other finder. options are passed to `Program`.
+def install(roots: List[str], **options) -> TransformFinder:
+	finder = TransformFinder(roots, **options)
+	sys.meta_path.insert(0, finder)
+	return finder
+
+def uninstall(finder: TransformFinder):
+	if finder in sys.meta_path:
+		sys.meta_path.remove(finder)
+
+# run a script transformed as `__main__`
+def run_script(path: str, finder: TransformFinder):
+	loader = TransformLoader("__main__", path, finder)
+	spec = importlib.util.spec_from_file_location("__main__", path, loader=loader)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules["__main__"] = module
+	loader.exec_module(module)
+
+def main():
+	parser = argparse.ArgumentParser(description="run a script, transforming it and its modules as they're imported")
+	parser.add_argument("--root", action="append", help="directory of modules to transform, the script's directory by default")
+	parser.add_argument("--keywords", metavar="PATH", help="file of the forbidden keywords, all of them by default")
+	parser.add_argument("script")
+	parser.add_argument("args", nargs=argparse.REMAINDER)
+	args = parser.parse_args()
+
+	options = {}
+	if args.keywords is not None:
+		from ir import KEYWORDS
+		from transformer import read_keywords
+		keywords = read_keywords(args.keywords)
+		unknown = [word for word in keywords if word not in KEYWORDS]
+		if unknown:
+			parser.error(f"can't remove {', '.join(unknown)}, only {', '.join(KEYWORDS)}")
+		options['keywords'] = keywords
+
+	script_dir = os.path.dirname(os.path.abspath(args.script))
+	sys.argv = [args.script] + args.args
+	sys.path.insert(0, script_dir)
+	finder = install(args.root or [script_dir], **options)
+	run_script(args.script, finder)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+import tempfile
+from typing import *
+from ir import Program, iter_top_level_blocks, transform_blocks
+from cache import transformer_version
+
+# re-transform a file, only transforming the top level blocks that changed
+# since the previous run.
+#
+# the state of a run is kept in a JSON file, the transformed lines of
+# every top level block keyed by its fingerprint, a hash of its lines and
+# the counters of temporary variables it starts with. see
+# `Program.begin_block`, a block transformed on its own has the same
+# output as within the whole file. blocks found in the state are spliced
+# in as they are, the output is the same as transforming the whole file.
+#
+# {
+#   "version": 1,
+#   "transformer": "<hash of ir.py>",
+#   "options": "{...}",
+#   "blocks": {"<fingerprint>": {"lines": [...], "state": {...}}, ...}
+# }
+#
+# blocks are only kept while they're in the file. a state written by
+# another version of the transformer or with other options is ignored.
+
+STATE_VERSION = 1
+
+# the fingerprint of a top level block, starting with the given counters
+def block_key(lines: List[str], temps: Dict[str, int]) -> str:
+	h = hashlib.sha256()
+	h.update(json.dumps(temps, sort_keys=True).encode())
+	h.update("\n".join(lines).encode())
+	return h.hexdigest()
+
+# the blocks of a state file written with the same transformer and
+# options, empty if missing or unreadable
+def read_state(path: str, options: dict) -> Dict[str, dict]:
+	try:
+		with open(path, "r") as f:
+			state = json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+	if not isinstance(state, dict):
+		return {}
+	if state.get('version') != STATE_VERSION or state.get('transformer') != transformer_version():
+		return {}
+	if state.get('options') != json.dumps(options, sort_keys=True):
+		return {}
+	return state.get('blocks', {})
+
+# write a state file through a temporary file next to it, a run that
+# dies never leaves a partial state behind
+def write_state(path: str, blocks: Dict[str, dict], options: dict):
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".state")
+	try:
+		with os.fdopen(fd, "w") as f:
+			json.dump({
+				'version': STATE_VERSION,
+				'transformer': transformer_version(),
+				'options': json.dumps(options, sort_keys=True),
+				'blocks': blocks,
+			}, f)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+# transform a Python source string, reusing the blocks of a previous run.
+#
+# returns the new source, the program holding the helpers and statistics
+# of every block, the blocks of the new state and the amount of blocks
+# reused. timings only count the blocks transformed.
+def transform_incremental(src: str, blocks: Dict[str, dict], **options) -> Tuple[str, Program, Dict[str, dict], int]:
+	program = Program("", **options)
+	new_blocks = {}
+	lines = []
+	reused = 0
+	line_offset = 0
+
+	for block in iter_top_level_blocks(src.split("\n")):
+		temps = program.begin_block(block)
+		key = block_key(block, temps)
+		entry = new_blocks.get(key) or blocks.get(key)
+		if entry is None:
+			block_lines, state = transform_blocks([(line_offset, block, temps)], **options)
+			entry = {'lines': block_lines, 'state': state}
+			program.merge(state)
+		else:
+			reused += 1
+			program.merge({**entry['state'], 'timings': {}})
+		new_blocks[key] = entry
+		lines += entry['lines']
+		line_offset += len(block)
+
+	prelude = program.transpile_prelude()
+	program.input_lines = src.count("\n") + (src.rpartition("\n")[2] != "")
+	program.output_lines = prelude.count("\n") + len(lines)
+	return prelude + "\n".join(lines), program, new_blocks, reused
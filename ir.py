@@ -1,12 +1,24 @@
 from typing import *
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import keyword
+import time
 import re
 
 # l-m> i am very against egregious code comments, or commenting code in general.
 #      i have very specific opinions on such, alas i'll have to drop my ideals
 #      to secure a mark. enjoy the useless comments.
 
+# facts about the body of a loop or function, computed in a single walk
+# of the IR by `Program.annotate` before transforming it.
+#
+# has_break: the loop contains a `break` ending it
+# has_return: the function contains a `return`
+#
+@dataclass(slots=True)
+class IRFacts:
+	has_break: bool = False
+	has_return: bool = False
+
 # represents an indented block
 # 
 # /--
@@ -15,11 +27,12 @@ import re
 # |
 # |- IRIndent("try", IRUnit(""), [IRUnit("pass")])
 #
-@dataclass
+@dataclass(slots=True)
 class IRIndent:
 	token: str
 	expr: 'IRNode'
 	body: List['IrNode']
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a function definition
 #
@@ -29,11 +42,13 @@ class IRIndent:
 # |
 # |- IRFn("func", "test", [IRUnit("pass")])
 #
-@dataclass
+@dataclass(slots=True)
 class IRFn:
 	name: str
 	params: str
 	body: List['IrNode']
+	facts: IRFacts | None = field(default=None, repr=False, compare=False)
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a single line of code or expression
 #
@@ -42,9 +57,10 @@ class IRFn:
 # |
 # |- IRUnit("print('hello')")
 #
-@dataclass
+@dataclass(slots=True)
 class IRUnit:
 	src: str
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a statment with optional expression
 #
@@ -53,10 +69,11 @@ class IRUnit:
 # |-
 # |- IRUnitStmt("yield", IRUnit("expr"))
 #
-@dataclass
+@dataclass(slots=True)
 class IRUnitStmt:
 	token: str
 	expr: 'IRNode'
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a for loop
 #
@@ -66,11 +83,13 @@ class IRUnitStmt:
 # |
 # |- IRFor(IRUnit("i"), IRUnit("range(10)"), [IRUnit("pass")])
 #
-@dataclass
+@dataclass(slots=True)
 class IRFor:
 	lhs: 'IRNode'
 	rhs: 'IRNode'
 	body: List['IrNode']
+	facts: IRFacts | None = field(default=None, repr=False, compare=False)
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a while loop
 #
@@ -80,22 +99,25 @@ class IRFor:
 # |
 # |- IRWhile(IRUnit("True"), [IRUnit("pass")])
 #
-@dataclass
+@dataclass(slots=True)
 class IRWhile:
 	cond: 'IRNode'
 	body: List['IrNode']
+	facts: IRFacts | None = field(default=None, repr=False, compare=False)
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a break statement
 #
-@dataclass
+@dataclass(slots=True)
 class IRBreak:
-	pass
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a return statement
 #
-@dataclass
+@dataclass(slots=True)
 class IRReturn:
 	expr: 'IRNode'
+	line: int = field(default=0, repr=False, compare=False)
 
 # all below represent the various if/elif/else statements
 #
@@ -113,19 +135,22 @@ class IRReturn:
 # |-     IRElse([IRUnit("pass")]),
 # |- ]
 #
-@dataclass
+@dataclass(slots=True)
 class IRIf:
 	cond: 'IRNode'
 	body: List['IrNode']
+	line: int = field(default=0, repr=False, compare=False)
 
-@dataclass
+@dataclass(slots=True)
 class IRElif:
 	cond: 'IRNode'
 	body: List['IrNode']
+	line: int = field(default=0, repr=False, compare=False)
 
-@dataclass
+@dataclass(slots=True)
 class IRElse:
 	body: List['IrNode']
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents an assert statement
 #
@@ -134,12 +159,32 @@ class IRElse:
 # |
 # |- IRAssert([IRUnit("True"), IRUnit("'hello'")])
 #
-@dataclass
+@dataclass(slots=True)
 class IRAssert:
 	exprs: List['IrNode']
+	line: int = field(default=0, repr=False, compare=False)
+
+# represents top level lines copied as is, without any forbidden keyword
+# in their code. they're never parsed or transformed.
+#
+# /--
+# |- x = {
+# |-   'a': 1,
+# |- }
+# |
+# |- IRVerbatim(["x = {", "  'a': 1,", "}"])
+#
+@dataclass(slots=True)
+class IRVerbatim:
+	lines: List[str]
+	line: int = field(default=0, repr=False, compare=False)
 
 # represents a single node in the IR, these are matched by the transformer
-IRNode = IRUnit | IRUnitStmt | IRIf | IRElif | IRElse | IRIndent | IRAssert | IRWhile | IRFor | IRBreak | IRReturn | IRFn
+#
+# every node holds `line`, the line of the source it was parsed from,
+# starting at 1. nodes created by a transformation hold the line of the
+# statement they replaced, see `stamp_lines`. expressions hold 0.
+IRNode = IRUnit | IRUnitStmt | IRIf | IRElif | IRElse | IRIndent | IRAssert | IRWhile | IRFor | IRBreak | IRReturn | IRFn | IRVerbatim
 
 def tokenise_first(line: str) -> str:
 	# will strip the end, taking the start
@@ -159,42 +204,116 @@ def iter_skip(v: Iterator[Any], amount: int):
 		next(v)
 		amount -= 1
 
-def iter_to_identifers(src: str):
+# the lexer splits a line into code, and strings or comments, in one pass
+# of a compiled regular expression. code is everything in between.
+#
+# strings skip over escapes, a string never closed runs until the end of
+# its line. every alternative starts with a literal character, letting the
+# regex engine skip over code without trying each alternative.
+LEX_RE = re.compile(
+	r"#[^\n]*|"
+	r"'''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''|"
+	r'"""[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""|'
+	r"'[^'\\\n]*(?:\\.[^'\\\n]*)*'|"
+	r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"|'
+	r"'[^\n]*|\"[^\n]*",
+	re.S,
+)
+LEX_PREFIX_CHARS = "rRbBuUfF"
+# inside a replacement field, strings are skipped over and brackets counted.
+# the expression ends at a `!` conversion, `:` format spec or the closing `}`
+LEX_FIELD_RE = re.compile(r"""'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*"|!=|[][(){}:!]""")
+
+def iter_to_identifers(src: str, pos: int = 0, endpos: int | None = None):
 	# return iterator, yielding (bool, int, int)
 	# bool: valid/invalid
 	# int, int: start/end
+	#
+	# spans are never empty, and only `src[pos:endpos]` is lexed.
 
-	start = 0
-	i = 0
-	strch = None
+	if endpos is None:
+		endpos = len(src)
+	start = pos
+
+	for m in LEX_RE.finditer(src, pos, endpos):
+		string_start, end = m.span()
+		fstring = False
+
+		# take up to two prefix characters, which aren't part of a name
+		if string_start > start and src[string_start] != '#' and src[string_start - 1] in LEX_PREFIX_CHARS:
+			prefix_start = string_start - 1
+			if prefix_start > start and src[prefix_start - 1] in LEX_PREFIX_CHARS:
+				prefix_start -= 1
+			if prefix_start == 0 or not (src[prefix_start - 1].isalnum() or src[prefix_start - 1] == '_'):
+				prefix = src[prefix_start:string_start]
+				fstring = 'f' in prefix or 'F' in prefix
+				string_start = prefix_start
+
+		if string_start > start:
+			yield (True, start, string_start) # valid searchable text
+
+		if fstring:
+			quote = 3 if src.startswith(("'''", '"""'), m.start()) else 1
+			yield from iter_fstring_fields(src, string_start, m.start() + quote, end)
+		else:
+			yield (False, string_start, end) # invalid searchable text
+		start = end
+
+	if start < endpos:
+		yield (True, start, endpos) # valid searchable text
+
+def iter_fstring_fields(src: str, start: int, pos: int, end: int):
+	# yield the spans of an f-string in `src[start:end]`, its contents
+	# starting from `pos`. the expressions of replacement fields are
+	# lexed as code, everything else is invalid. replacement fields
+	# nested inside a format spec are kept as part of the string.
 
 	while True:
-		if i >= len(src):
-			yield (True, start, len(src)) # valid searchable text
+		pos = src.find('{', pos, end)
+		if pos == -1:
+			yield (False, start, end) # invalid searchable text
 			return
-		
-		ch = src[i]
-		
-		if ch.isspace():
-			pass	
-		elif strch is None:
-			if ch == "'" or ch == '"':
-				strch = ch
-				yield (True, start, i) # valid searchable text
-				start = i
-			elif ch == "#":
-				if src[start:i] != '':
-					yield (True, start, i) # valid searchable text
-				yield (False, i, len(src)) # invalid searchable text
-				return
+
+		# `{{` is an escape
+		if src.startswith('{', pos + 1, end):
+			pos += 2
+			continue
+		pos += 1
+
+		# find the end of the expression
+		depth = 0
+		for field in LEX_FIELD_RE.finditer(src, pos, end):
+			token = field.group(0)
+			if token in "([{":
+				depth += 1
+			elif depth > 0:
+				if token in ")]}":
+					depth -= 1
+			elif token in "}:!":
+				break
 		else:
-			if ch == "\\":
-				i += 1
-			elif ch == strch:
-				strch = None
-				yield (False, start, i + 1) # invalid searchable text
-				start = i + 1		
-		i += 1
+			# malformed, the field is never closed
+			yield (False, start, end) # invalid searchable text
+			return
+
+		yield (False, start, pos) # invalid searchable text
+		yield from iter_to_identifers(src, pos, field.start())
+		start = field.start()
+
+		# skip past the conversion and format spec
+		if token != '}':
+			for field in LEX_FIELD_RE.finditer(src, field.end(), end):
+				token = field.group(0)
+				if token == '{':
+					depth += 1
+				elif token == '}':
+					if depth == 0:
+						break
+					depth -= 1
+		pos = field.end()
+
+# the brackets and commas of code, see `walk_expr_str`
+BRACKET_RE = re.compile(r'[][(){},]')
 
 def walk_expr_str(src: str) -> int | None:
 	# walk till `,` or EOL
@@ -209,16 +328,316 @@ def walk_expr_str(src: str) -> int | None:
 		if not valid:
 			continue
 
-		while start < end:
-			ch = src[start]
-			if ch == "(":
+		for m in BRACKET_RE.finditer(src, start, end):
+			ch = m.group(0)
+			if ch in "([{":
 				parens += 1
-			elif ch == ")":
+			elif ch in ")]}":
 				parens -= 1
-			start += 1
+			elif parens == 0:
+				return m.end()
+
+# the brackets left open at the end of a line, negative when it closes more
+# than it opens. a statement split across lines is left open on every
+# line but its last.
+#
+# assert bracket_depth("raise E('a', (") == 2
+def bracket_depth(src: str) -> int:
+	depth = 0
+	for valid, start, end in iter_to_identifers(src):
+		if not valid:
+			continue
+		for m in BRACKET_RE.finditer(src, start, end):
+			ch = m.group(0)
+			if ch in "([{":
+				depth += 1
+			elif ch in ")]}":
+				depth -= 1
+	return depth
+
+# split a string on every `,` outside of parens and strings
+#
+# assert split_expr_strs("a, f(b, c), 'd, e'") == ["a", "f(b, c)", "'d, e'"]
+def split_expr_strs(src: str) -> List[str]:
+	exprs = []
+	while True:
+		pos = walk_expr_str(src)
+		if pos is None:
+			exprs.append(src.strip())
+			return exprs
+		exprs.append(src[:pos - 1].strip())
+		src = src[pos:]
+
+# tokens looked at when lowering `and` and `or` lazily. comparisons are
+# matched whole, they're never mistaken for an assignment.
+SC_TOKEN_RE = re.compile(r'==|!=|<=|>=|:=|->|\*\*=|//=|>>=|<<=|[-+*/%&|^@]=|[][(){},:=;]|[A-Za-z_]\w*')
+# keywords ending an operand of `and` and `or`, all but the operators
+SC_BOUNDARY_WORDS = frozenset(keyword.kwlist) - {'and', 'or', 'not', 'in', 'is', 'True', 'False', 'None', 'await'}
+# operands evaluated eagerly, a name or a number. they have no side
+# effects unless looked up through a module `__getattr__`, but a name may
+# be unbound: `a or b` raises NameError when `b` is, even if `a` is true.
+# that's traded for not calling a lambda on every plain name.
+SC_SIMPLE_RE = re.compile(r'(?:not\s+)*(?:[A-Za-z_]\w*|\d[\w.]*)')
+# operands that can't be moved into a lambda, the lambda would become
+# their scope. zero argument `super()`, `locals()` and `vars()` look at it
+SC_EAGER_RE = re.compile(r'\b(?:yield|await)\b|:=|\b(?:super|locals|vars)\s*\(\s*\)')
+SC_BOOL_RE = re.compile(r'\b(?:and|or)\b')
+
+# the tokens of the code of an expression as (start, end, text), and where
+# its trailing comment starts. None if a replacement field of an f-string
+# holds an `and` or `or`
+def sc_tokens(src: str) -> Tuple[List[Tuple[int, int, str]], int] | None:
+	tokens = []
+	code = False
+	for valid, start, end in iter_to_identifers(src):
+		if not valid and src[start] == '#':
+			return (tokens, start)
+		if valid and not code and start > 0 and src[start - 1] == '{':
+			# a replacement field, part of its string
+			if SC_BOOL_RE.search(src, start, end):
+				return None
+		elif valid:
+			tokens += [(m.start(), m.end(), m.group(0)) for m in SC_TOKEN_RE.finditer(src, start, end)]
+		code = valid
+	return (tokens, len(src))
+
+# check if a token ends an operand of `and` and `or`
+def sc_boundary(text: str, after_for: bool) -> bool:
+	if text in (',', ':', '=', ';') or text in SC_BOUNDARY_WORDS:
+		return True
+	if text == 'in':
+		return after_for
+	return text.endswith('=') and text not in ('==', '!=', '<=', '>=')
+
+# rewrite `and` and `or` lazily in the code of an expression, see `lazy_bool_ops`.
+#
+# the operators are only looked at between brackets, commas, assignments
+# and keywords. a `for` turns the next `in` into a boundary.
+#
+# /--
+# |- f(a, b and g(c), d)
+# |-   ^  ^^^^^^^^^^  ^  <- regions, lowered on their own
+#
+def lazy_bool_level(src: str, tokens: List[Tuple[int, int, str]], i: int, pos: int, ops: Container[str], eager: bool, used: Set[str]) -> Tuple[List[str], int, int]:
+	out = []
+	raw = []
+	operands = [[]]
+	kinds = []
+	after_for = False
+
+	def end_region():
+		out.append(lazy_bool_region(raw, operands, kinds, ops, eager, used))
+		raw.clear()
+		operands[:] = [[]]
+		kinds.clear()
+
+	while i < len(tokens):
+		start, end, text = tokens[i]
+		if text in ")]}":
+			break
+		piece = src[pos:start]
+		raw.append(piece)
+		operands[-1].append(piece)
+		pos = start
+		i += 1
+
+		if text in "([{":
+			inner, i, pos = lazy_bool_level(src, tokens, i, end, ops, eager, used)
+			piece = text + "".join(inner)
+			if i < len(tokens):
+				# the closing bracket
+				piece += src[pos:tokens[i][1]]
+				pos = tokens[i][1]
+				i += 1
+			raw.append(piece)
+			operands[-1].append(piece)
+		elif text in ('and', 'or'):
+			raw.append(text)
+			kinds.append(text)
+			operands.append([])
+			pos = end
+		elif sc_boundary(text, after_for):
+			after_for = text == 'for'
+			end_region()
+			out.append(text)
+			pos = end
+
+	end_pos = tokens[i][0] if i < len(tokens) else len(src)
+	raw.append(src[pos:end_pos])
+	operands[-1].append(src[pos:end_pos])
+	end_region()
+	return (out, i, end_pos)
+
+# lower the operators of a region between boundaries, `or` binding loosest.
+# a region is kept as written unless an operand is deferred, or if an
+# operand is missing.
+def lazy_bool_region(raw: List[str], operands: List[List[str]], kinds: List[str], ops: Container[str], eager: bool, used: Set[str]) -> str:
+	if not kinds:
+		return "".join(raw)
+
+	texts = ["".join(operand) for operand in operands]
+	parts = [text.strip() for text in texts]
+	# an operand on another line, the region is split across lines
+	if not all(parts):
+		return "".join(raw)
+	# `*` and `**` unpack the whole region, `*a and b` is `*(a and b)`
+	if parts[0].startswith("*"):
+		return "".join(raw)
+	deferred = False
+
+	def lower(lhs: str, rhs: str, op: str) -> str:
+		nonlocal deferred
+		if op in ops and not eager and not SC_SIMPLE_RE.fullmatch(rhs) and not SC_EAGER_RE.search(rhs):
+			deferred = True
+			used.add(op)
+			return f"_{op}sc({lhs}, lambda _sc: {rhs})"
+		return f"{lhs} {op} {rhs}"
+
+	groups = [[parts[0]]]
+	for kind, part in zip(kinds, parts[1:]):
+		if kind == 'or':
+			groups.append([part])
+		else:
+			groups[-1].append(part)
+
+	chains = []
+	for group in groups:
+		chain = group[0]
+		for part in group[1:]:
+			chain = lower(chain, part, 'and')
+		chains.append(chain)
+	result = chains[0]
+	for chain in chains[1:]:
+		result = lower(result, chain, 'or')
+
+	if not deferred:
+		return "".join(raw)
+	lead = texts[0][:len(texts[0]) - len(texts[0].lstrip())]
+	trail = texts[-1][len(texts[-1].rstrip()):]
+	return lead + result + trail
+
+# lower the `and` and `or` operators in `ops` of an expression into calls,
+# keeping the right operand from being evaluated unless needed. returns
+# the expression, and the operators lowered.
+#
+# right operands that are a plain name or number, possibly negated, are
+# left to the infix helpers, see `SC_SIMPLE_RE`. so are operands holding
+# `yield`, `await`, `:=` or looking at their scope, and every operand with
+# `eager`, they can't be moved into a lambda. a line left open, continued on the next, is kept
+# as is.
+#
+# assert lazy_bool_ops("x = a and f(b)", {'and'}) == ("x = _andsc(a, lambda _sc: f(b))", {'and'})
+def lazy_bool_ops(src: str, ops: Container[str], eager: bool = False) -> Tuple[str, Set[str]]:
+	lexed = sc_tokens(src)
+	if lexed is None:
+		return (src, set())
+	tokens, code_end = lexed
+	# a line continued on the next holds part of an expression, its last
+	# operand would be cut short
+	depth = sum((text in "([{") - (text in ")]}") for _, _, text in tokens)
+	if depth > 0 or src[:code_end].rstrip().endswith("\\"):
+		return (src, set())
+	src, comment = src[:code_end], src[code_end:]
+	used = set()
+	out, i, pos = lazy_bool_level(src, tokens, 0, 0, ops, eager, used)
+	# unbalanced closing brackets are kept as is
+	while i < len(tokens):
+		closing = tokens[i][2]
+		more, i, pos = lazy_bool_level(src, tokens, i + 1, tokens[i][1], ops, eager, used)
+		out.append(closing)
+		out += more
+	if not used:
+		return (src + comment, used)
+	return ("".join(out) + comment, used)
+
+# split a condition on its top level `and` operators, looking into
+# operands wrapped in parentheses. a condition with a top level `or`, or
+# anything but an operand, is returned whole.
+#
+# assert split_and_operands("_if0 and (a and f(b))") == ["_if0", "a", "f(b)"]
+def split_and_operands(src: str) -> List[str]:
+	lexed = sc_tokens(src)
+	if lexed is None or lexed[1] < len(src):
+		return [src.strip()]
+	tokens = lexed[0]
+
+	splits = []
+	depth = 0
+	for start, end, text in tokens:
+		if text in "([{":
+			depth += 1
+		elif text in ")]}":
+			depth -= 1
+		elif depth > 0:
+			continue
+		elif text == 'and':
+			splits.append((start, end))
+		elif text == 'or' or sc_boundary(text, False):
+			return [src.strip()]
 
-			if parens == 0 and ch == ",":
-				return start
+	# a single operand wrapped in parentheses
+	if not splits:
+		stripped = src.strip()
+		if stripped.startswith("(") and tokens and tokens[0][2] == "(" and tokens[-1][2] == ")" and src[tokens[-1][1]:].strip() == "":
+			depth = 0
+			for _, _, text in tokens[:-1]:
+				if text in "([{":
+					depth += 1
+				elif text in ")]}":
+					depth -= 1
+				if depth == 0:
+					return [stripped] # closed before the end
+			inner = split_and_operands(src[tokens[0][1]:tokens[-1][0]])
+			if len(inner) > 1:
+				return inner
+		return [stripped]
+
+	operands = []
+	pos = 0
+	for start, end in splits + [(len(src), len(src))]:
+		operands += split_and_operands(src[pos:start])
+		pos = end
+	return operands
+
+# convert the parameters of a function definition into the parameters
+# of an equivalent lambda, and the arguments forwarding them in a call.
+# annotations can't appear in a lambda, and are removed.
+#
+# assert fn_lambda_params("a, b: int = 2, *args, c, **kw") == (
+#     "a, b=2, *args, c, **kw",
+#     "a, b, *args, c=c, **kw",
+# )
+def fn_lambda_params(params: str) -> Tuple[str, str]:
+	if params.strip() == '':
+		return ('', '')
+
+	lambda_params = []
+	call_args = []
+	keyword_only = False
+
+	for param in split_expr_strs(params):
+		components = param.split('=', 1)
+		name = components[0].split(':', 1)[0].strip()
+
+		if len(components) == 2:
+			lambda_params.append(f"{name}={components[1].strip()}")
+		else:
+			lambda_params.append(name)
+
+		if name == '/':
+			continue
+		elif name.startswith('**'):
+			call_args.append(name)
+		elif name.startswith('*'):
+			keyword_only = True
+			if name != '*':
+				call_args.append(name)
+		elif keyword_only:
+			call_args.append(f"{name}={name}")
+		else:
+			call_args.append(name)
+
+	return (", ".join(lambda_params), ", ".join(call_args))
 
 # removes the last occurance of a string, stripping it
 def rstrip_str(src: str, strip: str) -> str:
@@ -227,6 +646,265 @@ def rstrip_str(src: str, strip: str) -> str:
 		return src[:index].strip()
 	return src.strip()
 
+# helpers inserted at the top of a transpiled program, implementing the
+# removed operators as infix operators. see THOUGHTPROCESS.md.
+#
+# the helpers never store per-operation state. an operator either returns
+# a shared instance, or for operands that must be carried over to the
+# right hand side, a slotted holder of that operand.
+
+# x &_in& y  ->  (x & _in) & y
+#
+# `operator.contains` goes through the container's own `__contains__`
+# (falling back to iteration like `in` does), keeping the native
+# complexity of sets, dicts, ranges, etc.
+HELPER_IN = (
+	'from operator import contains as _contains\n'
+	'class _InLhs:\n'
+	'	__slots__ = ("lhs", "notin")\n'
+	'	__init__ = lambda self, lhs, notin: (setattr(self, "lhs", lhs), setattr(self, "notin", notin), None)[2]\n'
+	'	__and__ = lambda self, rhs: _contains(rhs, self.lhs) ^ self.notin\n'
+	'class _In:\n'
+	'	__slots__ = ("notin",)\n'
+	'	__init__ = lambda self, notin: setattr(self, "notin", notin)\n'
+	'	__rand__ = lambda self, lhs: _InLhs(lhs, self.notin)\n'
+)
+
+# x ^_and^ y  ->  (x ^ _and) ^ y
+#
+# a truthy lhs evaluates to the rhs, which is a shared `_AndRhs`.
+# a falsy lhs evaluates to itself, `False` has a shared holder.
+#
+# _and_ops[0] -> falsy lhs, held
+# _and_ops[1] -> truthy lhs
+# _and_ops[2] -> lhs is False
+HELPER_AND = (
+	'class _AndRhs:\n'
+	'	__slots__ = ()\n'
+	'	__call__ = lambda self, lhs: self\n'
+	'	__xor__ = lambda self, rhs: rhs\n'
+	'class _AndLhs:\n'
+	'	__slots__ = ("lhs",)\n'
+	'	__init__ = lambda self, lhs: setattr(self, "lhs", lhs)\n'
+	'	__call__ = lambda self, lhs: self\n'
+	'	__xor__ = lambda self, rhs: self.lhs\n'
+	'class _And:\n'
+	'	__slots__ = ()\n'
+	'	__rxor__ = lambda self, lhs: _and_ops[bool(lhs) + (lhs is False) * 2](lhs)\n'
+	'_and_ops = (_AndLhs, _AndRhs(), _AndLhs(False))\n'
+	'_and = _And()\n'
+)
+
+# x |_or| y  ->  (x | _or) | y
+#
+# a falsy lhs evaluates to the rhs, which is a shared `_OrRhs`.
+# a truthy lhs evaluates to itself, `True` has a shared holder.
+#
+# _or_ops[0] -> falsy lhs
+# _or_ops[1] -> truthy lhs, held
+# _or_ops[2] -> lhs is True
+HELPER_OR = (
+	'class _OrRhs:\n'
+	'	__slots__ = ()\n'
+	'	__call__ = lambda self, lhs: self\n'
+	'	__or__ = lambda self, rhs: rhs\n'
+	'class _OrLhs:\n'
+	'	__slots__ = ("lhs",)\n'
+	'	__init__ = lambda self, lhs: setattr(self, "lhs", lhs)\n'
+	'	__call__ = lambda self, lhs: self\n'
+	'	__or__ = lambda self, rhs: self.lhs\n'
+	'class _Or:\n'
+	'	__slots__ = ()\n'
+	'	__ror__ = lambda self, lhs: _or_ops[bool(lhs) + (lhs is True)](lhs)\n'
+	'_or_ops = (_OrRhs(), _OrLhs, _OrLhs(True))\n'
+	'_or = _Or()\n'
+)
+
+# _not& _not& x  ->  (_not & _not) & x
+#
+# `not` merges with another `_not` by flipping, there are only two
+# instances. applying one to a value is `flip ^ bool(value)`.
+HELPER_NOT = (
+	'class _Not:\n'
+	'	__slots__ = ("flip",)\n'
+	'	__init__ = lambda self, flip: setattr(self, "flip", flip)\n'
+	'	__and__ = lambda self, rhs: _not_ops[isinstance(rhs, _Not)](self, rhs)\n'
+	'_not_ops = (lambda self, rhs: self.flip ^ bool(rhs), lambda self, rhs: _nots[self.flip ^ rhs.flip])\n'
+	'_nots = (_Not(False), _Not(True))\n'
+	'_not = _nots[1]\n'
+)
+
+# _andsc(x, lambda _sc: y)  ->  x and y
+# _orsc(x, lambda _sc: y)   ->  x or y
+#
+# the right operand is deferred, only called when the left operand
+# doesn't decide the result. see `lazy_bool_ops`
+#
+# _sc_lhs -> evaluates to the left operand, in place of calling the rhs
+HELPER_SC = '_sc_lhs = lambda lhs: lhs\n'
+HELPER_ANDSC = '_andsc = lambda lhs, rhs: (_sc_lhs, rhs)[bool(lhs)](lhs)\n'
+HELPER_ORSC = '_orsc = lambda lhs, rhs: (rhs, _sc_lhs)[bool(lhs)](lhs)\n'
+
+# the end of an iterator in a lowered `for`, see `Program.transform_for`
+HELPER_FOR = '_forend = object()\n'
+
+# keywords removed from expressions, by the name of their group in
+# EXPR_KEYWORD_RE, as (replacement, flag of the helper implementing it)
+EXPR_KEYWORDS = {
+	'not_in': ('&_notin&', 'use_notinhelper'),
+	'and': ('^_and^', 'use_andhelper'),
+	'or': ('|_or|', 'use_orhelper'),
+	'not': ('_not&', 'use_nothelper'),
+	'in': ('&_in&', 'use_inhelper'),
+}
+EXPR_KEYWORD_RE = re.compile(r'\b(?:(?P<not_in>not\s+in)|(?P<and>and)|(?P<or>or)|(?P<not>not)|(?P<in>in))\b')
+
+# tokens continuing the statement above them, instead of starting a new one
+CONTINUATION_TOKENS = ('elif', 'else', 'except', 'finally')
+
+# statements leaving the block they're in, and `yield`, see `node_terminal`
+TERMINAL_TOKENS = ('continue', 'break', 'return', 'raise', 'yield')
+TERMINAL_RE = re.compile(r'(?:continue|break|return|raise|(yield))\b')
+
+# the flags of lowered `if` chains and `while` loops, see `peephole_body`
+IF_FLAG_RE = re.compile(r'(_if\d+) = True')
+WHILE_FLAG_RE = re.compile(r'(_while\d+) = True')
+
+# keywords the transformer is able to remove, all forbidden by default
+KEYWORDS = ('and', 'or', 'not', 'in', 'return', 'for', 'break', 'assert', 'elif', 'else')
+
+# build a regex finding the keywords that make code need transforming,
+# given the forbidden keywords. functions are lowered as a whole when
+# `return` is forbidden, `def` is searched for as well.
+def keywords_re(keywords: Iterable[str]) -> re.Pattern:
+	words = [word for word in KEYWORDS if word in keywords]
+	if 'return' in words:
+		words.append('def')
+	if not words:
+		return re.compile(r'(?!)') # never matches
+	return re.compile(r'\b(?:' + '|'.join(words) + r')\b')
+
+# keywords removed by the transformer, code without any of them is left as is
+FORBIDDEN_KEYWORD_RE = keywords_re(KEYWORDS)
+
+# scan the code of a source with the lexer, returning the forbidden
+# keywords present outside of strings and comments
+def scan_keywords(src: str, keyword_re: re.Pattern = FORBIDDEN_KEYWORD_RE) -> Set[str]:
+	found = set()
+	for valid, start, end in iter_to_identifers(src):
+		if valid:
+			found.update(keyword_re.findall(src, start, end))
+	return found
+
+# check if the code of a source has any forbidden keyword, stopping at the
+# first. sources without the keywords anywhere are never lexed.
+def has_keywords(src: str, keyword_re: re.Pattern = FORBIDDEN_KEYWORD_RE) -> bool:
+	if keyword_re.search(src) is None:
+		return False
+	for valid, start, end in iter_to_identifers(src):
+		if valid and keyword_re.search(src, start, end) is not None:
+			return True
+	return False
+
+# group lines into top level blocks, each a statement starting at column
+# zero along with its body and continuations (`elif`, `else`, ...).
+# blank lines and comments are kept with the block above them.
+def iter_top_level_blocks(lines: Iterable[str]) -> Iterator[List[str]]:
+	block = []
+	for line in lines:
+		line = line.rstrip("\n")
+		dedented_line = line.lstrip()
+
+		starts_block = (
+			dedented_line != ""
+			and len(dedented_line) == len(line)
+			and not dedented_line.startswith("#")
+			and tokenise_first(dedented_line) not in CONTINUATION_TOKENS
+		)
+		if starts_block and block:
+			yield block
+			block = []
+		block.append(line)
+
+	if block:
+		yield block
+
+# relations of the temporary variables of the lowerings, a function named
+# after one is lowered under `fn_<name>`, keeping their names apart
+TEMP_RELATIONS = ('if', 'while', 'iter', 'for', 'next')
+
+# yield lines of a file object, ending with an empty line if the file ends
+# with a newline. this matches the lines of `src.split("\n")`.
+def iter_split_lines(lines: Iterable[str]) -> Iterator[str]:
+	ends_with_newline = True
+	for line in lines:
+		ends_with_newline = line.endswith("\n")
+		yield line
+	if ends_with_newline:
+		yield ""
+
+# transform a program from an iterable of lines (such as a file object),
+# writing the transpiled program to a text sink as it goes.
+#
+# each top level block is transformed as soon as it's complete, only
+# one block is ever held in memory. the helpers used can't be known
+# before the end, so all of them are written first.
+def transform_stream(lines: Iterable[str], sink: TextIO, **options) -> 'Program':
+	program = Program("", **options)
+	prelude = program.transpile_prelude(all_helpers=True)
+	sink.write(prelude)
+	program.output_lines = prelude.count("\n")
+
+	first = True
+	for block in iter_top_level_blocks(iter_split_lines(lines)):
+		for line in program.transform_block(block):
+			if not first:
+				sink.write("\n")
+			sink.write(line)
+			first = False
+			program.output_lines += 1
+
+	return program
+
+# transform top level blocks apart from the rest of their program, such
+# as in a worker process. blocks are (line_offset, lines, temps), with the
+# counters from `Program.begin_block`. returns the transpiled lines of the
+# blocks in order, and the state to `Program.merge` into their program.
+def transform_blocks(blocks: List[Tuple[int, List[str], Dict[str, int]]], **options) -> Tuple[List[str], dict]:
+	program = Program("", **options)
+	lines = []
+	for line_offset, block, temps in blocks:
+		program.input_lines = line_offset
+		lines += program.transform_block(block, temps)
+	return lines, program.block_state()
+
+# count the nodes of every type in a list of IRNodes, and their bodies
+def count_nodes(nodes: List[IRNode]) -> Dict[str, int]:
+	counts = {}
+	stack = [nodes]
+	while stack:
+		for node in stack.pop():
+			name = type(node).__name__
+			counts[name] = counts.get(name, 0) + 1
+			if hasattr(node, 'body'):
+				stack.append(node.body)
+	return counts
+
+# set the line of nodes created by a transformation, along with the nodes
+# created inside of them. nodes holding a line already are left alone,
+# their bodies were stamped when they were transformed.
+def stamp_lines(nodes: List[IRNode], line: int):
+	stack = [nodes]
+	while stack:
+		for node in stack.pop():
+			if node.line == 0:
+				node.line = line
+				if hasattr(node, 'body'):
+					stack.append(node.body)
+
+# the helpers of the prelude, by the name of their flag `use_<name>helper`
+HELPER_NAMES = ('in', 'notin', 'and', 'or', 'not', 'andsc', 'orsc', 'for')
+
 # represents a `Program`, containing the intermediate representation
 # of a source file passed to the transpiler.
 #
@@ -234,8 +912,72 @@ def rstrip_str(src: str, strip: str) -> str:
 # running transformations on the IR, and then transpiling it back.
 #
 class Program:
-	def __init__(self, program_src):
+	# fn_lowering: how functions are lowered to remove `return`
+	#
+	#     "global" -> the return value is stored in a module global
+	#                 `_ret_<name>N`, read after the generator yields
+	#     "yield"  -> the return value is yielded from the generator,
+	#                 calls are reentrant and never touch globals
+	#
+	# for_lowering: how the end of an iterator is detected in a lowered `for`
+	#
+	#     "except"   -> `next()` raises StopIteration, caught on
+	#                   every iteration
+	#     "sentinel" -> `next()` returns a unique default object, compared
+	#                   by identity, there is no exception handling. slower
+	#                   than "except", a `try` costs nothing until it raises
+	#
+	# fast_path: copy top level blocks without any forbidden keyword in
+	#            their code verbatim, without parsing them. see `IRVerbatim`
+	#
+	# peephole: clean up the scaffolding left by the lowerings, see `peephole`
+	#
+	# short_circuit: keep `and` and `or` from evaluating their right operand
+	#                when the left one decides the result. conditions of an
+	#                `if` are split into nested ones, other expressions
+	#                defer the operand, see `lazy_bool_ops`
+	#
+	# keywords: the forbidden keywords, all of `KEYWORDS` by default. only
+	#           the transformations removing them are run, everything
+	#           else is emitted as written.
+	#
+	#     "for", "in"      -> `for` loops are lowered
+	#     "break"          -> `break` is lowered, along with the `for`
+	#                         loops containing one
+	#     "elif", "else"   -> `if` chains are lowered
+	#     "return"         -> functions are lowered
+	#     "assert"         -> `assert` is lowered
+	#     "and", "or", ... -> the operator is rewritten in expressions
+	#
+	def __init__(self, program_src, fn_lowering="global", for_lowering="except", fast_path=True, keywords=KEYWORDS, peephole=True, short_circuit=True):
+		assert fn_lowering in ("global", "yield"), fn_lowering
+		assert for_lowering in ("except", "sentinel"), for_lowering
+		assert set(keywords) <= set(KEYWORDS), keywords
 		self.program_src = program_src
+		self.fn_lowering = fn_lowering
+		self.for_lowering = for_lowering
+		self.fast_path = fast_path
+		self.peephole_enabled = peephole
+		self.short_circuit = short_circuit
+		self.keywords = frozenset(keywords)
+		self.keyword_re = keywords_re(self.keywords)
+		self.lower_for = 'for' in self.keywords or 'in' in self.keywords
+		self.lower_break = 'break' in self.keywords
+		self.lower_if = 'elif' in self.keywords or 'else' in self.keywords
+		self.lower_fn = 'return' in self.keywords
+		self.lower_assert = 'assert' in self.keywords
+		# the rewritten operators don't mix with every native one:
+		#
+		# - `not in` is rewritten when either of its keywords is forbidden
+		# - `a and b |_or| c` groups the wrong way, `or` needs `and`
+		# - `a ^_and^ not b` is a syntax error, `and` and `or` need `not`
+		self.expr_keywords = {kind for kind in EXPR_KEYWORDS if kind in self.keywords}
+		if 'or' in self.expr_keywords:
+			self.expr_keywords.add('and')
+		if 'and' in self.expr_keywords:
+			self.expr_keywords.add('not')
+		if 'not' in self.expr_keywords or 'in' in self.expr_keywords:
+			self.expr_keywords.add('not_in')
 		self.lines = program_src.split("\n")
 		self.index = 0
 		self.lines_iterator = iter(self.line_next, None)
@@ -245,16 +987,86 @@ class Program:
 		self.use_andhelper = False
 		self.use_orhelper = False
 		self.use_nothelper = False
+		self.use_andschelper = False
+		self.use_orschelper = False
+		self.use_forhelper = False
 		self.tmp_break_stack = []
+		# counters of the temporary variables of the block being transformed
 		self.tmp_counter_prefix = {}
+		# temporary variables allocated so far, for every relation
+		self.temps = {}
+		# lowered functions in the blocks so far, for every relation
+		self.fn_temps = {}
+		# top level blocks, as (start, end) in `program`, and the counters
+		# they start with
+		self.blocks = []
 		self.current_fn_ret = None
-		self.program = self.construct_ir(0)
+		# lowered function names, to their original names
+		self.fn_names = {}
+		# the line in the source before the lines being parsed
+		self.line_offset = 0
+		# statistics, see `stats()`
+		self.timings = {}
+		self.input_lines = len(self.lines) - (self.lines[-1] == "")
+		self.input_nodes = {}
+		self.output_lines = 0
+		self.fast_path_bytes = 0
+		start = time.perf_counter()
+		self.program = self.construct_regions(self.lines)
+		self.stats_time('parse', start)
+		# the IR holds the stripped lines, don't keep the originals around
+		self.lines = []
 	
-	# rewind the line iterator
-	def line_rewind(self):
-		if self.index > 0:
-			self.index -= 1
+	# add the time since `start` to a stage, returning the current time
+	def stats_time(self, stage: str, start: float) -> float:
+		now = time.perf_counter()
+		self.timings[stage] = self.timings.get(stage, 0.0) + (now - start)
+		return now
+
+	# statistics about the program so far, as a JSON serialisable dict.
+	#
+	# timings: seconds spent in each stage, summed over every block
+	# input_nodes, output_nodes: IR nodes by type, parsed and current
+	# temps: temporary variables allocated for each relation
+	# helpers: the helpers requested in the prelude
+	# line_ratio: lines emitted for every line of input
+	# fast_path_bytes: bytes of the source copied verbatim
+	def stats(self) -> dict:
+		return {
+			'timings': dict(self.timings),
+			'input_lines': self.input_lines,
+			'output_lines': self.output_lines,
+			'line_ratio': self.output_lines / self.input_lines if self.input_lines else 0.0,
+			'input_nodes': dict(self.input_nodes),
+			'output_nodes': count_nodes(self.program),
+			'temps': dict(self.temps),
+			'helpers': {name: getattr(self, f"use_{name}helper") for name in HELPER_NAMES},
+			'fast_path_bytes': self.fast_path_bytes,
+		}
 	
+	# the state left by transforming blocks, see `transform_blocks`
+	def block_state(self) -> dict:
+		return {
+			'helpers': {name: getattr(self, f"use_{name}helper") for name in HELPER_NAMES},
+			'fn_names': dict(self.fn_names),
+			'temps': dict(self.temps),
+			'timings': dict(self.timings),
+			'input_nodes': dict(self.input_nodes),
+			'fast_path_bytes': self.fast_path_bytes,
+		}
+
+	# merge the state left by transforming blocks apart, the helpers they
+	# requested and their statistics
+	def merge(self, state: dict):
+		for name, used in state['helpers'].items():
+			if used:
+				setattr(self, f"use_{name}helper", True)
+		self.fn_names.update(state['fn_names'])
+		for counts, other in ((self.temps, state['temps']), (self.timings, state['timings']), (self.input_nodes, state['input_nodes'])):
+			for key, value in other.items():
+				counts[key] = counts.get(key, 0) + value
+		self.fast_path_bytes += state['fast_path_bytes']
+
 	# move the line iterator forward
 	def line_next(self) -> str | None:
 		if self.index >= len(self.lines):
@@ -268,14 +1080,175 @@ class Program:
 		# possibly deprecate?
 		return IRUnit(expr)
 	
+	# construct a statement node from a single dedented line. statements
+	# opening a block are returned with an empty body, filled in by
+	# `construct_ir` with the lines indented below them.
+	def construct_stmt(self, dedented_line: str) -> IRNode:
+		# grab the first token on the line
+		token = tokenise_first(dedented_line)
+
+		match token:
+			case 'if':
+				# if expr:
+				#    ^^^^
+				expr_str = rstrip_str(dedented_line[len(token):], ":")
+				return IRIf(self.construct_expr(expr_str), [])
+			case 'elif':
+				# elif expr:
+				#      ^^^^
+				expr_str = rstrip_str(dedented_line[len(token):], ":")
+				return IRElif(self.construct_expr(expr_str), [])
+			case 'else':
+				# else:
+				return IRElse([])
+			case 'def':
+				# def func(params):
+				#     ^^^^ ^^^^^^
+				components = dedented_line[len(token):].split('(', 1)
+				components[1] = rstrip_str(components[1], "):")
+				name = components[0].strip()
+				params = components[1]
+				return IRFn(name, params, [])
+			case 'return':
+				# return expr
+				#        ^^^^
+				return IRReturn(self.construct_expr(dedented_line[len(token):].strip()))
+			case 'assert':
+				# assert expr0, expr1
+				#        ^^^^^  ^^^^^
+				exprs = []
+				expr_strs = dedented_line[len(token):]
+				pos = walk_expr_str(expr_strs)
+
+				if pos is None:
+					exprs.append(self.construct_expr(expr_strs.strip()))
+				else:
+					exprs.append(self.construct_expr(expr_strs[:pos - 1].strip()))
+					exprs.append(self.construct_expr(expr_strs[pos:].strip()))
+				return IRAssert(exprs)
+			case 'while':
+				# while expr:
+				#       ^^^^
+				expr_str = rstrip_str(dedented_line[len(token):], ":")
+				return IRWhile(self.construct_expr(expr_str), [])
+			case 'for':
+				# for lhs in rhs:
+				#     ^^^    ^^^
+				# a well formed `lhs` will never contain a keyword like `in`
+				#     -- use              : `.split("in", 1)`
+				#     -- will not fail on : `v in "hello in this"`
+
+				expr_strs = re.split(r'\b(in)\b', rstrip_str(dedented_line[len(token):], ":"))
+				del expr_strs[1]
+				assert len(expr_strs) == 2
+				expr_strs[0] = expr_strs[0].strip()
+				expr_strs[1] = expr_strs[1].strip()
+				return IRFor(self.construct_expr(expr_strs[0]), self.construct_expr(expr_strs[1]), [])
+			case 'break':
+				# break
+				return IRBreak()
+			case expr:
+				# base case without an explicit representation in the IR.
+				# just an expression, stripping all comments
+				dedented_line_no_comments = dedented_line.split('#', 1)[0].strip()
+				
+				if dedented_line_no_comments[len(dedented_line_no_comments) - 1:] == ":":
+					assert keyword.iskeyword(token), token # it should be.
+					expr_str = rstrip_str(dedented_line[len(token):], ":")
+					return IRIndent(token, self.construct_expr(expr_str), [])
+				else:
+					return self.construct_expr(dedented_line)
+
+	# construct the IR of a list of lines
+	def construct_block(self, lines: List[str]) -> List[IRNode]:
+		self.lines = lines
+		self.index = 0
+		self.lines_iterator = iter(self.line_next, None)
+		return self.construct_ir()
+
+	# check if a top level block can be copied verbatim, counting its bytes
+	def construct_verbatim(self, lines: List[str]) -> bool:
+		block_src = "\n".join(lines)
+		if has_keywords(block_src, self.keyword_re):
+			return False
+		self.fast_path_bytes += len(block_src.encode())
+		return True
+
+	# construct the IR one top level block at a time, see `begin_block`.
+	# with `fast_path`, blocks that can be copied verbatim are never
+	# parsed, neither is a whole file.
+	def construct_regions(self, lines: List[str]) -> List[IRNode]:
+		if self.fast_path and self.construct_verbatim(lines):
+			self.input_nodes['IRVerbatim'] = 1
+			self.blocks.append((0, 1, {}))
+			return [IRVerbatim(lines, line=1)]
+
+		nodes = []
+		line_offset = 0
+		for block in iter_top_level_blocks(lines):
+			start = len(nodes)
+			temps = self.begin_block(block)
+			if self.fast_path and self.construct_verbatim(block):
+				nodes.append(IRVerbatim(block, line=line_offset + 1))
+				self.input_nodes['IRVerbatim'] = self.input_nodes.get('IRVerbatim', 0) + 1
+			else:
+				self.line_offset = line_offset
+				nodes += self.construct_block(block)
+			self.blocks.append((start, len(nodes), temps))
+			line_offset += len(block)
+		return nodes
+
+	# the relations of the temporary variables of a lowered function
+	def fn_relations(self, name: str) -> List[str]:
+		relation = f"fn_{name}" if name in TEMP_RELATIONS else name
+		if self.fn_lowering == "global":
+			return [relation, f"ret_{name}"]
+		return [relation]
+
+	# start a top level block, returning the counters of temporary
+	# variables it's transformed with.
+	#
+	# every block numbers its temporary variables from zero, they're
+	# assigned before they're read and never outlive the block. lowered
+	# functions are module globals, numbered after the functions of the
+	# same name in the blocks before. they're counted from the lines,
+	# every block can be transformed on its own once counted. only the
+	# counters of the functions in the block are returned.
+	#
+	# /--
+	# |- def f():        def _f0():     <- block 0, starts with {'f': 0, 'ret_f': 0}
+	# |-     ...             ...
+	# |- def f():        def _f1():     <- block 1, starts with {'f': 1, 'ret_f': 1}
+	#
+	def begin_block(self, lines: List[str]) -> Dict[str, int]:
+		temps = {}
+		if not self.lower_fn:
+			return temps
+		for line in lines:
+			dedented_line = line.lstrip()
+			# def func(params):, as parsed by `construct_stmt`
+			if dedented_line.startswith("def") and tokenise_first(dedented_line) == 'def':
+				name = dedented_line[len('def'):].split('(', 1)[0].strip()
+				for relation in self.fn_relations(name):
+					count = self.fn_temps.get(relation, 0)
+					temps.setdefault(relation, count)
+					self.fn_temps[relation] = count + 1
+		return temps
+
 	# construct the IR working on tokens of lines from the iterator.
 	# it parses the lines, and constructs the IR.
-	def construct_ir(self, last_indent: int) -> List[IRNode]:
+	#
+	# this doesn't recurse, the blocks currently open are kept on a stack
+	# as (indent, stmts). a statement opening a block leaves its body
+	# pending, the indentation of the next line decides the indentation
+	# of that block. nesting is only limited by memory.
+	#
+	# comment only lines never open or close a block, they're kept in
+	# the innermost block.
+	def construct_ir(self) -> List[IRNode]:
 		stmts = []
-
-		first_line = self.lines[self.index]
-		current_indent = len(first_line) - len(first_line.lstrip())
-		indent_diff = current_indent - last_indent
+		blocks = []
+		pending = stmts
 
 		for line in self.lines_iterator:
 			# fuckit: we won't get multiline strings, or malformed indentation
@@ -287,94 +1260,30 @@ class Program:
 			dedented_line = line.lstrip()
 			line_indent = len(line) - len(dedented_line)
 
-			# walk iterator backwards, and break recursion
-			if line_indent < current_indent:
-				self.line_rewind()
-				break
+			line = self.line_offset + self.index
+			if dedented_line.startswith("#"):
+				if pending is not None:
+					pending.append(IRUnit(dedented_line, line=line))
+				else:
+					blocks[-1][1].append(IRUnit(dedented_line, line=line))
+				continue
 
-			# grab the first token on the line
-			token = tokenise_first(dedented_line)
+			if pending is not None:
+				blocks.append((line_indent, pending))
+				pending = None
+			else:
+				# close blocks, the outermost block is never closed
+				while len(blocks) > 1 and line_indent < blocks[-1][0]:
+					blocks.pop()
 
-			match token:
-				case 'if':
-					# if expr:
-					#    ^^^^
-					expr_str = rstrip_str(dedented_line[len(token):], ":")
-					body = self.construct_ir(current_indent)
-					stmts.append(IRIf(self.construct_expr(expr_str), body))
-				case 'elif':
-					# elif expr:
-					#      ^^^^
-					expr_str = rstrip_str(dedented_line[len(token):], ":")
-					body = self.construct_ir(current_indent)
-					stmts.append(IRElif(self.construct_expr(expr_str), body))
-				case 'else':
-					# else:
-					stmts.append(IRElse(self.construct_ir(current_indent)))
-				case 'def':
-					# def func(params):
-					#     ^^^^ ^^^^^^
-					components = dedented_line[len(token):].split('(', 1)
-					components[1] = rstrip_str(components[1], "):")
-					name = components[0].strip()
-					params = components[1]
-					body = self.construct_ir(current_indent)
-					func = IRFn(name, params, body)
-					stmts.append(func)
-				case 'return':
-					# return expr
-					#        ^^^^
-					expr = self.construct_expr(dedented_line[len(token):].strip())
-					stmts.append(IRReturn(expr))
-				case 'assert':
-					# assert expr0, expr1
-					#        ^^^^^  ^^^^^
-					exprs = []
-					expr_strs = dedented_line[len(token):]
-					pos = walk_expr_str(expr_strs)
-
-					if pos is None:
-						exprs.append(self.construct_expr(expr_strs.strip()))
-					else:
-						exprs.append(self.construct_expr(expr_strs[:pos - 1].strip()))
-						exprs.append(self.construct_expr(expr_strs[pos:].strip()))
-					stmts.append(IRAssert(exprs))
-				case 'while':
-					# while expr:
-					#       ^^^^
-					expr_str = rstrip_str(dedented_line[len(token):], ":")
-					body = self.construct_ir(current_indent)
-					stmts.append(IRWhile(self.construct_expr(expr_str), body))
-				case 'for':
-					# for lhs in rhs:
-					#     ^^^    ^^^
-					# a well formed `lhs` will never contain a keyword like `in`
-					#     -- use              : `.split("in", 1)`
-					#     -- will not fail on : `v in "hello in this"`
-
-					expr_strs = re.split(r'\b(in)\b', rstrip_str(dedented_line[len(token):], ":"))
-					del expr_strs[1]
-					assert len(expr_strs) == 2
-					expr_strs[0] = expr_strs[0].strip()
-					expr_strs[1] = expr_strs[1].strip()
-					body = self.construct_ir(current_indent)
-					stmts.append(IRFor(self.construct_expr(expr_strs[0]), self.construct_expr(expr_strs[1]), body))
-				case 'break':
-					# break
-					stmts.append(IRBreak())
-				case expr:
-					# base case without an explicit representation in the IR.
-					# just an expression, stripping all comments
-					dedented_line_no_comments = dedented_line.split('#', 1)[0].strip()
-					
-					if dedented_line_no_comments[len(dedented_line_no_comments) - 1:] == ":":
-						assert keyword.iskeyword(token), token # it should be.
-						expr_str = rstrip_str(dedented_line[len(token):], ":")
-						body = self.construct_ir(current_indent)
-						stmts.append(IRIndent(token, self.construct_expr(expr_str), body))
-					else:
-						expr_str = dedented_line
-						stmts.append(self.construct_expr(expr_str))
+			node = self.construct_stmt(dedented_line)
+			node.line = line
+			blocks[-1][1].append(node)
+			name = type(node).__name__
+			self.input_nodes[name] = self.input_nodes.get(name, 0) + 1
+
+			if hasattr(node, 'body'):
+				pending = node.body
 		
 		return stmts
 	
@@ -404,59 +1313,78 @@ class Program:
 		
 		tmp = f"_{relation}{self.tmp_counter_prefix[relation]}"
 		self.tmp_counter_prefix[relation] += 1
+		self.temps[relation] = self.temps.get(relation, 0) + 1
 		return tmp
 
 	# transform a slice of an entire IRIf + IRElif + IRElse,
 	# into one with applied transformations.
-	def transform_walk_if(self, body: List[IRNode]) -> List[IRNode]:
-		# check if it's a simplistic stmt
-		if len(body) == 1:
-			# body[0] must be a IRIf
-			node = body[0]
-			transformed = self.transform_stmts_recurse(node.body)
-			node.body = transformed
-			return [node]
+	def transform_walk_if(self, body: List[IRNode]) -> Generator[List[IRNode], List[IRNode], List[IRNode]]:
+		# check if it's a simplistic stmt, or the chain is kept
+		if len(body) == 1 or not self.lower_if:
+			for node in body:
+				node.body = yield node.body
+			return body
 
 		nbody = []
 		temp_var = self.transform_new_temp_var("if")
 
-		nbody.append(IRUnit(f"{temp_var} = True"))
+		nbody.append(IRUnit(f"{temp_var} = True", line=body[0].line))
 		for op in body:
 			match op:
 				case IRIf(expr, body):
-					transformed = self.transform_stmts_recurse(op.body)
-					tbody = [IRUnit(f"{temp_var} = False")] + transformed
-					nbody.append(IRIf(expr, tbody))
+					transformed = yield op.body
+					tbody = [IRUnit(f"{temp_var} = False", line=op.line)] + transformed
+					nbody.append(IRIf(expr, tbody, line=op.line))
 				case IRElif(expr, body):
-					transformed = self.transform_stmts_recurse(op.body)
+					transformed = yield op.body
 					tcond = IRUnit(f"{temp_var} and ({expr.src})") # quoted expr
-					tbody = [IRUnit(f"{temp_var} = False")] + transformed
-					nbody.append(IRIf(tcond, tbody))
+					tbody = [IRUnit(f"{temp_var} = False", line=op.line)] + transformed
+					nbody.append(IRIf(tcond, tbody, line=op.line))
 				case IRElse(body):
-					transformed = self.transform_stmts_recurse(op.body)
+					transformed = yield op.body
 					tcond = IRUnit(f"{temp_var}")
-					nbody.append(IRIf(tcond, transformed))
+					nbody.append(IRIf(tcond, transformed, line=op.line))
 				case other:
 					assert False, other
 
 		return nbody
 	
-	# check if the current IRWhile body contains a break statement.
-	def transform_body_contains_break(self, node: IRWhile) -> bool:
-		for op in node.body:
-			match op:
-				case IRWhile():
-					pass # break doesn't refer to this while
-				case IRFor():
-					pass # break doesn't refer to this for
-				case IRBreak():
-					return True
-				case other:
-					if hasattr(other, 'body'):
-						if self.transform_body_contains_break(other):
-							return True
-		
-		return False
+	# annotate every loop and function in a list of IRNodes with the
+	# facts about their bodies, see `IRFacts`. this is a single walk,
+	# the innermost loop and function are carried down with each body.
+	def annotate(self, nodes: List[IRNode]):
+		stack = [(iter(nodes), None, None)]
+
+		while stack:
+			body, loop, fn = stack[-1]
+			for node in body:
+				match node:
+					case IRWhile() | IRFor():
+						node.facts = IRFacts()
+						stack.append((iter(node.body), node.facts, fn))
+						break
+					case IRFn():
+						# a `break` can't leave a function
+						node.facts = IRFacts()
+						stack.append((iter(node.body), None, node.facts))
+						break
+					case IRBreak():
+						if loop is not None:
+							loop.has_break = True
+					case IRReturn():
+						if fn is not None:
+							fn.has_return = True
+					case IRIf() | IRElif() | IRElse() | IRIndent():
+						stack.append((iter(node.body), loop, fn))
+						break
+			else:
+				stack.pop()
+
+	# the facts about a loop or function, annotating it if it hasn't been
+	def node_facts(self, node: IRWhile | IRFor | IRFn) -> IRFacts:
+		if node.facts is None:
+			self.annotate([node])
+		return node.facts
 
 	# transform an IRWhile into a IRWhile with a temporary variable
 	# to insert into the condition expression to allow easy replacement
@@ -465,8 +1393,8 @@ class Program:
 	# this works recursively and throughout the entire IR tree,
 	# due to the `tmp_break_stack` that further IRBreak nodes
 	# can reference.
-	def transform_while(self, node: IRWhile) -> List[IRNode]:
-		contains_break = self.transform_body_contains_break(node)
+	def transform_while(self, node: IRWhile) -> Generator[List[IRNode], List[IRNode], List[IRNode]]:
+		contains_break = self.lower_break and self.node_facts(node).has_break
 
 		nbody = []
 
@@ -474,7 +1402,7 @@ class Program:
 			tmp = self.transform_new_temp_var("while")
 			self.tmp_break_stack.append(tmp)
 		
-		transformed = self.transform_stmts_recurse(node.body)
+		transformed = yield node.body
 
 		if contains_break:	
 			nbody.append(IRUnit(f"{tmp} = True"))
@@ -495,27 +1423,56 @@ class Program:
 	# due to the `tmp_break_stack` that further IRBreak nodes
 	# can reference.
 	#
-	# this also inserts a try/except block to catch StopIteration
-	# and set the temporary break condition to False.
-	def transform_for(self, node: IRFor) -> List[IRNode]:
+	# in "sentinel" mode, the iterator is advanced with `next()` and
+	# a default of `_forend`, a unique object. reaching it sets the
+	# temporary break condition to False.
+	#
+	# /--
+	# |- _iter0 = iter(range(0, 15))
+	# |- _for0 = True
+	# |- while _for0:
+	# |-     if (_next0 := next(_iter0, _forend)) is _forend:
+	# |-         _for0 = False
+	# |-         continue
+	# |-     v = _next0
+	# |-     print(v)
+	#
+	# in "except" mode, this inserts a try/except block to catch
+	# StopIteration and set the temporary break condition to False.
+	def transform_for(self, node: IRFor) -> Generator[List[IRNode], List[IRNode], List[IRNode]]:
 		iter_tmp = self.transform_new_temp_var("iter")
 		for_tmp = self.transform_new_temp_var("for")
 		nbody = []
 
+		if self.for_lowering == "sentinel":
+			next_tmp = self.transform_new_temp_var("next")
+			self.use_forhelper = True
+
 		self.tmp_break_stack.append(for_tmp)
-		transformed = self.transform_stmts_recurse(node.body)
+		transformed = yield node.body
 		self.tmp_break_stack.pop()
 
-		# TRY EXCEPT StopIteration
-		wnbody = [
-			IRIndent('try', IRUnit(''), [
-				IRUnit(f"{node.lhs.src} = next({iter_tmp})")
-			]),
-			IRIndent('except', IRUnit('StopIteration'), [
-				IRUnit(f"{for_tmp} = False"),
-				IRUnitStmt(f"continue", IRUnit('')),
-			]),
-		] + transformed
+		if self.for_lowering == "sentinel":
+			# the loop variable is assigned after the check, it must keep
+			# the last value once the loop is exhausted
+			wnbody = [
+				IRIf(IRUnit(f"({next_tmp} := next({iter_tmp}, _forend)) is _forend"), [
+					IRUnit(f"{for_tmp} = False"),
+					IRUnitStmt(f"continue", IRUnit('')),
+				]),
+				IRUnit(f"{node.lhs.src} = {next_tmp}"),
+			] + transformed
+		else:
+			# TRY EXCEPT StopIteration
+			wnbody = [
+				IRIndent('try', IRUnit(''), [
+					IRUnit(f"{node.lhs.src} = next({iter_tmp})")
+				]),
+				IRIndent('except', IRUnit('StopIteration'), [
+					IRUnit(f"{for_tmp} = False"),
+					IRUnitStmt(f"continue", IRUnit('')),
+				]),
+			] + transformed
 
 		nbody.append(IRUnit(f"{iter_tmp} = iter({node.rhs.src})"))
 		nbody.append(IRUnit(f"{for_tmp} = True"))
@@ -523,145 +1480,470 @@ class Program:
 
 		return nbody
 	
+	# transform an IRFn into a generator function, and a lambda under the
+	# original name driving it. a `return` becomes a `yield`, which stops
+	# execution of the generator.
+	#
+	# in "global" mode the return value is written to a global before
+	# yielding, and the lambda reads it back after.
+	#
+	# /--
+	# |- def _func0(test):
+	# |-     global _ret_func0
+	# |-     _ret_func0 = None
+	# |-     ...
+	# |-     yield
+	# |- func = lambda test : (next(_func0(test)), _ret_func0)[1]
+	#
+	# in "yield" mode the return value is the value yielded, and the
+	# lambda returns the value from `next()`. so does a function without
+	# a `return` in either mode.
+	#
+	# /--
+	# |- def _func0(test):
+	# |-     ...
+	# |-     yield
+	# |- func = lambda test : next(_func0(test))
+	#
+	def transform_fn(self, node: IRFn) -> Generator[List[IRNode], List[IRNode], List[IRNode]]:
+		assert self.current_fn_ret == None
+		new_fn_name = self.transform_new_temp_var(self.fn_relations(node.name)[0])
+		lambda_params, call_args = fn_lambda_params(node.params)
+		paramsrc = '' if lambda_params == '' else f' {lambda_params}'
+
+		# a function without a `return` returns None, the value of the
+		# final `yield`. it needs no return slot in either mode
+		if self.fn_lowering == "yield" or not self.node_facts(node).has_return:
+			# there is no return slot, mark that we're inside a function
+			self.current_fn_ret = new_fn_name
+			transformed = (yield node.body) + [IRUnit("yield")]
+			lambda_src = f"next({new_fn_name}({call_args}))"
+		else:
+			self.current_fn_ret = self.transform_new_temp_var(f"ret_{node.name}")
+			transformed = yield node.body
+			# global _ret_func0, set _ret_func0 to None, force to be iterator
+			transformed = [IRUnit(f"global {self.current_fn_ret}"), IRUnit(f"{self.current_fn_ret} = None")] + transformed + [IRUnit("yield")]
+			lambda_src = f"(next({new_fn_name}({call_args})), {self.current_fn_ret})[1]"
+
+		self.current_fn_ret = None
+		self.fn_names[new_fn_name] = node.name
+		return [
+			IRFn(new_fn_name, node.params, transformed),
+			IRUnit(f"{node.name} = lambda{paramsrc} : {lambda_src}"),
+		]
+
 	# transform a list of IRNodes into a list of IRNodes with applied
 	# transformations.
 	#
+	# this doesn't recurse. the transformations are generators, yielding
+	# a body they need transformed and receiving the result back. the
+	# generators waiting on a body are kept on an explicit stack, so
+	# nesting is only limited by memory.
+	def transform_stmts_recurse(self, abody: List[IRNode]) -> List[IRNode]:
+		stack = [self.transform_stmts(abody)]
+		transformed = None
+
+		while stack:
+			try:
+				body = stack[-1].send(transformed)
+			except StopIteration as e:
+				stack.pop()
+				transformed = e.value
+				continue
+			stack.append(self.transform_stmts(body))
+			transformed = None
+
+		return transformed
+
+	# the transformation of a list of IRNodes, driven by `transform_stmts_recurse`.
+	#
 	# some transformations are simple, others call out to auxiliary
 	# functions.
-	def transform_stmts_recurse(self, abody: List[IRNode]) -> List[IRNode]:
+	def transform_stmts(self, abody: List[IRNode]) -> Generator[List[IRNode], List[IRNode], List[IRNode]]:
 		nbody = []
 
 		# work on stmts, this will shuffle expressions
 		vals = enumerate(abody)
 		for index, op in vals:
 			match op:
-				case IRAssert(exprs):
+				case IRAssert(exprs) if self.lower_assert:
 					if len(exprs) == 1:
 						raise_str = "raise AssertionError"
 					else:
 						raise_str = f"raise AssertionError({self.transpile_expr(exprs[1])})"
-					new_expr = IRIf(IRUnit(f"not ({self.transpile_expr(exprs[0])})"), [IRUnit(raise_str)])
+					new_expr = IRIf(IRUnit(f"not ({self.transpile_expr(exprs[0])})"), [IRUnit(raise_str, line=op.line)], line=op.line)
 					nbody.append(new_expr)
 				case IRWhile():
-					nbody += self.transform_while(op)
-				case IRFor():
-					nbody += self.transform_for(op)
+					nodes = yield from self.transform_while(op)
+					stamp_lines(nodes, op.line)
+					nbody += nodes
+				case IRFor() if self.lower_for or (self.lower_break and self.node_facts(op).has_break):
+					nodes = yield from self.transform_for(op)
+					stamp_lines(nodes, op.line)
+					nbody += nodes
 				case IRIf():
 					if_stmts = self.transform_find_bounds_of_if(index, abody)
-					nbody += self.transform_walk_if(if_stmts)
+					nbody += yield from self.transform_walk_if(if_stmts)
 					iter_skip(vals, len(if_stmts) - 1) # skip these
-				case IRBreak():
+				case IRBreak() if self.lower_break:
 					top_tmp = self.tmp_break_stack[len(self.tmp_break_stack) - 1]
-					nbody.append(IRUnit(f"{top_tmp} = False"))
-					nbody.append(IRUnitStmt(f"continue", IRUnit('')))
-				case IRReturn(expr):
+					nbody.append(IRUnit(f"{top_tmp} = False", line=op.line))
+					nbody.append(IRUnitStmt(f"continue", IRUnit(''), line=op.line))
+				case IRReturn(expr) if self.lower_fn:
 					nsrc = self.transpile_expr(expr)
-					nbody.append(IRUnit(f'{self.current_fn_ret} = {nsrc}'))
-					nbody.append(IRUnit('yield'))
-				case IRFn(name, params, body):
-					assert self.current_fn_ret == None
-					new_fn_name = self.transform_new_temp_var(name)
-					self.current_fn_ret = self.transform_new_temp_var(f"ret_{name}")
-					transformed = self.transform_stmts_recurse(body)
-					# global _ret_func0, set _ret_func0 to None, force to be iterator
-					transformed = [IRUnit(f"global {self.current_fn_ret}"), IRUnit(f"{self.current_fn_ret} = None")] + transformed + [IRUnit("yield")]
-					nbody.append(IRFn(new_fn_name, params, transformed))
-					paramsrc = '' if params == '' else f' {params}'
-					nbody.append(IRUnit(f"{name} = lambda{paramsrc} : (next({new_fn_name}({params})), {self.current_fn_ret})[1]"))
-					self.current_fn_ret = None
+					if self.fn_lowering == "yield":
+						nbody.append(IRUnitStmt('yield', IRUnit(nsrc), line=op.line))
+					else:
+						nbody.append(IRUnit(f'{self.current_fn_ret} = {nsrc or "None"}', line=op.line))
+						nbody.append(IRUnit('yield', line=op.line))
+				case IRFn() if self.lower_fn:
+					nodes = yield from self.transform_fn(op)
+					stamp_lines(nodes, op.line)
+					nbody += nodes
 				case IRIndent(token, expr, body):
-					transformed = self.transform_stmts_recurse(body)
+					transformed = yield body
 					nbody.append(IRIndent(token, expr, transformed))
-				case IRUnit():
+				case IRFor() | IRFn():
+					# kept, the body is still transformed
+					op.body = yield op.body
+					nbody.append(op)
+				case IRElif() | IRElse() if not self.lower_if:
+					# the `else` of a loop or `try`, kept. a loop lowered to a
+					# flag would run it after a `break` too
+					prev = abody[index - 1]
+					assert not isinstance(prev, IRFor) or nbody[-1] is prev, "`else` of a lowered `for`"
+					assert not isinstance(prev, IRWhile) or not (self.lower_break and self.node_facts(prev).has_break), "`else` of a lowered `while`"
+					op.body = yield op.body
+					nbody.append(op)
+				case IRUnit() | IRAssert() | IRBreak() | IRReturn():
 					nbody.append(op) # not transforming expressions yet
+				case IRVerbatim():
+					nbody.append(op)
 				case other:
 					assert False, other
 
 		# work on expressions, to remove keywords introduced by previous stmt transformations
 		return nbody
 
+	# check if control never passes a statement, leaving its block. inside of
+	# a lowered function the generator is never resumed after a `yield`.
+	# a statement split across lines is parsed as a node per line, one left
+	# open never leaves its block before its last line.
+	def node_terminal(self, node: IRNode) -> bool:
+		match node:
+			case IRBreak():
+				return True
+			case IRReturn(expr):
+				return bracket_depth(expr.src) == 0
+			case IRUnitStmt(token, expr):
+				return (token == 'continue' or (token == 'yield' and self.lower_fn)) and bracket_depth(expr.src) == 0
+			case IRUnit(src) if src.startswith(TERMINAL_TOKENS):
+				m = TERMINAL_RE.match(src)
+				return m is not None and (m.group(1) is None or self.lower_fn) and bracket_depth(src) == 0
+		return False
+
+	# check if a body always leaves its block, ignoring comments after
+	def body_terminal(self, body: List[IRNode]) -> bool:
+		for node in reversed(body):
+			if not (isinstance(node, IRUnit) and node.src.startswith("#")):
+				return self.node_terminal(node)
+		return False
+
+	# optimise the scaffolding left by the statement transformations, on a
+	# list of IRNodes and every body inside. bodies are optimised innermost
+	# first, the bodies of branches are final once the branches are looked at.
+	#
+	# - statements after one leaving the block are unreachable, and dropped.
+	#   comments are kept
+	# - conditions `X and (True)` are folded to `X`
+	# - see `peephole_if_chain` and `peephole_while_once`
+	def peephole(self, nodes: List[IRNode]):
+		bodies = []
+		stack = [nodes]
+		while stack:
+			body = stack.pop()
+			bodies.append(body)
+			for node in body:
+				if hasattr(node, 'body'):
+					stack.append(node.body)
+
+		for body in reversed(bodies):
+			self.peephole_body(body)
+
+	# optimise a single list of IRNodes, in place
+	def peephole_body(self, nodes: List[IRNode]):
+		i = 0
+		while i < len(nodes):
+			match nodes[i]:
+				case IRUnit(src) if src.startswith("_"):
+					# flags start with an underscore, they never leave the block
+					if IF_FLAG_RE.fullmatch(src):
+						self.peephole_if_chain(nodes, i)
+					elif WHILE_FLAG_RE.fullmatch(src):
+						self.peephole_while_once(nodes, i)
+				case IRIf(cond) | IRWhile(cond) as node:
+					if cond.src.endswith(" and (True)"):
+						node.cond = IRUnit(cond.src[:-len(" and (True)")])
+				case node if self.node_terminal(node):
+					nodes[i + 1:] = [node for node in nodes[i + 1:] if isinstance(node, IRUnit) and node.src.startswith("#")]
+					break
+			i += 1
+
+	# a lowered `if` chain tests its flag in every branch but the first,
+	# and clears it when a branch is taken.
+	#
+	# the flag is never tested after the last branch, and never tested
+	# once a branch leaving the block is taken, those don't clear it.
+	# when every branch but the last leaves the block, the flag is always
+	# set when tested, and it's removed along with the `else` branch.
+	#
+	# /--
+	# |- _if0 = True
+	# |- if a:
+	# |-     _if0 = False
+	# |-     raise E
+	# |- if _if0 and (b):
+	# |-     _if0 = False
+	# |-     x()
+	# |- if _if0:
+	# |-     y()
+	# |
+	# |- if a:
+	# |-     raise E
+	# |- if (b):
+	# |-     x()
+	# |- y()
+	#
+	def peephole_if_chain(self, nodes: List[IRNode], start: int):
+		flag = nodes[start].src[:-len(" = True")]
+		clear = f"{flag} = False"
+		tested = f"{flag} and ("
+
+		end = start + 1
+		while end < len(nodes) and isinstance(nodes[end], IRIf):
+			src = nodes[end].cond.src
+			if end > start + 1 and src != flag and not src.startswith(tested):
+				break
+			end += 1
+		branches = nodes[start + 1:end]
+		if not branches:
+			return
+
+		terminal = [self.body_terminal(branch.body) for branch in branches]
+		for index, branch in enumerate(branches):
+			body = branch.body
+			if (index == len(branches) - 1 or terminal[index]) and body and isinstance(body[0], IRUnit) and body[0].src == clear:
+				del body[0]
+				if not body:
+					body.append(IRUnit("pass", line=branch.line))
+
+		if not all(terminal[:-1]):
+			return
+
+		chain = [branches[0]]
+		for branch in branches[1:]:
+			if branch.cond.src == flag:
+				chain += branch.body # the `else` branch
+			else:
+				branch.cond = IRUnit(branch.cond.src[len(tested) - 1:])
+				chain.append(branch)
+		nodes[start:end] = chain
+
+	# a lowered `while` loop ending in its only `break`, with no `continue`,
+	# runs at most once. it's an `if`, and the flag is removed.
+	#
+	# /--
+	# |- _while0 = True
+	# |- while _while0 and (a):
+	# |-     x()
+	# |-     _while0 = False
+	# |-     continue
+	# |
+	# |- if (a):
+	# |-     x()
+	#
+	def peephole_while_once(self, nodes: List[IRNode], start: int):
+		flag = nodes[start].src[:-len(" = True")]
+		tested = f"{flag} and ("
+		if start + 1 >= len(nodes) or not isinstance(nodes[start + 1], IRWhile):
+			return
+		loop = nodes[start + 1]
+		if not loop.cond.src.startswith(tested) or len(loop.body) < 2:
+			return
+		if not (isinstance(loop.body[-2], IRUnit) and loop.body[-2].src == f"{flag} = False"):
+			return
+
+		# every `break` and `continue` of this loop, but not of the loops inside
+		exits = 0
+		stack = [loop.body]
+		while stack:
+			for node in stack.pop():
+				match node:
+					case IRWhile() | IRFor() | IRFn():
+						pass
+					case IRUnit(src) if src == f"{flag} = False" or TERMINAL_RE.match(src) and src.startswith('continue'):
+						exits += 1
+					case IRUnitStmt('continue', _):
+						exits += 1
+					case _ if hasattr(node, 'body'):
+						stack.append(node.body)
+		if exits != 2:
+			return
+
+		body = loop.body[:-2] or [IRUnit("pass", line=loop.line)]
+		nodes[start:start + 2] = [IRIf(IRUnit(loop.cond.src[len(tested) - 1:]), body, line=loop.line)]
+
 	# transform an expression into a new expression with applied transformations.
 	# this is the main entry point for expression transformations.
-	def transform_expr(self, node: IRUnit):
+	#
+	# ---- remove all `not` + `and` + `or` + `in` + `not in`, if forbidden
+	#
+	# every keyword in the code of the expression is found in one scan, and
+	# replaced as described by EXPR_KEYWORDS. the output is joined once.
+	#
+	# with `short_circuit`, `and` and `or` are first lowered lazily where
+	# they must be. `eager` keeps them from using lambdas, they can't see
+	# the names of a class body.
+	def transform_expr(self, node: IRUnit, eager: bool = False):
 		src = node.src
+		if self.short_circuit and SC_BOOL_RE.search(src):
+			src, deferred = lazy_bool_ops(src, self.expr_keywords, eager)
+			for kind in deferred:
+				setattr(self, f"use_{kind}schelper", True)
+			node.src = src
+		parts = []
+		used = set()
+		last = 0
 
-		# ---- remove all `not` + `and` + `or` + `in` + `not in`
-		rep = {
-			'and': '^_and^',
-			'or': '|_or|',
-			'not in': '&_notin&',
-			'in': '&_in&',
-			'not': '_not&',
-		}
-		
-		nsrc = ''
 		for valid, start, end in iter_to_identifers(src):
-			v = src[start:end]
-			if valid:
-				def matchfn(match):
-					string = match.group(0)
-					if string == 'not':
-						self.use_nothelper = True
-					elif string == 'and':
-						self.use_andhelper = True
-					elif string == 'or':
-						self.use_orhelper = True
-					elif string == 'in':
-						self.use_inhelper = True
-					elif string == 'not in':
-						self.use_notinhelper = True
-					return rep[string]
-				nsrc += re.sub(r'\b(not in|and|or|not|in)\b', matchfn, v)
-			else:
-				nsrc += v
+			if not valid:
+				continue
+			for m in EXPR_KEYWORD_RE.finditer(src, start, end):
+				if m.lastgroup not in self.expr_keywords:
+					continue # allowed, kept as is
+				parts.append(src[last:m.start()])
+				parts.append(EXPR_KEYWORDS[m.lastgroup][0])
+				used.add(m.lastgroup)
+				last = m.end()
+
+		if not parts:
+			return
+
+		parts.append(src[last:])
+		node.src = ''.join(parts)
+		for kind in used:
+			setattr(self, EXPR_KEYWORDS[kind][1], True)
 
-		node.src = nsrc
+	# split the condition of an `if` on its top level `and`, into nested
+	# `if` statements evaluating each operand only if the last was truthy.
+	# only done when an operand must be kept from being evaluated, and
+	# never for an `if` continued by an `elif` or `else`.
+	#
+	# /--
+	# |- if a and f(b):      if a:
+	# |-     ...         ->      if f(b):
+	# |-                             ...
+	#
+	def transform_split_if(self, node: IRIf):
+		operands = split_and_operands(node.cond.src)
+		if len(operands) == 1 or all(SC_SIMPLE_RE.fullmatch(operand) for operand in operands[1:]):
+			return
+		body = node.body
+		for operand in reversed(operands[1:]):
+			body = [IRIf(IRUnit(operand, line=node.line), body, line=node.line)]
+		node.cond = IRUnit(operands[0], line=node.line)
+		node.body = body
 
 	# transform a list of IRNodes into a list of IRNodes with applied
 	# transformations to their inner expressions.
-	# this is called recursively.
+	# bodies left to walk are kept on an explicit stack, along with if
+	# they're a class body.
 	def transform_exprs_recurse(self, abody: List[IRNode]):
-		for op in abody:
-			match op:
-				case IRIf(cond, body):
-					self.transform_expr(cond)
-					self.transform_exprs_recurse(body)
-				case IRElif(cond, body):
-					self.transform_expr(cond)
-					self.transform_exprs_recurse(body)
-				case IRElse(body):
-					self.transform_exprs_recurse(body)
-				case IRAssert(exprs):
-					self.transform_exprs_recurse(exprs)
-				case IRWhile(cond, body):
-					self.transform_expr(cond)
-					self.transform_exprs_recurse(body)
-				case IRFor(_, rhs, body):
-					self.transform_expr(rhs)
-					self.transform_exprs_recurse(cond)
-				case IRBreak():
-					pass
-				case IRReturn(expr):
-					self.transform_expr(expr)
-				case IRFn(_, _, body):
-					self.transform_exprs_recurse(body)
-				case IRUnitStmt(_, expr):
-					self.transform_expr(expr)
-				case IRUnit():
-					self.transform_expr(op)
-				case IRIndent(_, expr, body):
-					self.transform_expr(expr)
-					self.transform_exprs_recurse(body)
-				case other:
-					assert False, other
+		split_if = self.short_circuit and 'and' in self.expr_keywords
+		stack = [(abody, False)]
+		while stack:
+			nodes, eager = stack.pop()
+			for index, op in enumerate(nodes):
+				match op:
+					case IRIf(cond, body):
+						if split_if and not (index + 1 < len(nodes) and isinstance(nodes[index + 1], (IRElif, IRElse))):
+							self.transform_split_if(op)
+							cond, body = op.cond, op.body
+						self.transform_expr(cond, eager)
+						stack.append((body, eager))
+					case IRElif(cond, body):
+						self.transform_expr(cond, eager)
+						stack.append((body, eager))
+					case IRElse(body):
+						stack.append((body, eager))
+					case IRAssert(exprs):
+						stack.append((exprs, eager))
+					case IRWhile(cond, body):
+						self.transform_expr(cond, eager)
+						stack.append((body, eager))
+					case IRFor(_, rhs, body):
+						self.transform_expr(rhs, eager)
+						stack.append((body, eager))
+					case IRBreak():
+						pass
+					case IRReturn(expr):
+						self.transform_expr(expr, eager)
+					case IRFn(_, _, body):
+						stack.append((body, False))
+					case IRUnitStmt(_, expr):
+						self.transform_expr(expr, eager)
+					case IRUnit():
+						self.transform_expr(op, eager)
+					case IRIndent(token, expr, body):
+						self.transform_expr(expr, eager)
+						# `async def` starts a scope of its own
+						stack.append((body, token == 'class' or (eager and token != 'async')))
+					case IRVerbatim():
+						pass
+					case other:
+						assert False, other
 	
-	# transform the entire program
-	def transform(self):
+	# transform a list of top level IRNodes
+	def transform_nodes(self, nodes: List[IRNode]) -> List[IRNode]:
+		start = time.perf_counter()
+		# facts about loops and functions, read by the statement transforms
+		self.annotate(nodes)
+		start = self.stats_time('annotate', start)
 		# transform all statements, may introduce forbidden keywords in expressions
-		nprogram = self.transform_stmts_recurse(self.program)
+		nprogram = self.transform_stmts_recurse(nodes)
+		start = self.stats_time('stmts', start)
+		# clean up after the statements, only rearranging generated code
+		if self.peephole_enabled:
+			self.peephole(nprogram)
+			start = self.stats_time('peephole', start)
 		# transform all expressions, doesn't require context
 		self.transform_exprs_recurse(nprogram)
-		self.program = nprogram
+		self.stats_time('exprs', start)
+		return nprogram
+
+	# transform the entire program, one top level block at a time
+	def transform(self):
+		program = []
+		for start, end, temps in self.blocks:
+			self.tmp_counter_prefix = dict(temps)
+			program += self.transform_nodes(self.program[start:end])
+		self.program = program
+
+	# parse, transform and transpile one top level block of lines, sharing
+	# helpers with the rest of the program. `temps` are the counters it
+	# starts with, the blocks before are counted by default.
+	def transform_block(self, lines: List[str], temps: Dict[str, int] | None = None) -> Iterator[str]:
+		self.tmp_counter_prefix = self.begin_block(lines) if temps is None else dict(temps)
+		self.line_offset = self.input_lines
+		self.input_lines += len(lines)
+		if self.fast_path and self.construct_verbatim(lines):
+			return iter(lines)
+
+		start = time.perf_counter()
+		nodes = self.construct_block(lines)
+		self.stats_time('parse', start)
+		nodes = self.transform_nodes(nodes)
+		return self.transpile_iter(nodes, 0)
 
 	# unwrap an IRNode into a string
 	def transpile_expr(self, expr: IRNode) -> str:
@@ -671,137 +1953,171 @@ class Program:
 			case other:
 				assert False, other
 
-	# transpile a list of IRNodes into a list of strings, this is a recursive function
-	# and outputs a Python program.
+	# transpile a list of IRNodes into the lines of a Python program,
+	# yielding them one at a time.
 	#
-	# this appends known helpers to the top of the program, to be used.
+	# this doesn't recurse, the bodies being transpiled are kept on a stack
+	# as (iterator, indent). a body is entered by pushing it, and the outer
+	# body resumes where it left off once the inner body is exhausted.
+	def transpile_iter(self, body: List[IRNode], indent: int) -> Iterator[str]:
+		stack = [(iter(body), indent)]
+
+		while stack:
+			nodes, indent = stack[-1]
+			indent_line = "\t" * indent
+
+			for node in nodes:
+				match node:
+					case IRIf(cond, body):
+						yield f"{indent_line}if {self.transpile_expr(cond)}:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRElif(cond, body):
+						yield f"{indent_line}elif {self.transpile_expr(cond)}:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRElse(body):
+						yield f"{indent_line}else:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRWhile(cond, body):
+						yield f"{indent_line}while {self.transpile_expr(cond)}:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRFor(lhs, rhs, body):
+						yield f"{indent_line}for {self.transpile_expr(lhs)} in {self.transpile_expr(rhs)}:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRBreak():
+						yield f"{indent_line}break"
+					case IRIndent(token, expr, body):
+						expr_str = self.transpile_expr(expr)
+						if expr_str == '':
+							yield f"{indent_line}{token}:"
+						else:	
+							yield f"{indent_line}{token} {expr_str}:"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRAssert(exprs):
+						exprs_str = ", ".join(map(self.transpile_expr, exprs))
+						yield f"{indent_line}assert {exprs_str}"
+					case IRFn(name, params, body):
+						yield f"{indent_line}def {name}({params}):"
+						stack.append((iter(body), indent + 1))
+						break
+					case IRReturn(expr):
+						yield f"{indent_line}return {self.transpile_expr(expr)}"
+					case IRUnitStmt(token, expr):
+						yield f"{indent_line}{token} {self.transpile_expr(expr)}"
+					case IRUnit(src):
+						yield f"{indent_line}{src}"
+					case IRVerbatim(lines):
+						yield from lines
+					case other:
+						assert False, other
+			else:
+				stack.pop()
+
+	# the source line of every line `transpile_iter` yields, in order.
+	# every node is transpiled to a single line, but `IRVerbatim`.
+	def transpile_lines_iter(self, body: List[IRNode]) -> Iterator[int]:
+		stack = [iter(body)]
+
+		while stack:
+			for node in stack[-1]:
+				match node:
+					case IRVerbatim(lines):
+						yield from range(node.line, node.line + len(lines))
+					case _:
+						yield node.line
+						if hasattr(node, 'body'):
+							stack.append(iter(node.body))
+							break
+			else:
+				stack.pop()
+
+	# the source map of the transpiled program, as a JSON serialisable dict.
+	#
+	# lines: the source line of every line of `transpile()`, 0 for the prelude
+	# names: lowered function names, to their original names
+	# source: the lines of the source
+	def source_map(self) -> dict:
+		return {
+			'version': 1,
+			'lines': [0] * self.transpile_prelude().count("\n") + list(self.transpile_lines_iter(self.program)),
+			'names': dict(self.fn_names),
+			'source': self.program_src.split("\n"),
+		}
+
+	# transpile a list of IRNodes into a list of strings
 	def transpile_recurse(self, body: List[IRNode], indent: int) -> List[str]:
-		code = []
-		indent_line = "\t" * indent
-		
-		for node in body:
-			match node:
-				case IRIf(cond, body):
-					code.append(f"{indent_line}if {self.transpile_expr(cond)}:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRElif(cond, body):
-					code.append(f"{indent_line}elif {self.transpile_expr(cond)}:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRElse(body):
-					code.append(f"{indent_line}else:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRWhile(cond, body):
-					code.append(f"{indent_line}while {self.transpile_expr(cond)}:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRFor(lhs, rhs, body):
-					code.append(f"{indent_line}while {self.transpile_expr(lhs)} in {self.transpile_expr(rhs)}:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRBreak():
-					code.append(f"{indent_line}break")
-				case IRIndent(token, expr, body):
-					expr_str = self.transpile_expr(expr)
-					if expr_str == '':
-						code.append(f"{indent_line}{token}:")
-					else:	
-						code.append(f"{indent_line}{token} {expr_str}:")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRAssert(exprs):
-					exprs_str = ", ".join(map(self.transpile_expr, exprs))
-					code.append(f"{indent_line}assert {exprs_str}")
-				case IRFn(name, params, body):
-					code.append(f"{indent_line}def {name}({params}):")
-					code += self.transpile_recurse(body, indent + 1)
-				case IRReturn(expr):
-					code.append(f"{indent_line}return {self.transpile_expr(expr)}")
-				case IRUnitStmt(token, expr):
-					code.append(f"{indent_line}{token} {self.transpile_expr(expr)}")
-				case IRUnit(src):
-					code.append(f"{indent_line}{src}")
-				case other:
-					assert False, other
-		return code
+		return list(self.transpile_iter(body, indent))
 
-	# transpile the entire program IR into a string
-	def transpile(self) -> str:
-		# join the transpiled lines of the program into a single string
-		program_str = "\n".join(self.transpile_recurse(self.program, 0))
+	# build the prelude of helpers requested by the expression transformations
+	#
+	# with `all_helpers`, every helper is included regardless of use.
+	def transpile_prelude(self, all_helpers: bool = False) -> str:
 		prelude_str = ""
 
 		# check if infix helpers are requested
-		if self.use_inhelper or self.use_notinhelper:
-			inclass = (
-				'class _In:\n'
-				'	__init__ = lambda self, notin, lhs=None: (setattr(self, "notin", notin), setattr(self, "lhs", lhs), None)[2]\n'
-				'	__rand__ = lambda self, lhs: _In(self.notin, lhs)\n'
-				'	__and__ = lambda self, rhs: (self.in_impl(rhs), self.op_ret)[1] ^ self.notin\n'
-				'	def in_impl(self, rhs):\n'
-				'		is_inst = isinstance(rhs, str)\n'
-				'		if is_inst:\n'
-				'			self.op_ret = rhs.find(self.lhs) != -1\n'
-				'		if False == is_inst:\n'
-				'			self.op_ret = any(filter(lambda _x: _x == self.lhs, rhs))\n'
-			)
-			prelude_str += inclass
+		if self.use_inhelper or self.use_notinhelper or all_helpers:
+			prelude_str += HELPER_IN
 		# check if specific infix helpers are requested and add them to the prelude
-		if self.use_inhelper:
+		if self.use_inhelper or all_helpers:
 			prelude_str += '_in = _In(False)\n'
-		if self.use_notinhelper:
+		if self.use_notinhelper or all_helpers:
 			prelude_str += '_notin = _In(True)\n'
 		# check if "and" helper is requested
-		if self.use_andhelper:
-			andclass = (
-				'class _And:\n'
-				'	__init__ = lambda self, lhs=None : setattr(self, "lhs", lhs)\n'
-				'	__rxor__ = lambda self, lhs: _And(lhs)\n'
-				'	__xor__ = lambda self, rhs: (self.impl_and(rhs), self.op_ret)[1]\n'
-				'	def impl_and(self, rhs):\n'
-				'		passed = True\n'
-				'		if self.lhs:\n'
-				'			self.op_ret = rhs\n'
-				'			passed = False\n'
-				'		if passed:\n'
-				'			self.op_ret = self.lhs\n'
-			)
-			prelude_str += andclass
-			prelude_str += '_and = _And()\n'
+		if self.use_andhelper or all_helpers:
+			prelude_str += HELPER_AND
 		# check if "or" helper is requested
-		if self.use_orhelper:
-			orclass = (
-				'class _Or:\n'
-				'	__init__ = lambda self, lhs=None: setattr(self, "lhs", lhs)\n'
-				'	__ror__ = lambda self, lhs: _Or(lhs)\n'
-				'	__or__ = lambda self, rhs: (self.impl_or(rhs), self.op_ret)[1]\n'
-				'	def impl_or(self, rhs):\n'
-				'		passed = True\n'
-				'		if self.lhs:\n'
-				'			self.op_ret = self.lhs\n'
-				'			passed = False\n'
-				'		if passed:\n'
-				'			self.op_ret = rhs\n'
-			)
-			prelude_str += orclass
-			prelude_str += '_or = _Or()\n'
+		if self.use_orhelper or all_helpers:
+			prelude_str += HELPER_OR
 		# check if "not" helper is requested
-		if self.use_nothelper:
-			notclass = (
-				'class _Not:\n'
-				'	__init__ = lambda self: setattr(self, "dup", 1)\n'
-				'	__and__ = lambda self, other: (self.impl_not(other), self.op_ret)[1]\n'
-				'	def impl_not(self, other):\n'
-				'		is_inst = isinstance(other, _Not)\n'
-				'		if is_inst:\n'
-				'			self.dup += 1\n'
-				'			self.op_ret = self\n'
-				'		if False == is_inst:\n'
-				'			self.impl_operate(other)\n'
-				'	def impl_operate(self, other):\n'
-				'		ret = other\n'
-				'		while self.dup > 0:\n'
-				'			ret = False == bool(ret)\n'
-				'			self.dup -= 1\n'
-				'		self.op_ret = ret\n'
-			)
-			prelude_str += notclass
-			prelude_str += '_not = _Not()\n'
-
-		return prelude_str + program_str
\ No newline at end of file
+		if self.use_nothelper or all_helpers:
+			prelude_str += HELPER_NOT
+		# check if the lazy "and" and "or" helpers are requested
+		if self.use_andschelper or self.use_orschelper or all_helpers:
+			prelude_str += HELPER_SC
+		if self.use_andschelper or all_helpers:
+			prelude_str += HELPER_ANDSC
+		if self.use_orschelper or all_helpers:
+			prelude_str += HELPER_ORSC
+		# check if the `for` sentinel is requested
+		if self.use_forhelper or all_helpers:
+			prelude_str += HELPER_FOR
+
+		return prelude_str
+
+	# write the entire program IR into a text sink, the same output as
+	# `transpile()`. lines are written in chunks of `chunk_lines`, the
+	# program is never held in memory as a whole.
+	def transpile_to(self, sink: TextIO, chunk_lines: int = 1024):
+		start = time.perf_counter()
+		prelude = self.transpile_prelude()
+		sink.write(prelude)
+		self.output_lines = prelude.count("\n")
+
+		chunk = []
+		sep = ""
+		for line in self.transpile_iter(self.program, 0):
+			chunk.append(line)
+			if len(chunk) == chunk_lines:
+				sink.write(sep + "\n".join(chunk))
+				sep = "\n"
+				self.output_lines += len(chunk)
+				chunk = []
+		if chunk:
+			sink.write(sep + "\n".join(chunk))
+			self.output_lines += len(chunk)
+		self.stats_time('transpile', start)
+
+	# transpile the entire program IR into a string
+	def transpile(self) -> str:
+		start = time.perf_counter()
+		# join the transpiled lines of the program into a single string
+		program_str = "\n".join(self.transpile_iter(self.program, 0))
+		prelude = self.transpile_prelude()
+		self.output_lines = prelude.count("\n") + (program_str.count("\n") + 1 if self.program else 0)
+		self.stats_time('transpile', start)
+		return prelude + program_str
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import *
+from ir import Program, KEYWORDS
+from transformer import read_keywords, transform_file, transform_source
+from cache import TransformCache
+from client import DEFAULT_SOCKET
+
+# a long lived transform server, keeping the transformer loaded in a pool
+# of workers. it speaks JSON lines over stdin and stdout, or a Unix
+# socket, answering requests as they finish, out of order.
+#
+# {"id": 1, "path": "/abs/a.py"}         -> transform a file in place
+# {"id": 2, "src": "..."}                -> transform a source
+# {"id": 3, "op": "stats"}               -> requests served, latencies
+# {"id": 4, "op": "shutdown"}            -> stop once answered
+#
+# {"id": 1, "path": "/abs/a.py", "lines": 10, "cached": false, "error": null, "ms": 1.2}
+# {"id": 2, "src": "...", "error": null, "ms": 0.8}
+#
+# transform requests take the forbidden keywords in "keywords", the ones
+# of the server by default. the latency of a request is the time from
+# reading it to writing its response.
+#
+# python3 server.py [--stdio | --socket PATH] [-j N] [--keywords PATH] [--cache DIR] [--cache-size MB]
+#
+#         serve until stdin closes or a shutdown request, printing the
+#         latency percentiles to stderr once done. see `client.py`.
+#         the cache is pruned every PRUNE_INTERVAL requests, and once done
+
+# latencies kept for the percentiles, the most recent requests
+LATENCY_WINDOW = 100000
+# requests served between two prunes of the cache
+PRUNE_INTERVAL = 1000
+
+# the latency percentiles of requests, in ms
+def percentiles(latencies: List[float]) -> dict:
+	if not latencies:
+		return {}
+	ordered = sorted(latencies)
+	at = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e3
+	return {
+		'p50_ms': at(0.50),
+		'p90_ms': at(0.90),
+		'p99_ms': at(0.99),
+		'max_ms': ordered[-1] * 1e3,
+	}
+
+# load the transformer in a worker once, the first request pays nothing
+def warm_worker():
+	program = Program("if a and b:\n\tpass")
+	program.transform()
+	program.transpile()
+
+# run a transform request in a worker, the response without its id
+def run_request(request: dict, keywords: List[str] | None, cache_path: str | None) -> dict:
+	keywords = request.get('keywords', keywords)
+	if 'path' in request:
+		path, lines, cached, error, _ = transform_file(request['path'], cache_path, keywords=keywords)
+		return {'path': path, 'lines': lines, 'cached': cached, 'error': error}
+
+	options = {} if keywords is None else {'keywords': keywords}
+	cache = None if cache_path is None else TransformCache(cache_path)
+	try:
+		return {'src': transform_source(request['src'], cache, **options), 'error': None}
+	except Exception as e:
+		return {'error': f"{type(e).__name__}: {e}"}
+
+class TransformServer:
+	def __init__(self, jobs: int, keywords: List[str] | None = None, cache_path: str | None = None, cache_bytes: int = 256 * 2 ** 20):
+		self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=warm_worker)
+		self.keywords = keywords
+		self.cache_path = cache_path
+		# filled by the workers, only pruned here
+		self.cache = None if cache_path is None else TransformCache(cache_path, cache_bytes)
+		self.lock = threading.Lock()
+		self.latencies = deque(maxlen=LATENCY_WINDOW)
+		self.requests = 0
+		self.failures = 0
+		self.stopping = threading.Event()
+		# workers are spawned on demand, start them all before serving
+		for future in [self.pool.submit(int) for _ in range(jobs)]:
+			future.result()
+
+	# handle a request read at `start`, calling `respond` with its response
+	# once done, possibly from another thread. returns the future of a
+	# transform request, None if answered right away.
+	def handle(self, line: str, respond: Callable[[dict], None], start: float) -> Future | None:
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise ValueError("a request is an object")
+		except ValueError as e:
+			self.finish({'id': None, 'error': f"bad request: {e}"}, respond, start)
+			return None
+
+		response = {'id': request.get('id')}
+		match request:
+			case {'op': 'stats'}:
+				response.update(self.stats())
+			case {'op': 'shutdown'}:
+				self.stopping.set()
+				response['error'] = None
+			case {'path': str()} | {'src': str()}:
+				keywords = request.get('keywords', [])
+				valid = isinstance(keywords, list) and all(isinstance(word, str) for word in keywords)
+				unknown = [word for word in keywords if word not in KEYWORDS] if valid else []
+				if not valid:
+					response['error'] = "bad request: keywords are a list of strings"
+				elif unknown:
+					response['error'] = f"can't remove {', '.join(unknown)}, only {', '.join(KEYWORDS)}"
+				else:
+					future = self.pool.submit(run_request, request, self.keywords, self.cache_path)
+					future.add_done_callback(lambda future: self.finish({**response, **self.result(future)}, respond, start))
+					return future
+			case _:
+				response['error'] = "bad request: expected a path, src or op"
+
+		self.finish(response, respond, start)
+		return None
+
+	# the response of a finished transform request
+	def result(self, future: Future) -> dict:
+		try:
+			return future.result()
+		except Exception as e:
+			# the worker died, or the request couldn't be pickled
+			return {'error': f"{type(e).__name__}: {e}"}
+
+	def finish(self, response: dict, respond: Callable[[dict], None], start: float):
+		elapsed = time.perf_counter() - start
+		response['ms'] = elapsed * 1e3
+		with self.lock:
+			self.requests += 1
+			self.failures += response.get('error') is not None
+			self.latencies.append(elapsed)
+			prune = self.cache is not None and self.requests % PRUNE_INTERVAL == 0
+		respond(response)
+		if prune:
+			self.cache.prune()
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {
+				'requests': self.requests,
+				'failures': self.failures,
+				**percentiles(list(self.latencies)),
+			}
+
+	def close(self):
+		self.pool.shutdown()
+		if self.cache is not None:
+			self.cache.prune()
+
+# serve requests read line by line, writing each response as a line
+# with `write`. returns once the lines end or on shutdown, with every
+# request answered.
+def serve_stream(server: TransformServer, lines: Iterable[str], write: Callable[[str], None]):
+	lock = threading.Lock()
+	# released once per response written, a future is done before its
+	# callback writes the response
+	written = threading.Semaphore(0)
+	requests = 0
+
+	def respond(response: dict):
+		try:
+			with lock:
+				write(json.dumps(response) + "\n")
+		finally:
+			written.release()
+
+	for line in lines:
+		if not line.strip():
+			continue
+		server.handle(line, respond, time.perf_counter())
+		requests += 1
+		if server.stopping.is_set():
+			break
+
+	for _ in range(requests):
+		written.acquire()
+
+class StreamHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		serve_stream(self.server.transform_server, (line.decode() for line in self.rfile), lambda text: self.wfile.write(text.encode()))
+		if self.server.transform_server.stopping.is_set():
+			threading.Thread(target=self.server.shutdown).start()
+
+# serve requests over a Unix socket, one thread per connection
+def serve_socket(server: TransformServer, path: str):
+	if os.path.exists(path):
+		os.remove(path) # left behind by a server that died
+	with socketserver.ThreadingUnixStreamServer(path, StreamHandler) as sock_server:
+		sock_server.daemon_threads = True
+		sock_server.transform_server = server
+		try:
+			sock_server.serve_forever()
+		finally:
+			os.remove(path)
+
+def main():
+	parser = argparse.ArgumentParser(description="serve transform requests from a pool of warm workers")
+	parser.add_argument("--stdio", action="store_true", help="serve JSON lines over stdin and stdout")
+	parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"path of the Unix socket, default {DEFAULT_SOCKET}")
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+	parser.add_argument("--keywords", metavar="PATH", help="file of the forbidden keywords, all of them by default")
+	parser.add_argument("--cache", help="directory of the transform cache")
+	parser.add_argument("--cache-size", type=float, default=256, help="maximum size of the cache in MB")
+	args = parser.parse_args()
+
+	keywords = None
+	if args.keywords is not None:
+		keywords = read_keywords(args.keywords)
+		unknown = [word for word in keywords if word not in KEYWORDS]
+		if unknown:
+			parser.error(f"can't remove {', '.join(unknown)}, only {', '.join(KEYWORDS)}")
+
+	server = TransformServer(args.jobs, keywords, args.cache, int(args.cache_size * 2 ** 20))
+	try:
+		if args.stdio:
+			serve_stream(server, sys.stdin, lambda text: (sys.stdout.write(text), sys.stdout.flush()))
+		else:
+			serve_socket(server, args.socket)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+
+	stats = server.stats()
+	summary = ", ".join(f"{key} {value:.2f}" for key, value in stats.items() if key.endswith("_ms"))
+	print(f"served {stats['requests']} requests, {stats['failures']} failed" + (f", latency {summary}" if summary else ""), file=sys.stderr)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,215 @@
+import os
+import re
+import sys
+import json
+import pstats
+import runpy
+import argparse
+import traceback
+from typing import *
+
+# map profiles and tracebacks of transformed programs back to their source.
+#
+# transforming with `--source-map` writes a map next to each file, holding
+# the source line of every transformed line. see `Program.source_map`
+#
+# /--
+# |- <path>.py
+# |- <path>.py.map
+#
+# python3 sourcemap.py stats <profile> [--sort KEY] [-n N]
+#
+#         print a profile written by `python3 -m cProfile -o <profile>`,
+#         with lines and functions of transformed files remapped
+#
+# python3 sourcemap.py traceback [file]
+#
+#         remap a traceback read from a file, or stdin
+#
+# python3 sourcemap.py run <script.py> [args...]
+#
+#         run a transformed script, remapping the traceback if it raises
+
+MAP_SUFFIX = ".map"
+
+# the path of the source map of a transformed file
+def map_path(path: str) -> str:
+	return path + MAP_SUFFIX
+
+# write the source map of a transformed file
+def write_source_map(path: str, source_map: dict):
+	with open(map_path(path), "w") as f:
+		json.dump(source_map, f)
+
+# source maps of transformed files, loaded once per file
+class SourceMaps:
+	def __init__(self):
+		self.maps = {}
+
+	# the source map of a file, None if it has none
+	def get(self, path: str) -> dict | None:
+		if path not in self.maps:
+			try:
+				with open(map_path(path), "r") as f:
+					self.maps[path] = json.load(f)
+			except (OSError, ValueError):
+				self.maps[path] = None
+		return self.maps[path]
+
+	# the source line of a transformed line, 0 for lines without a source
+	# such as the prelude, unchanged for files without a map
+	def line(self, path: str, line: int) -> int:
+		source_map = self.get(path)
+		if source_map is None:
+			return line
+		if not 0 < line <= len(source_map['lines']):
+			return 0
+		return source_map['lines'][line - 1]
+
+	# the text of a source line, None if unknown
+	def source(self, path: str, line: int) -> str | None:
+		source_map = self.get(path)
+		if source_map is None or not 0 < line <= len(source_map['source']):
+			return None
+		return source_map['source'][line - 1]
+
+	# the original name of a lowered function
+	def name(self, path: str, name: str) -> str:
+		source_map = self.get(path)
+		if source_map is None:
+			return name
+		return source_map['names'].get(name, name)
+
+	# remap a (file, line, function) key of a profile. functions in the
+	# prelude keep their line, prefixed by `prelude:`
+	def key(self, key: Tuple[str, int, str]) -> Tuple[str, int, str]:
+		path, line, name = key
+		if self.get(path) is None:
+			return key
+		source_line = self.line(path, line)
+		if source_line == 0:
+			# the module starts in the prelude, but spans every line
+			if name != "<module>":
+				name = f"prelude:{name}"
+			return (path, line, name)
+		return (path, source_line, self.name(path, name))
+
+# sum the entries of a profile falling on the same key once remapped
+def merge_stat(old: tuple | None, new: tuple) -> tuple:
+	if old is None:
+		return new
+	cc, nc, tt, ct, callers = old
+	ncc, nnc, ntt, nct, ncallers = new
+	callers = dict(callers)
+	for caller, value in ncallers.items():
+		if caller in callers:
+			callers[caller] = tuple(a + b for a, b in zip(callers[caller], value))
+		else:
+			callers[caller] = value
+	return (cc + ncc, nc + nnc, tt + ntt, ct + nct, callers)
+
+# remap every entry of a profile, and their callers, in place
+def remap_stats(stats: pstats.Stats, maps: SourceMaps | None = None) -> pstats.Stats:
+	if maps is None:
+		maps = SourceMaps()
+
+	remapped = {}
+	for key, (cc, nc, tt, ct, callers) in stats.stats.items():
+		ncallers = {}
+		for caller, value in callers.items():
+			caller = maps.key(caller)
+			if caller in ncallers:
+				value = tuple(a + b for a, b in zip(ncallers[caller], value))
+			ncallers[caller] = value
+		key = maps.key(key)
+		remapped[key] = merge_stat(remapped.get(key), (cc, nc, tt, ct, ncallers))
+
+	stats.stats = remapped
+	stats.fcn_list = None
+	return stats
+
+# a frame of a formatted traceback, `  File "<path>", line <line>, in <name>`
+TRACEBACK_FRAME_RE = re.compile(r'^(\s*File "(.*)", line )(\d+)(, in )(.*)$')
+# the markers under a line of a traceback, only meaningful for the transformed code
+TRACEBACK_MARKER_RE = re.compile(r'^\s*[~^]+\s*$')
+
+# remap the frames of a formatted traceback, replacing each line of
+# transformed code with its source
+def remap_traceback(text: str, maps: SourceMaps | None = None) -> str:
+	if maps is None:
+		maps = SourceMaps()
+
+	lines = text.split("\n")
+	out = []
+	i = 0
+	while i < len(lines):
+		m = TRACEBACK_FRAME_RE.match(lines[i])
+		i += 1
+		if m is None or maps.get(m.group(2)) is None:
+			out.append(lines[i - 1])
+			continue
+
+		# frames in the prelude are kept as is
+		path = m.group(2)
+		line = maps.line(path, int(m.group(3)))
+		if line == 0:
+			out.append(lines[i - 1])
+			continue
+		out.append(f"{m.group(1)}{line}{m.group(4)}{maps.name(path, m.group(5))}")
+
+		# the code of the frame, and the markers under it
+		source = maps.source(path, line)
+		if i < len(lines) and lines[i].startswith("    ") and TRACEBACK_FRAME_RE.match(lines[i]) is None:
+			indent = lines[i][:len(lines[i]) - len(lines[i].lstrip())]
+			out.append(lines[i] if source is None else indent + source.strip())
+			i += 1
+			if i < len(lines) and TRACEBACK_MARKER_RE.match(lines[i]):
+				i += 1
+
+	return "\n".join(out)
+
+# an excepthook printing remapped tracebacks
+def excepthook(kind, value, tb):
+	text = "".join(traceback.format_exception(kind, value, tb))
+	sys.stderr.write(remap_traceback(text))
+
+def install():
+	sys.excepthook = excepthook
+
+def main():
+	parser = argparse.ArgumentParser(description="map profiles and tracebacks of transformed programs back to their source")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	stats_parser = commands.add_parser("stats", help="print a remapped cProfile profile")
+	stats_parser.add_argument("profile")
+	stats_parser.add_argument("--sort", default="cumulative", help="pstats sort key, default cumulative")
+	stats_parser.add_argument("-n", type=int, default=30, help="entries to print")
+
+	traceback_parser = commands.add_parser("traceback", help="remap a traceback")
+	traceback_parser.add_argument("file", nargs="?", help="file holding the traceback, stdin by default")
+
+	run_parser = commands.add_parser("run", help="run a transformed script, remapping its traceback")
+	run_parser.add_argument("script")
+	run_parser.add_argument("args", nargs=argparse.REMAINDER)
+
+	args = parser.parse_args()
+
+	match args.command:
+		case "stats":
+			stats = remap_stats(pstats.Stats(args.profile))
+			stats.sort_stats(args.sort).print_stats(args.n)
+		case "traceback":
+			if args.file is None:
+				text = sys.stdin.read()
+			else:
+				with open(args.file, "r") as f:
+					text = f.read()
+			sys.stdout.write(remap_traceback(text))
+		case "run":
+			sys.argv = [args.script] + args.args
+			sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+			install()
+			runpy.run_path(args.script, run_name="__main__")
+
+if __name__ == "__main__":
+	main()
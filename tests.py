@@ -1,4 +1,30 @@
+import io
+import os
+import json
+import sys
+import pstats
+import cProfile
+import tempfile
+import time
+import importlib
+import threading
+import traceback
 import ir
+import cache
+import transformer
+import sourcemap
+import incremental
+import importhook
+import server
+import client
+
+# transform and execute a program, returning its globals
+def transform_run(src: str, **options) -> dict:
+	prog = ir.Program(src, **options)
+	prog.transform()
+	namespace = {}
+	exec(prog.transpile(), namespace)
+	return namespace
 
 def test_tokenise_first():
 	# test the tokeniser to get the first identifier in various statements
@@ -27,6 +53,30 @@ def test_iter_to_identifers():
 		(True, ") "),
 		(False, "# comment"),
 	])
+	# prefixes, escapes, and triple quotes
+	driver("x = rb'\\'' + \"a\\\"b\" if '''it's''' else u\"\"", [
+		(True, "x = "),
+		(False, "rb'\\''"),
+		(True, " + "),
+		(False, "\"a\\\"b\""),
+		(True, " if "),
+		(False, "'''it's'''"),
+		(True, " else "),
+		(False, "u\"\""),
+	])
+	# a string never closed runs until the end
+	driver("x = 'a # b", [(True, "x = "), (False, "'a # b")])
+	# replacement fields of f-strings are code, but not their format specs
+	driver("f'{a and b!r:>{w}} {{not}} {c[\"d\"]}' or e", [
+		(False, "f'{"),
+		(True, "a and b"),
+		(False, "!r:>{w}} {{not}} {"),
+		(True, "c["),
+		(False, "\"d\""),
+		(True, "]"),
+		(False, "}'"),
+		(True, " or e"),
+	])
 
 def test_walk_expr_str():
 	# test walking a string to skip over an expression
@@ -42,12 +92,89 @@ def test_walk_expr_str():
 	# test when there's no expression to skip
 	driver("test(hello, 'along')", None)
 
+def test_split_expr_strs():
+	# test splitting on commas outside of parens, brackets and strings
+	assert ir.split_expr_strs("a, f(b, c), 'd, e'") == ["a", "f(b, c)", "'d, e'"]
+	assert ir.split_expr_strs("[1, 2], {3: 4}") == ["[1, 2]", "{3: 4}"]
+	assert ir.split_expr_strs("a") == ["a"]
+
+def test_fn_lambda_params():
+	# test converting function parameters into lambda parameters and call arguments
+	assert ir.fn_lambda_params("") == ("", "")
+	assert ir.fn_lambda_params("a, b: int = 2, *args, c, **kw") == (
+		"a, b=2, *args, c, **kw",
+		"a, b, *args, c=c, **kw",
+	)
+	assert ir.fn_lambda_params("a, /, b, *, c=3") == ("a, /, b, *, c=3", "a, b, c=c")
+
 def test_rstrip_str():
 	# test stripping a specific suffix from a string
 	assert ir.rstrip_str("for guess in range(1, 101):  # Simulating guesses from 1 to 100", ":") == "for guess in range(1, 101)"
 	# test when there's no suffix to strip
 	assert ir.rstrip_str("none at all", ":") == "none at all"
 
+def test_transform_expr():
+	# test rewriting every keyword of an expression, outside of strings and comments
+	def driver(src: str, expected: str, helpers: list):
+		prog = ir.Program("", short_circuit=False)
+		node = ir.IRUnit(src)
+		prog.transform_expr(node)
+		assert node.src == expected
+		for kind, (_, flag) in ir.EXPR_KEYWORDS.items():
+			assert getattr(prog, flag) == (kind in helpers), flag
+
+	driver("a + b", "a + b", [])
+	driver(
+		"a and not b or c not  in d in 'and' # or",
+		"a ^_and^ _not& b |_or| c &_notin& d &_in& 'and' # or",
+		['and', 'not', 'or', 'not_in', 'in'],
+	)
+	driver("notin(index, android) or f'{x in y}'", "notin(index, android) |_or| f'{x &_in& y}'", ['or', 'in'])
+
+def test_ir_slots():
+	# IR nodes are slotted, without a `__dict__` per instance
+	for cls in ir.IRNode.__args__:
+		assert '__slots__' in vars(cls), cls
+		assert '__dict__' not in dir(cls), cls
+
+def test_annotate():
+	# test the facts about loops and functions, computed in one walk
+	prog = ir.Program(
+		"def f(x):\n"
+		"	while x:\n"
+		"		for i in x:\n"
+		"			if i:\n"
+		"				return i\n"
+		"		while True:\n"
+		"			if x:\n"
+		"				break\n"
+		"	def g():\n"
+		"		pass\n"
+		"while True:\n"
+		"	def h():\n"
+		"		while True:\n"
+		"			break\n"
+	)
+	prog.annotate(prog.program)
+	f, outer = prog.program
+	f_while = f.body[0]
+	f_for, f_inner = f_while.body
+	g = f.body[1]
+	h = outer.body[0]
+
+	assert f.facts == ir.IRFacts(has_break=False, has_return=True)
+	assert f_while.facts == ir.IRFacts(has_break=False, has_return=False)
+	assert f_for.facts == ir.IRFacts(has_break=False, has_return=False)
+	assert f_inner.facts == ir.IRFacts(has_break=True, has_return=False)
+	assert g.facts == ir.IRFacts(has_break=False, has_return=False)
+	# the break inside of `h` doesn't end the outer loop
+	assert outer.facts == ir.IRFacts(has_break=False, has_return=False)
+	assert h.body[0].facts == ir.IRFacts(has_break=True, has_return=False)
+
+	# computed on demand for nodes that weren't annotated
+	loop = ir.IRWhile(ir.IRUnit("True"), [ir.IRBreak()])
+	assert prog.node_facts(loop).has_break
+
 def test_program_identity():
 	# test parsing and transpilation identity for various code snippets
 	def driver(src: str):
@@ -76,8 +203,8 @@ def test_program_identity():
 
 def test_program_transformations():
 	# test stmt level transformations without transforming expressions	
-	def driver(src: str, expected: str):
-		prog = ir.Program(src)
+	def driver(src: str, expected: str, **options):
+		prog = ir.Program(src, **options)
 		prog.program = prog.transform_stmts_recurse(prog.program)
 		assert expected == prog.transpile()
 	
@@ -94,17 +221,33 @@ def test_program_transformations():
 	driver(
 		(
 			"def test():\n"
-			"	pass"
+			"	if a:\n"
+			"		return 1"
 		),
 		(
 			"def _test0():\n"
 			"	global _ret_test0\n"
 			"	_ret_test0 = None\n"
-			"	pass\n"
+			"	if a:\n"
+			"		_ret_test0 = 1\n"
+			"		yield\n"
 			"	yield\n"
 			"test = lambda : (next(_test0()), _ret_test0)[1]"
 		)
 	)
+	# a function without a `return` has no return slot
+	driver(
+		(
+			"def test():\n"
+			"	pass"
+		),
+		(
+			"def _test0():\n"
+			"	pass\n"
+			"	yield\n"
+			"test = lambda : next(_test0())"
+		)
+	)
 
 	# test transforming a break statement and else
 	driver(
@@ -149,10 +292,1049 @@ def test_program_transformations():
 		)
 	)
 
+	# test transforming a for loop, without exception handling
+	driver(
+		(
+			"vals = {'a': 1, 'b': 2, 'c': 3}\n"
+			"for k, v in vals.items():\n"
+			"	print(k, v)"
+		),
+		(
+			"_forend = object()\n"
+			"vals = {'a': 1, 'b': 2, 'c': 3}\n"
+			"_iter0 = iter(vals.items())\n"
+			"_for0 = True\n"
+			"while _for0:\n"
+			"	if (_next0 := next(_iter0, _forend)) is _forend:\n"
+			"		_for0 = False\n"
+			"		continue \n"
+			"	k, v = _next0\n"
+			"	print(k, v)"
+		),
+		for_lowering="sentinel",
+	)
+
+def test_program_membership():
+	# test `in` and `not in` dispatching to the container's `__contains__`
+	namespace = transform_run(
+		"class Only42:\n"
+		"	__contains__ = lambda self, v: v == 42\n"
+		"	__iter__ = lambda self: iter(range(10 ** 9))\n"
+		"a = 3 in {1, 2, 3}\n"
+		"b = 'k' in {'k': 1}\n"
+		"c = 5 not in range(3)\n"
+		"d = 42 in Only42()\n"
+		"e = 'ell' in 'hello'\n"
+		"f = 7 not in [1, 2, 7]"
+	)
+	assert namespace['a'] is True
+	assert namespace['b'] is True
+	assert namespace['c'] is True
+	assert namespace['d'] is True
+	assert namespace['e'] is True
+	assert namespace['f'] is False
+
+def test_program_bool_operators():
+	# test `and`, `or` and `not` keeping Python's value semantics
+	namespace = transform_run(
+		"a = 0 and 1\n"
+		"b = 2 and 3\n"
+		"c = False and 1\n"
+		"d = 0 or []\n"
+		"e = 'x' or 1\n"
+		"f = True or 1\n"
+		"g = not 0\n"
+		"h = not not 0\n"
+		"i = not not not 'x'\n"
+		"j = not 1\n"
+		"k = (1 and 0) or (None or 5)\n"
+		"l = f'{0 or 1:>{2}} {\"and\" in \"or\"} {{not}}'"
+	)
+	assert namespace['a'] == 0
+	assert namespace['b'] == 3
+	assert namespace['c'] is False
+	assert namespace['d'] == []
+	assert namespace['e'] == 'x'
+	assert namespace['f'] is True
+	assert namespace['g'] is True
+	assert namespace['h'] is False
+	assert namespace['i'] is False
+	assert namespace['j'] is False
+	assert namespace['k'] == 5
+	assert namespace['l'] == ' 1 False {not}'
+
+def test_program_fn_lowering():
+	# test lowering functions through the generator protocol, without globals
+	prog = ir.Program(
+		(
+			"def test(a, b=2):\n"
+			"	return a + b"
+		),
+		fn_lowering="yield",
+	)
+	prog.program = prog.transform_stmts_recurse(prog.program)
+	assert prog.transpile() == (
+		"def _test0(a, b=2):\n"
+		"	yield a + b\n"
+		"	yield\n"
+		"test = lambda a, b=2 : next(_test0(a, b))"
+	)
+
+	# test recursion, default arguments and bare returns in both modes
+	for fn_lowering in ("global", "yield"):
+		namespace = transform_run(
+			(
+				"def fib(n, base=1):\n"
+				"	if n < 2:\n"
+				"		return base\n"
+				"	return fib(n - 1, base) + fib(n - 2, base)\n"
+				"def nothing():\n"
+				"	return\n"
+				"a = fib(10)\n"
+				"b = fib(10, 2)\n"
+				"c = nothing()"
+			),
+			fn_lowering=fn_lowering,
+		)
+		assert namespace['a'] == 89
+		assert namespace['b'] == 178
+		assert namespace['c'] is None
+		assert ('_ret_fib0' in namespace) == (fn_lowering == "global")
+
+def test_program_for_lowering():
+	# test for loops, breaks and the loop variable after exit in both modes
+	for for_lowering in ("sentinel", "except"):
+		namespace = transform_run(
+			(
+				"total = 0\n"
+				"for i in [3, None, 4]:\n"
+				"	if i == None:\n"
+				"		continue\n"
+				"	total += i\n"
+				"for k, v in {'a': 1, 'b': 2}.items():\n"
+				"	if v == 2:\n"
+				"		break\n"
+				"for e in []:\n"
+				"	total = -1\n"
+				"range = lambda n: [5, 6]\n"
+				"for r in range(10):\n"
+				"	total += r"
+			),
+			for_lowering=for_lowering,
+		)
+		assert namespace['total'] == 18
+		assert namespace['i'] == 4
+		assert (namespace['k'], namespace['v']) == ('b', 2)
+		assert 'e' not in namespace
+		assert namespace['r'] == 6
+
+def test_transpile_to():
+	# test writing to a sink in chunks, matching `transpile()` exactly
+	def driver(src: str):
+		prog = ir.Program(src)
+		prog.transform()
+		for chunk_lines in (1, 2, 3, 1024):
+			sink = io.StringIO()
+			prog.transpile_to(sink, chunk_lines)
+			assert sink.getvalue() == prog.transpile()
+
+	driver("")
+	driver("print(1)")
+	driver(
+		"def f(x):\n"
+		"	for i in x:\n"
+		"		if i and not i in x:\n"
+		"			break\n"
+		"	return x\n"
+		"print(f([1, 2]))"
+	)
+
+def test_program_stats():
+	# test the statistics of a transformed program
+	prog = ir.Program(
+		"x = 1\n"
+		"for i in y:\n"
+		"	if i and not z:\n"
+		"		break\n"
+	)
+	prog.transform()
+	src = prog.transpile()
+	stats = prog.stats()
+
+	assert set(stats['timings']) == {'parse', 'annotate', 'stmts', 'peephole', 'exprs', 'transpile'}
+	assert stats['input_lines'] == 4
+	assert stats['output_lines'] == src.count("\n") + 1
+	assert stats['line_ratio'] == stats['output_lines'] / 4
+	assert stats['input_nodes'] == {'IRVerbatim': 1, 'IRFor': 1, 'IRIf': 1, 'IRBreak': 1}
+	assert 'IRFor' not in stats['output_nodes'] and stats['output_nodes']['IRWhile'] == 1
+	assert stats['temps'] == {'iter': 1, 'for': 1}
+	assert stats['helpers'] == {'in': False, 'notin': False, 'and': True, 'or': False, 'not': True, 'andsc': False, 'orsc': False, 'for': False}
+	assert stats['fast_path_bytes'] == len("x = 1")
+
+def test_transformer_batch():
+	# test transforming a directory tree, continuing past broken files
+	with tempfile.TemporaryDirectory() as root:
+		os.makedirs(os.path.join(root, "pkg", "__pycache__"))
+		files = {
+			"a.py": "x = 1 and 2",
+			"pkg/b.py": "assert x",
+			"pkg/broken.py": "for x:\n	pass",
+			"pkg/notes.txt": "and",
+			"pkg/__pycache__/c.py": "and",
+		}
+		for name, src in files.items():
+			with open(os.path.join(root, name), "w") as f:
+				f.write(src)
+
+		found = transformer.collect_files([root], ["*.py"], [])
+		assert [os.path.relpath(path, root) for path in found] == ["a.py", "pkg/b.py", "pkg/broken.py"]
+		found = transformer.collect_files([root], ["*.py"], ["pkg/*"])
+		assert [os.path.relpath(path, root) for path in found] == ["a.py"]
+
+		results = list(transformer.transform_batch(transformer.collect_files([root], ["*.py"], []), 2))
+		assert [error is None for _, _, _, error, _ in results] == [True, True, False]
+		with open(os.path.join(root, "a.py"), "r") as f:
+			assert f.read().endswith("x = 1 ^_and^ 2")
+		with open(os.path.join(root, "pkg/broken.py"), "r") as f:
+			assert f.read() == files["pkg/broken.py"]
+
+def test_transform_cache():
+	# test hits, misses, keys covering options, and eviction of the cache
+	with tempfile.TemporaryDirectory() as root:
+		tcache = cache.TransformCache(root)
+		src = "x = a and b"
+
+		first = transformer.transform_source(src, tcache)
+		assert (tcache.hits, tcache.misses) == (0, 1)
+		assert transformer.transform_source(src, tcache) == first
+		assert (tcache.hits, tcache.misses) == (1, 1)
+
+		assert tcache.key(src, {}) != tcache.key(src, {'fn_lowering': 'yield'})
+		assert tcache.key(src, {}) != tcache.key(src + " ", {})
+
+		# the first entry is the least recently used, evicted first
+		old_key = tcache.key("old", {})
+		new_key = tcache.key("new", {})
+		tcache.put(old_key, "x" * 100)
+		os.utime(tcache.entry_path(old_key), (0, 0))
+		tcache.put(new_key, "y" * 100)
+		tcache.max_bytes = 150
+		tcache.prune()
+		assert tcache.get(old_key) is None
+		assert tcache.get(new_key) == "y" * 100
+
+		tcache.clear()
+		assert tcache.stats()['entries'] == 0
+
+def test_iter_top_level_blocks():
+	# test grouping lines into top level blocks, keeping continuations together
+	lines = [
+		"import sys\n",
+		"if a:\n",
+		"	pass\n",
+		"\n",
+		"elif b:\n",
+		"	pass\n",
+		"# comment\n",
+		"else:\n",
+		"	pass\n",
+		"def f():\n",
+		"	return 1\n",
+	]
+	assert list(ir.iter_top_level_blocks(lines)) == [
+		["import sys"],
+		["if a:", "	pass", "", "elif b:", "	pass", "# comment", "else:", "	pass"],
+		["def f():", "	return 1"],
+	]
+
+def test_transform_stream():
+	# test streaming a program, matching the transformed program after the prelude
+	src = (
+		"def f(x):\n"
+		"	for i in range(x):\n"
+		"		if i in seen and not i:\n"
+		"			break\n"
+		"		elif i:\n"
+		"			continue\n"
+		"	return x or None\n"
+		"\n"
+		"while f(1):\n"
+		"	assert f(2)\n"
+		"	break\n"
+		"print(f(3))\n"
+	)
+	prog = ir.Program(src)
+	prog.transform()
+	body = "\n".join(prog.transpile_recurse(prog.program, 0))
+
+	sink = io.StringIO()
+	ir.transform_stream(io.StringIO(src), sink)
+	prelude = ir.Program("").transpile_prelude(all_helpers=True)
+	assert sink.getvalue() == prelude + body
+
+def test_parallel_blocks():
+	# test transforming top level blocks apart, the same output for any amount of workers
+	src = (
+		"def f(x):\n"
+		"	while x:\n"
+		"		if x in seen:\n"
+		"			break\n"
+		"		x -= 1\n"
+		"	return x and 1\n"
+		"\n"
+		"for i in range(3):\n"
+		"	assert not i or not f(i)\n"
+		"def f(x):\n"
+		"	return x or 2\n"
+		"def stop(x):\n"
+		"	return not x\n"
+		"for i in range(3):\n"
+		"	print(f(i), stop(i))\n"
+		"x = 1\n"
+	)
+	serial = transformer.transform_source(src)
+	# every block numbers its temporary variables from zero, functions are unique
+	assert "def _f0(x):" in serial and "def _f1(x):" in serial and "def _stop0(x):" in serial
+	assert serial.count("_iter0 = iter(range(3))") == 2
+
+	for jobs in (1, 2, 4):
+		new_src, prog = transformer.transform_source_parallel(src, jobs)
+		assert new_src == serial
+		assert prog.stats()['input_lines'] == 16
+		assert prog.stats()['helpers']['for'] == ir.Program(src).stats()['helpers']['for']
+
+	prog = ir.Program(src)
+	prog.transform()
+	sink = io.StringIO()
+	ir.transform_stream(io.StringIO(src), sink)
+	prelude = ir.Program("").transpile_prelude(all_helpers=True)
+	assert sink.getvalue() == prelude + serial[len(prog.transpile_prelude()):]
+
+	out = []
+	exec(serial, {'seen': [], 'print': lambda *args: out.append(args)})
+	assert out == [(2, True), (1, False), (2, False)]
+
+def test_incremental():
+	# test re-transforming only the changed blocks, the same output as the whole file
+	def driver(blocks: int, changed: int) -> str:
+		return "\n".join(
+			f"def f(x):\n\twhile x {'>' if i == changed else '<'} {i}:\n\t\tx += 1\n\treturn x and {i}\n"
+			for i in range(blocks)
+		)
+
+	src = driver(5, -1)
+	new_src, _, blocks, reused = incremental.transform_incremental(src, {})
+	assert new_src == transformer.transform_source(src) and reused == 0 and len(blocks) == 5
+
+	src = driver(5, 2)
+	new_src, prog, new_blocks, reused = incremental.transform_incremental(src, blocks)
+	assert new_src == transformer.transform_source(src) and reused == 4
+	assert prog.stats()['helpers']['and'] and "def _f4(x):" in new_src
+
+	with tempfile.TemporaryDirectory() as root:
+		path = os.path.join(root, "a.py")
+		state_path = os.path.join(root, "state.json")
+		for changed, expected in ((-1, 0), (3, 4), (3, 5)):
+			with open(path, "w") as f:
+				f.write(driver(5, changed))
+			stats = transformer.write_incremental(path, driver(5, changed), state_path)
+			assert stats['reused_blocks'] == expected
+			with open(path, "r") as f:
+				assert f.read() == transformer.transform_source(driver(5, changed))
+
+		# another set of options can't reuse the blocks
+		assert incremental.read_state(state_path, {}) != {}
+		assert incremental.read_state(state_path, {'keywords': ['and']}) == {}
+
+def test_program_deep_nesting():
+	# parsing, transforming and transpiling nest past the recursion limit
+	depth = 5000
+	lines = [("\t" * i) + f"if a{i} and not b:" for i in range(depth)]
+	lines += [
+		("\t" * depth) + "while x in y:",
+		("\t" * (depth + 1)) + "break",
+		"# comments don't close blocks",
+		("\t" * depth) + "assert c or d",
+		"print(1)",
+	]
+	prog = ir.Program("\n".join(lines))
+	prog.transform()
+	code = prog.transpile_recurse(prog.program, 0)
+
+	indent = "\t" * depth
+	assert len(code) == depth + 8
+	assert code[0] == "if a0 ^_and^ _not& b:"
+	assert code[depth - 1] == ("\t" * (depth - 1)) + f"if a{depth - 1} ^_and^ _not& b:"
+	assert code[depth:] == [
+		indent + "_while0 = True",
+		indent + "while _andsc(_while0, lambda _sc: (x &_in& y)):",
+		indent + "\t_while0 = False",
+		indent + "\tcontinue ",
+		indent + "\t# comments don't close blocks",
+		indent + "if _not& (c |_or| d):",
+		indent + "\traise AssertionError",
+		"print(1)",
+	]
+
+def test_program_comment_indent():
+	# a comment outside of the indentation of a block stays inside it
+	ns = transform_run(
+		"def f(x):\n"
+		"	if x:\n"
+		"		x += 1\n"
+		"# a comment\n"
+		"		x *= 2\n"
+		"# another comment\n"
+		"	return x\n"
+		"v = f(1)\n"
+	)
+	assert ns['v'] == 4
+
+def test_scan_keywords():
+	# test finding forbidden keywords in code, never in strings or comments
+	assert ir.scan_keywords("x = 1") == set()
+	assert ir.scan_keywords("x = 'a and b' # or not") == set()
+	assert ir.scan_keywords("x = f'{a and b}'") == {'and'}
+	assert ir.scan_keywords("for_ = index or notice") == {'or'}
+	assert ir.scan_keywords("def f():\n\treturn x") == {'def', 'return'}
+	assert not ir.has_keywords("x = 'in' # in")
+	assert ir.has_keywords("x = 'in' if y in z")
+
+def test_program_fast_path():
+	# test copying blocks without forbidden keywords verbatim
+	src = (
+		"import sys\n"
+		"\n"
+		"x = {\n"
+		"    'a': 1,   \n"
+		"}\n"
+		"while x:\n"
+		"    print('and or not')\n"
+	)
+	prog = ir.Program(src)
+	prog.transform()
+	assert prog.transpile() == src
+	assert prog.stats()['fast_path_bytes'] == len(src)
+	assert prog.stats()['input_nodes'] == {'IRVerbatim': 1}
+
+	# only the blocks with keywords are parsed and transformed
+	src = (
+		"x = [1,\n"
+		"     2]\n"
+		"if a and b:\n"
+		"\tpass\n"
+		"y = 1\n"
+	)
+	prog = ir.Program(src)
+	prog.transform()
+	assert prog.transpile().endswith(
+		"x = [1,\n"
+		"     2]\n"
+		"if a ^_and^ b:\n"
+		"\tpass\n"
+		"y = 1\n"
+	)
+	assert prog.stats()['input_nodes'] == {'IRVerbatim': 2, 'IRIf': 1, 'IRUnit': 1}
+
+	# without the fast path every line is parsed
+	prog = ir.Program(src, fast_path=False)
+	prog.transform()
+	assert prog.transpile().endswith("x = [1,\n2]\nif a ^_and^ b:\n\tpass\ny = 1")
+	assert prog.stats()['fast_path_bytes'] == 0
+
+def test_peephole():
+	# test cleaning up after the statement transformations, the same behaviour with and without
+	def driver(src: str, expected: str, keywords: list, **options):
+		prog = ir.Program(src, keywords=keywords, **options)
+		prog.transform()
+		assert prog.transpile_recurse(prog.program, 0) == expected.split("\n")
+		prog = ir.Program(src, keywords=keywords, peephole=False, **options)
+		prog.transform()
+		assert prog.transpile_recurse(prog.program, 0) != expected.split("\n")
+
+	# branches leaving the block and the last branch don't clear the flag
+	driver(
+		"if a:\n"
+		"	raise E\n"
+		"elif b:\n"
+		"	x()\n"
+		"else:\n"
+		"	y()",
+		(
+		"_if0 = True\n"
+		"if a:\n"
+		"	raise E\n"
+		"if _if0 and (b):\n"
+		"	_if0 = False\n"
+		"	x()\n"
+		"if _if0:\n"
+		"	y()"
+		), ['elif', 'else']
+	)
+	# every branch but the last leaves the block, the `else` is inlined
+	driver(
+		"if a:\n"
+		"	raise E\n"
+		"elif b:\n"
+		"	raise F\n"
+		"else:\n"
+		"	y()",
+		(
+		"if a:\n"
+		"	raise E\n"
+		"if (b):\n"
+		"	raise F\n"
+		"y()"
+		), ['elif', 'else']
+	)
+	# a loop only leaving through a `break` at its end runs once
+	driver(
+		"while a:\n"
+		"	x()\n"
+		"	break",
+		(
+		"if (a):\n"
+		"	x()"
+		), ['break']
+	)
+	# `and (True)` is folded
+	driver(
+		"while True:\n"
+		"	if a:\n"
+		"		continue\n"
+		"	break",
+		(
+		"_while0 = True\n"
+		"while _while0:\n"
+		"	if a:\n"
+		"		continue\n"
+		"	_while0 = False\n"
+		"	continue "
+		), ['break']
+	)
+	# statements after one leaving the block are dropped, comments are kept
+	driver(
+		"def f(a):\n"
+		"	if a:\n"
+		"		return 1\n"
+		"		x()\n"
+		"		# done\n"
+		"	return 2",
+		(
+		"def _f0(a):\n"
+		"	if a:\n"
+		"		yield 1\n"
+		"		# done\n"
+		"	yield 2\n"
+		"f = lambda a : next(_f0(a))"
+		), ['return'], fn_lowering="yield"
+	)
+
+	# a statement split across lines leaves its block on its last line
+	src = (
+		"def f(a):\n"
+		"	if a:\n"
+		"		raise ValueError(\n"
+		"			'bad value')\n"
+		"	elif a == 0:\n"
+		"		return (\n"
+		"			1 + 2)\n"
+		"	return 3"
+	)
+	prog = ir.Program(src, fn_lowering="yield")
+	prog.transform()
+	scope = {}
+	exec(prog.transpile(), scope)
+	assert scope['f'](0) == 3 and scope['f'](None) == 3
+	try:
+		scope['f'](1)
+		assert False
+	except ValueError as e:
+		assert str(e) == 'bad value'
+
+def test_short_circuit():
+	# test `and` and `or` never evaluating a right operand they don't need
+	def driver(src: str, expected: str):
+		prog = ir.Program(src)
+		prog.transform()
+		assert prog.transpile_recurse(prog.program, 0) == expected.split("\n")
+
+	driver("x = a and b", "x = a ^_and^ b")
+	driver("x = a and f(b) or c", "x = _andsc(a, lambda _sc: f(b)) |_or| c")
+	driver("x = filter(lambda v: v or not v.y, a)", "x = filter(lambda v: _orsc(v, lambda _sc: _not& v.y), a)")
+	driver(
+		"if a and (b.c and d):\n"
+		"	pass",
+		"if a:\n"
+		"	if b.c:\n"
+		"		if d:\n"
+		"			pass"
+	)
+	# a class body can't be seen from a lambda
+	driver(
+		"class A:\n"
+		"	x = a and f(b)\n"
+		"	with c:\n"
+		"		y = a and f(b)\n"
+		"y = a and f(b)",
+		"class A:\n"
+		"	x = a ^_and^ f(b)\n"
+		"	with c:\n"
+		"		y = a ^_and^ f(b)\n"
+		"y = _andsc(a, lambda _sc: f(b))"
+	)
+	# a starred region is unpacked whole
+	driver("x = f(*a and [len(a)])", "x = f(*a ^_and^ [len(a)])")
+	driver("x = f(**opts or dict(a=1))", "x = f(**opts |_or| dict(a=1))")
+	driver("x = [*a, *b or c()]", "x = [*a, *b |_or| c()]")
+	# operands looking at their scope can't be moved into a lambda
+	driver("x = a and super().f()", "x = a ^_and^ super().f()")
+	driver("x = a and sorted(locals())", "x = a ^_and^ sorted(locals())")
+	driver("x = a or vars()", "x = a |_or| vars()")
+	driver("x = a or vars(b)", "x = _orsc(a, lambda _sc: vars(b))")
+	# an expression split across lines keeps the operators of its open lines
+	driver(
+		"x = (a and\n"
+		"     f(3))\n"
+		"y = [a or\n"
+		"     f(4), 5]\n"
+		"z = a and \\\n"
+		"	f(5)",
+		"x = (a ^_and^\n"
+		"f(3))\n"
+		"y = [a |_or|\n"
+		"f(4), 5]\n"
+		"z = a ^_and^ \\\n"
+		"f(5)"
+	)
+
+	src = (
+		"calls = []\n"
+		"def f(x):\n"
+		"	calls.append(x)\n"
+		"	return x\n"
+		"a = None\n"
+		"b = a is not None and a.y\n"
+		"c = f(0) and f(1) or f(2) and f(3)\n"
+		"d = list(filter(lambda x: x % 2 or f(x), range(4)))\n"
+		"e = 0\n"
+		"while e < 3 and f(e) != 1:\n"
+		"	e += 1\n"
+		"if f(4) and f(0) and f(5):\n"
+		"	pass\n"
+		"elif f(6) or f(7):\n"
+		"	g = f(8) or f(9)\n"
+		"else:\n"
+		"	pass"
+	)
+	native = {}
+	exec(src, native)
+	namespace = transform_run(src)
+	for name in "calls", "b", "c", "d", "e", "g":
+		assert namespace[name] == native[name], name
+
+	src = (
+		"def f(*args, **kwargs):\n"
+		"	return (args, kwargs)\n"
+		"x = [1]\n"
+		"opts = {}\n"
+		"j = f(*x and [len(x)], **opts or dict(a=1))"
+	)
+	native = {}
+	exec(src, native)
+	assert transform_run(src)['j'] == native['j'] == ((1,), {'a': 1})
+
+	src = (
+		"class A:\n"
+		"	def f(self):\n"
+		"		return 1\n"
+		"class B(A):\n"
+		"	def f(self):\n"
+		"		x = self and super().f()\n"
+		"		return x\n"
+		"def g(a):\n"
+		"	x = a and sorted(locals())\n"
+		"	return x\n"
+		"h = B().f()\n"
+		"i = g(1)"
+	)
+	native = {}
+	exec(src, native)
+	# methods returning aren't lowered, they'd be out of the class scope
+	namespace = transform_run(src, keywords=['and', 'or', 'not', 'in'])
+	assert (namespace['h'], namespace['i']) == (native['h'], native['i']) == (1, ['a'])
+
+def test_program_keywords():
+	# test running only the transformations for the forbidden keywords
+	def driver(src: str, expected: str, keywords: list):
+		prog = ir.Program(src, keywords=keywords)
+		prog.transform()
+		assert prog.transpile_recurse(prog.program, 0) == expected.split("\n")
+
+	src = (
+		"def f(x):\n"
+		"	for i in x:\n"
+		"		if i and not i in y:\n"
+		"			break\n"
+		"		elif i or i not in z:\n"
+		"			assert i\n"
+		"	return i"
+	)
+	driver(src, (
+		"def f(x):\n"
+		"	for i in x:\n"
+		"		if _andsc(i, lambda _sc: _not& i in y):\n"
+		"			break\n"
+		"		elif i or i &_notin& z:\n"
+		"			assert i\n"
+		"	return i"
+	), ['and'])
+	driver(src, (
+		"def f(x):\n"
+		"	for i in x:\n"
+		"		if i and _not& i in y:\n"
+		"			break\n"
+		"		elif i or i &_notin& z:\n"
+		"			assert i\n"
+		"	return i"
+	), ['not'])
+	driver(src, (
+		"def f(x):\n"
+		"	for i in x:\n"
+		"		if i and not i in y:\n"
+		"			break\n"
+		"		if (i or i not in z):\n"
+		"			if not (i):\n"
+		"				raise AssertionError\n"
+		"	return i"
+	), ['elif', 'assert'])
+	driver(
+		"def f(x):\n"
+		"	for i in range(10):\n"
+		"		if i:\n"
+		"			break",
+		(
+		"def f(x):\n"
+		"	_iter0 = iter(range(10))\n"
+		"	_for0 = True\n"
+		"	while _for0:\n"
+		"		try:\n"
+		"			i = next(_iter0)\n"
+		"		except StopIteration:\n"
+		"			_for0 = False\n"
+		"			continue \n"
+		"		if i:\n"
+		"			_for0 = False\n"
+		"			continue "
+		), ['break']
+	)
+	# `break` is only lowered in loops with one
+	driver(
+		"while a:\n"
+		"	for i in x:\n"
+		"		pass\n"
+		"	break",
+		(
+		"if (a):\n"
+		"	for i in x:\n"
+		"		pass"
+		), ['break']
+	)
+	driver(
+		"while a:\n"
+		"	for i in x:\n"
+		"		pass\n"
+		"	if b:\n"
+		"		break",
+		(
+		"_while0 = True\n"
+		"while _while0 and (a):\n"
+		"	for i in x:\n"
+		"		pass\n"
+		"	if b:\n"
+		"		_while0 = False\n"
+		"		continue "
+		), ['break']
+	)
+	# the `else` of a `try` or a loop is kept when if chains are
+	src = (
+		"try:\n"
+		"	x = a and b\n"
+		"except E:\n"
+		"	pass\n"
+		"else:\n"
+		"	x = b and a\n"
+		"while c and d:\n"
+		"	c = 0\n"
+		"else:\n"
+		"	c = d and c\n"
+		"for i in x:\n"
+		"	if i and c:\n"
+		"		break\n"
+		"else:\n"
+		"	i = c and d"
+	)
+	driver(src, src.replace(" and ", " ^_and^ "), ['and'])
+	namespace = transform_run(
+		"out = []\n"
+		"for i in [1, 2]:\n"
+		"	if i and i > 1:\n"
+		"		break\n"
+		"else:\n"
+		"	out.append('for')\n"
+		"try:\n"
+		"	pass\n"
+		"except E:\n"
+		"	pass\n"
+		"else:\n"
+		"	out.append('try' and 'else')",
+		keywords=['and'],
+	)
+	assert namespace['out'] == ['else']
+
+	# every combination behaves the same
+	src = (
+		"def f(n):\n"
+		"	out = []\n"
+		"	for i in range(n):\n"
+		"		if (i not in (3, 4)) and not i % 2:\n"
+		"			out.append(i)\n"
+		"		elif (i > 7) or (i in (5,)):\n"
+		"			break\n"
+		"		else:\n"
+		"			assert i, 'i'\n"
+		"	return out\n"
+		"v = f(20)\n"
+	)
+	for keyword in ir.KEYWORDS:
+		assert transform_run(src, keywords=[keyword])['v'] == [0, 2]
+	assert transform_run(src, keywords=[])['v'] == [0, 2]
+	assert transform_run(src)['v'] == [0, 2]
+
+	# blocks without the forbidden keywords are copied verbatim
+	prog = ir.Program("for i in x:\n    print(i)\n", keywords=['and'])
+	prog.transform()
+	assert prog.transpile() == "for i in x:\n    print(i)\n"
+	assert ir.scan_keywords("for i in x: return", ir.keywords_re(['return'])) == {'return'}
+
+	# the keywords file is separated by whitespace or commas
+	with tempfile.TemporaryDirectory() as root:
+		path = os.path.join(root, "keywords.txt")
+		with open(path, "w") as f:
+			f.write("or, and\nnot\n")
+		assert transformer.read_keywords(path) == ['and', 'not', 'or']
+
+def test_source_map():
+	# test mapping every transformed line back to the line it came from
+	src = (
+		"x = 1\n"
+		"def f(v):\n"
+		"	for i in v:\n"
+		"		if i:\n"
+		"			break\n"
+		"		elif not i:\n"
+		"			pass\n"
+		"	return i\n"
+	)
+	prog = ir.Program(src)
+	prog.transform()
+	lines = prog.transpile().split("\n")
+	source_map = prog.source_map()
+	assert len(source_map['lines']) == len(lines)
+	assert source_map['names'] == {'_f0': 'f'}
+	assert source_map['source'] == src.split("\n")
+
+	mapped = dict(zip(lines, source_map['lines']))
+	assert mapped["x = 1"] == 1
+	assert mapped["def _f0(v):"] == 2
+	assert mapped["f = lambda v : (next(_f0(v)), _ret_f0)[1]"] == 2
+	assert mapped["	_iter0 = iter(v)"] == 3
+	assert mapped["			_for0 = False"] == 5
+	assert mapped["		if (_not& i):"] == 6
+	assert mapped["	_ret_f0 = i"] == 8
+	assert all(line == 0 for line in source_map['lines'][:lines.index("x = 1")])
+
+	# tracebacks and profiles of the transformed file point into the source
+	with tempfile.TemporaryDirectory() as root:
+		path = os.path.join(root, "mod.py")
+		src = (
+			"def check(x):\n"
+			"	assert x and x > 0, 'positive'\n"
+			"	return x\n"
+			"check(1)\n"
+			"check(-1)\n"
+		)
+		with open(path, "w") as f:
+			f.write(src)
+		transformer.write_transformed(path, src, source_map=True)
+
+		profile = cProfile.Profile()
+		namespace = {}
+		try:
+			with open(path, "r") as f:
+				profile.runctx(compile(f.read(), path, "exec"), namespace, namespace)
+		except AssertionError:
+			text = traceback.format_exc()
+		else:
+			assert False, "expected an AssertionError"
+
+		text = sourcemap.remap_traceback(text)
+		assert f'File "{path}", line 5, in <module>\n    check(-1)' in text
+		assert f'File "{path}", line 2, in check\n    assert x and x > 0, \'positive\'' in text
+
+		stats = sourcemap.remap_stats(pstats.Stats(profile))
+		assert (path, 1, 'check') in stats.stats
+		assert any(name.startswith("prelude:") for file, _, name in stats.stats if file == path)
+
+def test_import_hook():
+	# test importing modules transformed, from the bytecode cache once cached
+	src = (
+		"def f(x):\n"
+		"	for i in range(x):\n"
+		"		if i > 2 and i % 2:\n"
+		"			return i\n"
+	)
+	with tempfile.TemporaryDirectory() as root:
+		package = os.path.join(root, "hookpkg")
+		os.makedirs(package)
+		with open(os.path.join(package, "__init__.py"), "w") as f:
+			f.write("from hookpkg.mod import f\n")
+		with open(os.path.join(package, "mod.py"), "w") as f:
+			f.write(src)
+
+		def driver(expected: int, hits: int, misses: int):
+			for name in ("hookpkg", "hookpkg.mod"):
+				sys.modules.pop(name, None)
+			importlib.invalidate_caches()
+			module = importlib.import_module("hookpkg")
+			assert module.f(10) == expected
+			assert "_f0" in vars(module.mod) # lowered
+			assert finder.stats() == {'hits': hits, 'misses': misses}
+			cached = [name for name in os.listdir(os.path.join(package, "__pycache__")) if name.startswith("mod.")]
+			assert len(cached) == 1 and ".lt-" in cached[0]
+
+		dont_write_bytecode = sys.dont_write_bytecode
+		sys.dont_write_bytecode = False
+		sys.path.insert(0, root)
+		finder = importhook.install([root])
+		try:
+			driver(3, 0, 2)
+			driver(3, 2, 2)
+			# a changed source replaces its entry
+			with open(os.path.join(package, "mod.py"), "w") as f:
+				f.write(src.replace("i > 2", "i > 4"))
+			driver(5, 3, 3)
+		finally:
+			importhook.uninstall(finder)
+			sys.path.remove(root)
+			sys.dont_write_bytecode = dont_write_bytecode
+			for name in ("hookpkg", "hookpkg.mod"):
+				sys.modules.pop(name, None)
+
+		# the source is never touched
+		with open(os.path.join(package, "mod.py"), "r") as f:
+			assert f.read() == src.replace("i > 2", "i > 4")
+
+	# the transformer's own modules are never claimed, even under a root
+	finder = importhook.TransformFinder([os.path.dirname(os.path.abspath(ir.__file__))])
+	for name in ("ir", "cache", "json", "__hello__", "sys"):
+		assert finder.find_spec(name) is None, name
+
+def test_server():
+	# test serving requests over JSON lines, and over a socket with the client
+	with tempfile.TemporaryDirectory() as root:
+		path = os.path.join(root, "a.py")
+		with open(path, "w") as f:
+			f.write("x = a and b")
+
+		transform_server = server.TransformServer(1)
+		try:
+			out = []
+			server.serve_stream(transform_server, [
+				'{"id": 1, "src": "y = not b"}\n',
+				f'{{"id": 2, "path": "{path}"}}\n',
+				'{"id": 3, "path": "missing.py"}\n',
+				'{"id": 4, "src": "x", "keywords": ["def"]}\n',
+				'[1]\n',
+				'\n',
+				'{"id": 5, "src": "x", "keywords": 5}\n',
+				'{"id": 6, "src": "x", "keywords": null}\n',
+				'{"id": 7, "src": "x", "keywords": "and"}\n',
+			], out.append)
+			responses = {response['id']: response for response in map(json.loads, out)}
+			assert len(out) == 8
+			for id in 5, 6, 7:
+				assert responses[id]['error'] == "bad request: keywords are a list of strings"
+			assert responses[1]['src'].endswith("y = _not& b") and responses[1]['error'] is None
+			assert responses[2]['error'] is None and responses[2]['lines'] == 1
+			assert responses[3]['error'].startswith("FileNotFoundError")
+			assert responses[4]['error'].startswith("can't remove def")
+			assert responses[None]['error'].startswith("bad request")
+			assert transform_server.stats()['requests'] == 8
+			assert transform_server.stats()['failures'] == 6
+			with open(path, "r") as f:
+				assert f.read().endswith("x = a ^_and^ b")
+
+			sock_path = os.path.join(root, "server.sock")
+			thread = threading.Thread(target=server.serve_socket, args=(transform_server, sock_path))
+			thread.start()
+			try:
+				for _ in range(100):
+					if os.path.exists(sock_path):
+						break
+					time.sleep(0.05)
+				responses = client.request(sock_path, [{'src': "z = a or b"}, {'op': 'stats'}])
+				assert responses[0]['src'].endswith("z = a |_or| b")
+				assert responses[1]['requests'] >= 8 and 'p50_ms' in responses[1]
+			finally:
+				client.request(sock_path, [{'op': 'shutdown'}])
+				thread.join()
+			assert not os.path.exists(sock_path)
+		finally:
+			transform_server.close()
+
+		# the cache stays within its bound
+		cache_path = os.path.join(root, "cache")
+		transform_server = server.TransformServer(1, cache_path=cache_path, cache_bytes=0)
+		try:
+			out = []
+			server.serve_stream(transform_server, ['{"id": 1, "src": "x = a and b"}\n', '{"id": 2, "src": "x = a or b"}\n'], out.append)
+			assert len(out) == 2 and cache.TransformCache(cache_path).stats()['entries'] == 2
+		finally:
+			transform_server.close()
+		assert cache.TransformCache(cache_path).stats()['entries'] == 0
+
 if __name__ == "__main__":
 	test_tokenise_first()
 	test_iter_to_identifers()
 	test_walk_expr_str()
+	test_split_expr_strs()
+	test_fn_lambda_params()
 	test_rstrip_str()
+	test_transform_expr()
+	test_ir_slots()
+	test_annotate()
 	test_program_identity()
 	test_program_transformations()
+	test_program_membership()
+	test_program_bool_operators()
+	test_program_fn_lowering()
+	test_program_for_lowering()
+	test_transpile_to()
+	test_program_stats()
+	test_transformer_batch()
+	test_transform_cache()
+	test_iter_top_level_blocks()
+	test_transform_stream()
+	test_parallel_blocks()
+	test_incremental()
+	test_program_deep_nesting()
+	test_program_comment_indent()
+	test_scan_keywords()
+	test_program_fast_path()
+	test_peephole()
+	test_short_circuit()
+	test_program_keywords()
+	test_source_map()
+	test_import_hook()
+	test_server()
@@ -1,5 +1,17 @@
+import os
 import sys
+import json
+import time
+import fnmatch
+import shutil
+import argparse
+import tempfile
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from ir import *
+from cache import TransformCache
+from sourcemap import write_source_map
+from incremental import read_state, write_state, transform_incremental
 
 # --- Just. Remove. Everything.
 #
@@ -11,10 +23,353 @@ from ir import *
 # python3 transformer.py <path_to_python_script.py> <keywords_text_file.txt>
 #         ^^^^^^^^^^^^^^ ^^^^^^^^^^^^^^^^^^^^^^^^^^ ^^^^^^^^^^^^^^^^^^^^^^^^
 #         argv[0]        argv[1]                    argv[2]
+#
+#         the keywords file lists the forbidden keywords, separated by
+#         whitespace or commas. only the transformations removing them
+#         are run, without it every keyword is removed.
+#
+# python3 transformer.py --keywords <keywords_text_file.txt> ...
+#
+#         the same, for --batch and --stream
+#
+# python3 transformer.py -j N <path_to_python_script.py> ...
+#
+#         transform the top level blocks of a single file in a pool of N
+#         processes, the same output as with one
+#
+# python3 transformer.py --incremental STATE <path_to_python_script.py> ...
+#
+#         only transform the top level blocks that changed since the run
+#         that wrote STATE, see `incremental.py`
+#
+# python3 transformer.py --batch [-j N] [--include GLOB] [--exclude GLOB] <paths...>
+#
+#         transforms every file, and every matching file under the
+#         directories in place, using a pool of N processes.
+#
+# python3 transformer.py --cache DIR [--cache-size MB] [--cache-clear] ...
+#
+#         reuse transformed sources from an on-disk cache, see `cache.py`
+#
+# python3 transformer.py --stream ...
+#
+#         transform one top level block at a time, never holding the
+#         whole file in memory, see `ir.transform_stream`
+#
+# python3 transformer.py --source-map ...
+#
+#         write a source map next to every transformed file, mapping its
+#         lines back to the source, see `sourcemap.py`
+#
+# python3 transformer.py --stats PATH ...
+#
+#         dump the statistics of every transformed file as JSON,
+#         keyed by path, see `Program.stats`
+
+# read the forbidden keywords from a keywords file
+def read_keywords(path: str) -> List[str]:
+	with open(path, "r") as f:
+		return sorted(set(f.read().replace(",", " ").split()))
+
+# transform a Python source string, reusing and filling the cache if given
+def transform_source(src: str, cache: TransformCache | None = None, **options) -> str:
+	if cache is not None:
+		key = cache.key(src, options)
+		new_src = cache.get(key)
+		if new_src is not None:
+			return new_src
+
+	program = Program(src, **options)
+	program.transform()
+	new_src = program.transpile()
+
+	if cache is not None:
+		cache.put(key, new_src)
+	return new_src
+
+# split the top level blocks of a source into about `tasks` runs of
+# consecutive blocks, each (line_offset, lines, temps) as taken by
+# `ir.transform_blocks`. the counters are taken from `program`.
+def split_blocks(src: str, program: Program, tasks: int) -> List[List[Tuple[int, List[str], Dict[str, int]]]]:
+	lines = src.split("\n")
+	task_lines = max(1, len(lines) // tasks)
+	runs = []
+	run = []
+	run_lines = 0
+	line_offset = 0
+	for block in iter_top_level_blocks(lines):
+		run.append((line_offset, block, program.begin_block(block)))
+		line_offset += len(block)
+		run_lines += len(block)
+		if run_lines >= task_lines:
+			runs.append(run)
+			run = []
+			run_lines = 0
+	if run:
+		runs.append(run)
+	return runs
+
+# transform a Python source string in a pool of N processes, a few runs
+# of top level blocks for every worker. temporary variables are numbered
+# per block, the output is the same as `transform_source` for any amount
+# of workers.
+#
+# returns the new source, and the program holding the helpers and the
+# statistics of every block. the IR isn't kept, there are no output
+# nodes or source map.
+def transform_source_parallel(src: str, jobs: int, **options) -> Tuple[str, Program]:
+	program = Program("", **options)
+	runs = split_blocks(src, program, jobs * 4)
+
+	if jobs > 1 and len(runs) > 1:
+		with ProcessPoolExecutor(max_workers=min(jobs, len(runs))) as pool:
+			results = list(pool.map(functools.partial(transform_blocks, **options), runs))
+	else:
+		results = [transform_blocks([block for run in runs for block in run], **options)]
+
+	lines = []
+	for run_lines, state in results:
+		lines += run_lines
+		program.merge(state)
+
+	prelude = program.transpile_prelude()
+	program.input_lines = src.count("\n") + (src.rpartition("\n")[2] != "")
+	program.output_lines = prelude.count("\n") + len(lines)
+	return prelude + "\n".join(lines), program
+
+# transform a Python source string, writing it to a file. the file is only
+# opened once transformed, the output is emitted straight into it.
+#
+# returns the statistics of the program, None if taken from the cache.
+# with `source_map`, the source map is written next to the file. with
+# more than one job, it's transformed with `transform_source_parallel`.
+def write_transformed(path: str, src: str, cache: TransformCache | None = None, source_map: bool = False, jobs: int = 1, **options) -> dict | None:
+	if cache is not None:
+		key = cache.key(src, options)
+		new_src = cache.get(key)
+		if new_src is not None:
+			with open(path, "w") as f:
+				f.write(new_src)
+			return None
+
+	if jobs > 1:
+		assert not source_map
+		new_src, program = transform_source_parallel(src, jobs, **options)
+		if cache is not None:
+			cache.put(key, new_src)
+		with open(path, "w") as f:
+			f.write(new_src)
+		return program.stats()
+
+	program = Program(src, **options)
+	program.transform()
+
+	if cache is not None:
+		new_src = program.transpile()
+		cache.put(key, new_src)
+		with open(path, "w") as f:
+			f.write(new_src)
+	else:
+		with open(path, "w") as f:
+			program.transpile_to(f)
+
+	if source_map:
+		write_source_map(path, program.source_map())
+	return program.stats()
+
+# transform a Python source string into a file, reusing the blocks of the
+# state file and writing the new state. returns the statistics of the
+# program, along with the amount of blocks reused.
+def write_incremental(path: str, src: str, state_path: str, **options) -> dict:
+	blocks = read_state(state_path, options)
+	new_src, program, new_blocks, reused = transform_incremental(src, blocks, **options)
+	with open(path, "w") as f:
+		f.write(new_src)
+	write_state(state_path, new_blocks, options)
+	return {**program.stats(), 'reused_blocks': reused}
+
+# transform a file in place by streaming it into a temporary file next
+# to it, replacing the original once done. returns the amount of lines,
+# and the statistics of the program.
+def transform_file_stream(path: str, **options) -> Tuple[int, dict]:
+	lines = 0
+	def count_lines(f):
+		nonlocal lines
+		for line in f:
+			lines += 1
+			yield line
+
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".transform")
+	try:
+		with open(path, "r") as f, os.fdopen(fd, "w") as sink:
+			program = transform_stream(count_lines(f), sink, **options)
+		shutil.copymode(path, tmp_path)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+	return (lines, program.stats())
+
+# transform a file in place, returning (path, lines, cached, error, stats).
+# the file is only written once transformed successfully.
+def transform_file(path: str, cache_path: str | None = None, stream: bool = False, keywords: List[str] | None = None, source_map: bool = False) -> Tuple[str, int, bool, str | None, dict | None]:
+	cache = None if cache_path is None else TransformCache(cache_path)
+	options = {} if keywords is None else {'keywords': keywords}
+
+	try:
+		if stream:
+			lines, stats = transform_file_stream(path, **options)
+			return (path, lines, False, None, stats)
+
+		with open(path, "r") as f:
+			python_src = f.read()
+
+		stats = write_transformed(path, python_src, cache, source_map, **options)
+	except Exception as e:
+		return (path, 0, False, f"{type(e).__name__}: {e}", None)
+
+	cached = cache is not None and cache.hits > 0
+	return (path, python_src.count("\n") + 1, cached, None, stats)
+
+# check a path relative to a searched directory against the globs,
+# matching either the file name or the whole relative path
+def path_matches(path: str, globs: List[str]) -> bool:
+	name = os.path.basename(path)
+	return any(fnmatch.fnmatch(name, glob) or fnmatch.fnmatch(path, glob) for glob in globs)
+
+# expand files and directories into a sorted list of files to transform.
+# files passed explicitly are always included.
+def collect_files(paths: List[str], include: List[str], exclude: List[str]) -> List[str]:
+	files = []
+
+	for path in paths:
+		if not os.path.isdir(path):
+			files.append(path)
+			continue
+
+		for root, dirs, names in os.walk(path):
+			# skip caches and hidden directories, walk in a stable order
+			dirs[:] = sorted(d for d in dirs if d != "__pycache__" and not d.startswith("."))
+			for name in sorted(names):
+				rel = os.path.relpath(os.path.join(root, name), path)
+				if path_matches(rel, include) and not path_matches(rel, exclude):
+					files.append(os.path.join(root, name))
+
+	return files
+
+# transform files in a process pool, yielding (path, lines, cached, error, stats) in order
+def transform_batch(files: List[str], jobs: int, cache_path: str | None = None, stream: bool = False, keywords: List[str] | None = None, source_map: bool = False) -> Iterator[Tuple[str, int, bool, str | None, dict | None]]:
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		chunksize = max(1, len(files) // (jobs * 8))
+		yield from pool.map(functools.partial(transform_file, cache_path=cache_path, stream=stream, keywords=keywords, source_map=source_map), files, chunksize=chunksize)
+
+# dump statistics keyed by path as JSON, `-` for stdout
+def write_stats(path: str, all_stats: dict):
+	if path == "-":
+		json.dump(all_stats, sys.stdout, indent=2)
+		print()
+		return
+	with open(path, "w") as f:
+		json.dump(all_stats, f, indent=2)
+
+def batch_main(args, cache: TransformCache | None, keywords: List[str] | None) -> int:
+	files = collect_files(args.paths, args.include or ["*.py"], args.exclude or [])
+
+	jobs = args.jobs or os.cpu_count()
+	start = time.perf_counter()
+	failures = 0
+	total_lines = 0
+	hits = 0
+	all_stats = {}
+
+	for path, lines, cached, error, stats in transform_batch(files, jobs, args.cache, args.stream, keywords, args.source_map):
+		if error is not None:
+			print(f"{path}: {error}", file=sys.stderr)
+			failures += 1
+		total_lines += lines
+		hits += cached
+		if stats is not None:
+			all_stats[path] = stats
+
+	elapsed = max(time.perf_counter() - start, 1e-9)
+	transformed = len(files) - failures
+	print(
+		f"transformed {transformed}/{len(files)} files, {total_lines} lines in {elapsed:.2f}s "
+		f"({transformed / elapsed:.1f} files/s, {total_lines / elapsed:.0f} lines/s, {jobs} workers)"
+	)
+	if cache is not None:
+		cache.prune()
+		stats = cache.stats()
+		print(f"cache: {hits} hits, {transformed - hits} misses, {stats['entries']} entries, {stats['bytes']} bytes")
+	if args.stats is not None:
+		write_stats(args.stats, all_stats)
+
+	return 1 if failures else 0
 
 def main():
-	# yeah, we don't need this
-	# passes = get_passes(sys.argv[2])
+	parser = argparse.ArgumentParser(description="remove keywords from Python source files, in place")
+	parser.add_argument("paths", nargs="*", help="<file> [keywords], or files and directories with --batch")
+	parser.add_argument("--batch", action="store_true", help="transform many files and directories")
+	parser.add_argument("-j", "--jobs", type=int, help="worker processes, for --batch or the blocks of a single file, default the CPUs for --batch")
+	parser.add_argument("--include", action="append", help="glob of files to transform in directories, default *.py")
+	parser.add_argument("--exclude", action="append", help="glob of files to skip in directories")
+	parser.add_argument("--cache", help="directory of the transform cache")
+	parser.add_argument("--cache-size", type=float, default=256, help="maximum size of the cache in MB")
+	parser.add_argument("--cache-clear", action="store_true", help="empty the cache before transforming")
+	parser.add_argument("--stream", action="store_true", help="transform block by block with bounded memory")
+	parser.add_argument("--stats", metavar="PATH", help="dump statistics of every transformed file as JSON, - for stdout")
+	parser.add_argument("--keywords", metavar="PATH", help="file of the forbidden keywords, all of them by default")
+	parser.add_argument("--source-map", action="store_true", help="write a source map next to every transformed file")
+	parser.add_argument("--incremental", metavar="STATE", help="only transform the blocks changed since the run that wrote STATE")
+	args = parser.parse_args()
+
+	if args.stream and args.cache is not None:
+		parser.error("--stream can't be used with --cache, the cache needs the whole source")
+	if args.source_map and (args.stream or args.cache is not None):
+		parser.error("--source-map can't be used with --stream or --cache, the map needs the whole program")
+	if args.incremental is not None and (args.batch or args.stream or args.cache is not None or args.source_map or args.jobs is not None):
+		parser.error("--incremental transforms a single file, it can't be used with --batch, --stream, --cache, --source-map or -j")
+	if args.jobs is not None and args.jobs < 1:
+		parser.error("-j must be at least 1")
+
+	cache = None
+	if args.cache is not None:
+		cache = TransformCache(args.cache, int(args.cache_size * 2 ** 20))
+		if args.cache_clear:
+			cache.clear()
+	elif args.cache_clear:
+		parser.error("--cache-clear requires --cache")
+
+	# clearing the cache is a valid invocation on its own
+	if len(args.paths) == 0:
+		if args.cache_clear:
+			return
+		parser.error("expected <file> [keywords], or paths with --batch")
+
+	keywords_path = args.keywords
+	if not args.batch and len(args.paths) == 2:
+		if keywords_path is not None:
+			parser.error("the keywords file was given twice")
+		keywords_path = args.paths.pop()
+
+	keywords = None
+	if keywords_path is not None:
+		keywords = read_keywords(keywords_path)
+		unknown = [word for word in keywords if word not in KEYWORDS]
+		if unknown:
+			parser.error(f"can't remove {', '.join(unknown)}, only {', '.join(KEYWORDS)}")
+
+	if args.batch:
+		sys.exit(batch_main(args, cache, keywords))
+
+	if len(args.paths) > 1:
+		parser.error("expected <file> [keywords], use --batch for many files")
+
+	options = {} if keywords is None else {'keywords': keywords}
+	jobs = args.jobs or 1
+	if jobs > 1 and (args.stream or args.source_map):
+		parser.error("-j can't be used with --stream or --source-map on a single file")
 
 	# 1. read the file
 	# 2. create a Program, parse into IR
@@ -22,15 +377,23 @@ def main():
 	# 4. transpile the IR back into Python
 	# 5. write the new Python back into the file
 
-	with open(sys.argv[1], "r") as f:
-		python_src = f.read()
+	if args.stream:
+		_, stats = transform_file_stream(args.paths[0], **options)
+	elif args.incremental is not None:
+		with open(args.paths[0], "r") as f:
+			python_src = f.read()
 
-	program = Program(python_src)
-	program.transform()
-	new_src = program.transpile()
+		stats = write_incremental(args.paths[0], python_src, args.incremental, **options)
+	else:
+		with open(args.paths[0], "r") as f:
+			python_src = f.read()
 
-	with open(sys.argv[1], "w") as f:
-		f.write(new_src)
+		stats = write_transformed(args.paths[0], python_src, cache, args.source_map, jobs, **options)
+
+	if cache is not None:
+		cache.prune()
+	if args.stats is not None:
+		write_stats(args.stats, {} if stats is None else {args.paths[0]: stats})
 
 if __name__ == "__main__":
 	main()